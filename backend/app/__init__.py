@@ -1,6 +1,7 @@
 from flask import Flask, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+import multiprocessing
 import os
 
 db = SQLAlchemy()
@@ -28,14 +29,47 @@ def create_app():
     )
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+    # Load the shared embedding model at startup instead of on the first request
+    app.config['EMBEDDING_WARMUP'] = os.getenv('EMBEDDING_WARMUP', '0') == '1'
+
+    # Run /generate and /cluster as background jobs by default (workers: python worker.py)
+    app.config['ASYNC_JOBS'] = os.getenv('ASYNC_JOBS', '0') == '1'
+
     # Initialize extensions
     db.init_app(app)
     migrate.init_app(app, db)
 
+    from . import metrics
+    with app.app_context():
+        metrics.instrument_engine(db.engine)
+
     # Register blueprints
     from .views import views
     app.register_blueprint(views, url_prefix='/api')
 
+    # Child processes (e.g. the plot rendering pool re-importing main.py) skip the warm-up
+    if app.config['EMBEDDING_WARMUP'] and multiprocessing.parent_process() is None:
+        from .thematic_analysis.embeddings import warm_up
+        warm_up()
+
+    @app.cli.command('rebuild-codeword-index')
+    def rebuild_codeword_index():
+        """Re-embed every approved codeword into the similarity search index."""
+        from .thematic_analysis.codeword_index import rebuild_index
+        print(f"Indexed {rebuild_index()} codewords")
+
+    @app.cli.command('backfill-codewords')
+    def backfill_codewords_command():
+        """Fill the codewords table from Feedback.codewords for existing rows."""
+        from .thematic_analysis.utils import backfill_codewords
+        print(f"Backfilled codewords for {backfill_codewords()} feedback rows")
+
+    @app.cli.command('backfill-plots')
+    def backfill_plots_command():
+        """Move base64 plots of results from before plot_data into plot_images."""
+        from .thematic_analysis.utils import backfill_legacy_plots
+        print(f"Moved the plots of {backfill_legacy_plots()} cluster results")
+
     # Serve React frontend
     @app.route('/', defaults={'path': ''})
     @app.route('/<path:path>')
@@ -0,0 +1,159 @@
+# ------------- File ingest -------------
+# Streams an uploaded CSV/XLSX survey export into Feedback rows. The file is
+# read in chunks of INGEST_CHUNK rows and each chunk is inserted and committed
+# before the next one is parsed, so memory use depends on the chunk size, not
+# on the file size. Werkzeug already spools large uploads to a temp file.
+#
+# Only the feedback text column and an optional student name column are kept;
+# rows with blank text are dropped.
+
+import os
+
+from . import db, metrics
+from app.thematic_analysis.utils import insert_feedback
+
+
+INGEST_CHUNK = int(os.getenv('INGEST_CHUNK', '2000'))  # rows parsed and inserted per batch
+NAME_COLUMN = 'student_name'  # picked up automatically when no name column is given
+NAME_MAX_LENGTH = 100  # Feedback.student_name is a String(100)
+
+
+class IngestError(ValueError):
+    pass
+
+
+def file_format(filename):
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.xlsx', '.xlsm'):
+        return 'xlsx'
+    raise IngestError(f"Unsupported file type '{extension or filename}'; upload a .csv or .xlsx file.")
+
+
+def _find_column(header, wanted, required=True):
+    # Exact match first, then ignoring case and surrounding spaces
+    if wanted in header:
+        return header.index(wanted)
+    normalized = [str(name).strip().lower() if name is not None else '' for name in header]
+    if str(wanted).strip().lower() in normalized:
+        return normalized.index(str(wanted).strip().lower())
+    if required:
+        raise IngestError(f"Column '{wanted}' not found. Available columns: {', '.join(str(h) for h in header if h is not None)}")
+    return None
+
+
+def _resolve_columns(header, text_column, name_column):
+    text_index = _find_column(header, text_column)
+    if name_column:
+        name_index = _find_column(header, name_column)
+    else:
+        name_index = _find_column(header, NAME_COLUMN, required=False)
+    return text_index, name_index
+
+
+def _csv_chunks(stream, text_column, name_column, chunk_size):
+    import pandas as pd
+
+    # Read only the header to resolve the columns, then rewind and stream the rows
+    try:
+        header = list(pd.read_csv(stream, nrows=0, encoding='utf-8-sig', encoding_errors='replace').columns)
+    except pd.errors.EmptyDataError:
+        raise IngestError("The uploaded file is empty.")
+    text_index, name_index = _resolve_columns(header, text_column, name_column)
+    stream.seek(0)
+
+    usecols = [text_index] if name_index is None else [text_index, name_index]
+    reader = pd.read_csv(stream, usecols=usecols, dtype=str, keep_default_na=False, chunksize=chunk_size,
+                         encoding='utf-8-sig', encoding_errors='replace')
+    with reader:
+        try:
+            for chunk in reader:
+                texts = chunk[header[text_index]].tolist()
+                names = chunk[header[name_index]].tolist() if name_index is not None else [None] * len(texts)
+                yield list(zip(texts, names))
+        except pd.errors.ParserError as e:
+            raise IngestError(f"Could not parse the CSV file: {e}")
+
+
+def _xlsx_chunks(stream, text_column, name_column, chunk_size, sheet=None):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise IngestError("XLSX upload needs openpyxl on the server (pip install openpyxl); upload a CSV instead.")
+    from zipfile import BadZipFile
+
+    # read_only streams rows from the sheet XML instead of building the whole workbook
+    try:
+        workbook = load_workbook(stream, read_only=True, data_only=True)
+    except (BadZipFile, KeyError, ValueError) as e:
+        raise IngestError(f"Could not read the XLSX file: {e}")
+    try:
+        if sheet:
+            if sheet not in workbook.sheetnames:
+                raise IngestError(f"Sheet '{sheet}' not found. Available sheets: {', '.join(workbook.sheetnames)}")
+            worksheet = workbook[sheet]
+        else:
+            worksheet = workbook.worksheets[0]
+
+        rows = worksheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            raise IngestError("The uploaded file is empty.")
+        text_index, name_index = _resolve_columns(list(header), text_column, name_column)
+
+        chunk = []
+        for row in rows:
+            text = row[text_index] if text_index < len(row) else None
+            name = row[name_index] if name_index is not None and name_index < len(row) else None
+            chunk.append((text, name))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    finally:
+        workbook.close()
+
+
+def read_chunks(stream, filename, text_column, name_column=None, chunk_size=None, sheet=None):
+    """
+    Yield lists of raw (text, student_name) pairs from a CSV or XLSX upload,
+    at most chunk_size at a time.
+    """
+    chunk_size = chunk_size or INGEST_CHUNK
+    if file_format(filename) == 'csv':
+        return _csv_chunks(stream, text_column, name_column, chunk_size)
+    return _xlsx_chunks(stream, text_column, name_column, chunk_size, sheet)
+
+
+def _clean(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value != value:  # NaN
+        return ''
+    return str(value).strip()
+
+
+def ingest_feedback(submission_id, stream, filename, text_column, name_column=None, chunk_size=None, sheet=None):
+    """
+    Insert the rows of an uploaded file as uncoded Feedback rows of a
+    submission, committing after every chunk. Returns row counts.
+    """
+    stats = {"rows": 0, "skipped_blank": 0, "chunks": 0}
+    with metrics.span('ingest'):
+        for chunk in read_chunks(stream, filename, text_column, name_column, chunk_size, sheet):
+            texts, names = [], []
+            for text, name in chunk:
+                text = _clean(text)
+                if not text:
+                    stats["skipped_blank"] += 1
+                    continue
+                texts.append(text)
+                names.append(_clean(name)[:NAME_MAX_LENGTH] or None)
+            if texts:
+                insert_feedback(submission_id, texts, student_names=names, returning=False)
+                db.session.commit()
+                stats["rows"] += len(texts)
+            stats["chunks"] += 1
+    return stats
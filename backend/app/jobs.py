@@ -0,0 +1,300 @@
+# ------------- Background jobs -------------
+# A small DB-backed queue so /generate and /cluster don't run the LLM and ML
+# pipeline inside the HTTP request. Jobs live in the `jobs` table; worker
+# processes (see worker.py) claim them with a conditional UPDATE, which works on
+# SQLite and Postgres alike without an external broker.
+#
+# Handlers are written to be resumable: a generate job only codes feedback rows
+# whose codewords are still NULL, so a job requeued after a crash or restart
+# picks up where it stopped.
+
+import os
+import socket
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import update
+
+from . import db
+from .models import Job, Submission, Feedback
+
+
+JOB_STALE_AFTER = int(os.getenv('JOB_STALE_AFTER', '900'))  # seconds without a heartbeat before a running job is requeued
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1.0'))
+GENERATE_CHUNK = int(os.getenv('JOB_GENERATE_CHUNK', '50'))  # feedback rows coded per commit
+
+_handlers = {}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def job_handler(kind):
+    def register(fn):
+        _handlers[kind] = fn
+        return fn
+    return register
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def enqueue(kind, payload=None, submission_id=None):
+    job = Job(kind=kind, status='queued', payload=payload or {}, submission_id=submission_id,
+              stage='queued', progress=0.0, timings={})
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def job_to_dict(job):
+    data = {
+        "job_id": job.public_id,
+        "kind": job.kind,
+        "status": job.status,
+        "stage": job.stage,
+        "progress": round(job.progress or 0.0, 1),
+        "timings": job.timings or {},
+        "attempts": job.attempts,
+        "error": job.error,
+        "cancel_requested": bool(job.cancel_requested),
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if job.status == 'done':
+        data["result"] = job.result
+    return data
+
+
+def cancel(job):
+    # Queued jobs stop right away; running ones stop at their next progress check
+    if job.status == 'queued':
+        job.status = 'cancelled'
+        job.finished_at = _now()
+    elif job.status == 'running':
+        job.cancel_requested = True
+    db.session.commit()
+    return job
+
+
+def resume(job):
+    if job.status in ('failed', 'cancelled'):
+        job.status = 'queued'
+        job.cancel_requested = False
+        job.error = None
+        job.finished_at = None
+        db.session.commit()
+    return job
+
+
+def requeue_stale(stale_after=None):
+    """
+    Put running jobs whose worker stopped heartbeating back on the queue.
+    With stale_after=0 every running job is requeued (used on a full restart).
+    """
+    stale_after = JOB_STALE_AFTER if stale_after is None else stale_after
+    cutoff = _now() - timedelta(seconds=stale_after)
+    result = db.session.execute(
+        update(Job)
+        .where(Job.status == 'running', (Job.heartbeat_at == None) | (Job.heartbeat_at < cutoff))  # noqa: E711
+        .values(status='queued', worker=None)
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def claim_next(worker_id):
+    # Oldest queued job first; the status check in the UPDATE makes the claim atomic
+    while True:
+        job_id = db.session.query(Job.id).filter_by(status='queued').order_by(Job.id).limit(1).scalar()
+        if job_id is None:
+            return None
+        now = _now()
+        claimed = db.session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == 'queued')
+            .values(status='running', worker=worker_id, heartbeat_at=now, started_at=now,
+                    attempts=Job.attempts + 1)
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id)
+
+
+class JobContext:
+    """
+    Handed to job handlers to report stage/progress. Every report refreshes the
+    heartbeat and raises JobCancelled if a cancel was requested.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self._stage_started = time.perf_counter()
+
+    def stage(self, name, progress=None):
+        self._close_stage()
+        self.job.stage = name
+        if progress is not None:
+            self.job.progress = progress
+        self._beat()
+
+    def progress(self, done, total):
+        self.job.progress = 100.0 * done / total if total else 100.0
+        self._beat()
+
+    def finish(self):
+        self._close_stage()
+
+    def _close_stage(self):
+        now = time.perf_counter()
+        if self.job.stage and self.job.stage != 'queued':
+            timings = dict(self.job.timings or {})
+            timings[self.job.stage] = round(timings.get(self.job.stage, 0.0) + now - self._stage_started, 3)
+            self.job.timings = timings
+        self._stage_started = now
+
+    def _beat(self):
+        self.job.heartbeat_at = _now()
+        db.session.commit()
+        cancel_requested = db.session.query(Job.cancel_requested).filter_by(id=self.job.id).scalar()
+        if cancel_requested:
+            raise JobCancelled()
+
+
+def run_job(job):
+    handler = _handlers.get(job.kind)
+    ctx = JobContext(job)
+    try:
+        if handler is None:
+            raise ValueError(f"Unknown job kind: {job.kind}")
+        job.result = handler(job, ctx)
+        ctx.finish()
+        job.status = 'done'
+        job.stage = 'done'
+        job.progress = 100.0
+    except JobCancelled:
+        db.session.rollback()
+        ctx.finish()
+        job.status = 'cancelled'
+    except Exception as e:
+        db.session.rollback()
+        print(f"Job {job.public_id} failed:", str(e))
+        import traceback
+        traceback.print_exc()
+        ctx.finish()
+        job.status = 'failed'
+        job.error = str(e)
+    job.finished_at = _now()
+    db.session.commit()
+    return job
+
+
+def run_worker(app, poll_interval=None, once=False):
+    poll_interval = JOB_POLL_INTERVAL if poll_interval is None else poll_interval
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    last_sweep = 0.0
+
+    with app.app_context():
+        while True:
+            if time.monotonic() - last_sweep > 60:
+                requeue_stale()
+                last_sweep = time.monotonic()
+
+            job = claim_next(worker_id)
+            if job is not None:
+                run_job(job)
+                db.session.remove()
+            elif once:
+                return
+            else:
+                time.sleep(poll_interval)
+
+
+# ------------- Handlers -------------
+
+@job_handler('generate')
+def run_generate(job, ctx):
+    from app.thematic_analysis.llm_coding import generate_codewords_bulk
+    from app.thematic_analysis.utils import sync_codewords, dedup_uncoded, copy_representative_codewords
+
+    submission = db.session.get(Submission, job.submission_id)
+    batch_size = (job.payload or {}).get('batch_size')
+
+    # Duplicates are linked to a representative and skip the LLM
+    ctx.stage('dedup')
+    dedup_uncoded(submission.id)
+    db.session.commit()
+
+    to_code = Feedback.query.filter_by(submission_id=submission.id, representative_id=None)
+    total = to_code.count()
+    ctx.stage('coding')
+
+    # {feedback id: error} of failed rows, kept on the job so a resumed run still reports earlier chunks
+    errors = dict((job.result or {}).get('errors') or {})
+    while True:
+        # Rows already coded by an earlier attempt are skipped
+        pending = (to_code
+                   .filter_by(codewords=None)
+                   .order_by(Feedback.id)
+                   .limit(GENERATE_CHUNK)
+                   .all())
+        if not pending:
+            break
+
+        coded = generate_codewords_bulk([fb.feedback_text for fb in pending], batch_size=batch_size)
+        failed = len(errors)
+        for fb, (codewords, error) in zip(pending, coded):
+            # Failed rows are stored as empty so a resume doesn't retry them forever
+            fb.codewords = ','.join(codewords)
+            if error:
+                errors[str(fb.id)] = error
+        sync_codewords(pending)
+        if len(errors) > failed:
+            job.result = {"errors": dict(errors)}
+        db.session.commit()
+
+        remaining = to_code.filter_by(codewords=None).count()
+        ctx.progress(total - remaining, total)
+
+    ctx.stage('copying')
+    copy_representative_codewords(submission.id)
+
+    # Only counts and failures: the rows themselves are paged from /submission/<id>/feedback
+    ctx.stage('collecting')
+    rows = Feedback.query.filter_by(submission_id=submission.id).count()
+    return {
+        "submission_id": submission.public_id,
+        "rows": rows,
+        "coded": total,
+        "duplicates": rows - total,
+        "failed": len(errors),
+        "errors": errors,
+    }
+
+
+@job_handler('cluster')
+def run_cluster(job, ctx):
+    from app.thematic_analysis.utils import cluster_submission_codewords, prerender_plots, parse_theme_seeds
+    from app.models import ThemeSet
+    import json
+
+    submission = db.session.get(Submission, job.submission_id)
+    payload = job.payload or {}
+    theme_set = None
+    if payload.get('theme_set_id'):
+        theme_set = ThemeSet.query.filter_by(public_id=payload['theme_set_id']).one()
+
+    ctx.stage('clustering', progress=10.0)
+    theme_seeds = None if theme_set else parse_theme_seeds(payload.get('themes', {}), payload.get('seeds', {}))
+    cluster_result = cluster_submission_codewords(submission, theme_seeds, theme_set)
+    if cluster_result is None:
+        raise ValueError("No codewords available for clustering.")
+
+    # Off the request path anyway, so have the charts ready before the results page asks
+    ctx.stage('rendering', progress=70.0)
+    prerender_plots(cluster_result)
+
+    return {"public_id": submission.public_id, "results": json.loads(cluster_result.results)}
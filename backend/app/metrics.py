@@ -0,0 +1,164 @@
+# ------------- Metrics and tracing -------------
+# A small in-process registry of counters and timing histograms, exported as
+# Prometheus text at /api/metrics. Code marks expensive steps with
+# `with span('kmeans'):` and counts things with `inc('llm_calls_total')`.
+#
+# trace() additionally collects the spans of one piece of work (e.g. one
+# clustering run) into a {stage: seconds} dict, which is how the per-submission
+# breakdown in ClusterResult.timings is built. Nested spans each record their
+# own time, so stages can overlap (define_themes includes encode).
+#
+# Every process keeps its own numbers; with several gunicorn workers or job
+# workers, each scrape sees the process that answered it.
+
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+PREFIX = 'thematic_'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+HELP = {
+    'stage_seconds': "Time spent in each pipeline stage.",
+    'http_request_seconds': "Time to produce an API response, by endpoint.",
+    'http_requests_total': "API responses, by endpoint and status.",
+    'llm_calls_total': "Chat completion requests sent to OpenAI.",
+    'llm_errors_total': "Chat completion requests that failed.",
+    'llm_retries_total': "Chat completion requests retried after a retryable error.",
+    'llm_tokens_total': "Tokens reported by OpenAI usage, by type.",
+    'llm_cache_hits_total': "LLM replies served from llm_cache.",
+    'llm_cache_misses_total': "LLM lookups that missed llm_cache.",
+    'llm_cache_bypassed_total': "LLM lookups skipped because a fresh answer was forced.",
+    'llm_cache_stored_total': "LLM replies written to llm_cache.",
+    'llm_cache_evicted_total': "llm_cache rows evicted (expired or over the size limit).",
+    'embedding_cache_hits_total': "Embeddings served from a cache, by level.",
+    'embeddings_encoded_total': "Texts run through the embedding model.",
+    'db_queries_total': "SQL statements executed.",
+    'rows_total': "Rows written, by table and operation.",
+    'dedup_collapsed_total': "Feedback rows not sent to the LLM because they duplicate another response.",
+}
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_histograms = {}
+_current_trace = ContextVar('current_trace', default=None)
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe('stage_seconds', elapsed, stage=stage)
+        timings = _current_trace.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+@contextmanager
+def trace(timings=None):
+    """
+    Collect the spans run inside the block (in this thread) into a
+    {stage: seconds} dict. Pass an existing dict to keep adding to it.
+    """
+    timings = {} if timings is None else timings
+    token = _current_trace.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_trace.reset(token)
+
+
+def rounded(timings):
+    return {stage: round(seconds, 4) for stage, seconds in timings.items()}
+
+
+# ------------- Prometheus export -------------
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def render_prometheus():
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: dict(h, buckets=list(h["buckets"])) for key, h in _histograms.items()}
+
+    lines = []
+    for kind, series in (('counter', counters), ('histogram', histograms)):
+        by_name = defaultdict(list)
+        for (name, labels), value in sorted(series.items()):
+            by_name[name].append((labels, value))
+        for name, entries in by_name.items():
+            full_name = PREFIX + name
+            lines.append(f"# HELP {full_name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for labels, value in entries:
+                if kind == 'counter':
+                    lines.append(f"{full_name}{_labels(labels)} {value:g}")
+                    continue
+                for bound, count in zip(BUCKETS, value["buckets"]):
+                    lines.append(f"{full_name}_bucket{_labels(labels, [('le', f'{bound:g}')])} {count}")
+                lines.append(f"{full_name}_bucket{_labels(labels, [('le', '+Inf')])} {value['count']}")
+                lines.append(f"{full_name}_sum{_labels(labels)} {value['sum']:.6f}")
+                lines.append(f"{full_name}_count{_labels(labels)} {value['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+def instrument_engine(engine):
+    # Count statements and time them as the "db" stage
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        inc('db_queries_total')
+        observe('stage_seconds', elapsed, stage='db')
+        timings = _current_trace.get()
+        if timings is not None:
+            timings['db'] = timings.get('db', 0.0) + elapsed
+
+    @event.listens_for(engine, 'handle_error')
+    def _error(context):
+        # A failed statement never reaches after_cursor_execute
+        conn = context.connection
+        if conn is not None and conn.info.get('query_start'):
+            conn.info['query_start'].pop()
@@ -21,24 +21,41 @@ class Submission(db.Model):
 
 class Feedback(db.Model):
     __tablename__ = 'feedbacks'
+    # Serves both "rows of a submission" and keyset pagination (submission_id, id > cursor)
+    __table_args__ = (db.Index('ix_feedbacks_submission_id_id', 'submission_id', 'id'),)
 
     id = db.Column(db.Integer, primary_key=True)
     student_name = db.Column(db.String(100), nullable=True)  # Optional, if present in CSV
     feedback_text = db.Column(db.Text, nullable=False)
     codewords = db.Column(JSON, nullable=True)
     approved = db.Column(db.Boolean, default=False)
+    # Set on duplicates of another response: they were not coded themselves but copied its codewords
+    representative_id = db.Column(db.Integer, db.ForeignKey('feedbacks.id'), nullable=True, index=True)
 
 
     submission_id = db.Column(db.Integer, db.ForeignKey('submissions.id'), nullable=False)
 
 
 
+class Codeword(db.Model):
+    # One row per code on a feedback row; Feedback.codewords keeps the joined string for display
+    __tablename__ = 'codewords'
+    __table_args__ = (db.Index('ix_codewords_submission_normalized', 'submission_id', 'normalized_text'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    feedback_id = db.Column(db.Integer, db.ForeignKey('feedbacks.id'), nullable=False, index=True)
+    submission_id = db.Column(db.Integer, db.ForeignKey('submissions.id'), nullable=False)
+    text = db.Column(db.String(255), nullable=False)
+    normalized_text = db.Column(db.String(255), nullable=False)
+
+
+
 class Theme(db.Model):
     __tablename__ = 'themes'  
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    submission_id = db.Column(db.Integer, db.ForeignKey('submissions.id'), nullable=False)
+    submission_id = db.Column(db.Integer, db.ForeignKey('submissions.id'), nullable=False, index=True)
 
     seeds = db.relationship('Seed', backref='theme', cascade="all, delete-orphan")
 
@@ -47,7 +64,7 @@ class Theme(db.Model):
 class Seed(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.String(255), nullable=False)
-    theme_id = db.Column(db.Integer, db.ForeignKey('themes.id'), nullable=False)
+    theme_id = db.Column(db.Integer, db.ForeignKey('themes.id'), nullable=False, index=True)
 
 
 
@@ -56,17 +73,120 @@ class ClusterResult(db.Model):
     submission_id = db.Column(db.Integer, db.ForeignKey('submissions.id'), nullable=False, unique=True)
     results = db.Column(db.Text, nullable=False) 
 
+    plot_data = db.Column(JSON)  # words, labels, 2-D coords and theme overlap; plots are rendered from this
+    theme_seeds = db.Column(JSON)  # {theme: [seeds]} used for the fit, needed for a full refit
+    theme_set_id = db.Column(db.Integer, db.ForeignKey('theme_sets.id'), nullable=True)  # set when clustered with a library theme set
+    model_state = db.Column(db.LargeBinary)  # npz: theme centres, PCA basis, per-theme sums/counts
+    version = db.Column(db.Integer, default=1)  # bumped on every re-cluster, used in plot URLs
+    timings = db.Column(JSON)  # {stage: seconds} for the fit, plus later renders and appends
+    updated_at = db.Column(db.DateTime(timezone=True), default=func.now(), onupdate=func.now())
 
-    scatter_plot = db.Column(db.Text)  # Base64 string
-    bar_chart = db.Column(db.Text)
-    word_cloud = db.Column(db.Text)
+    # Base64 data URIs from before plot_data existed; only read for results that have no plot_data
+    # (served by get_or_render_plot and moved into plot_images by `flask backfill-plots`)
+    scatter_plot = db.deferred(db.Column(db.Text))
+    bar_chart = db.deferred(db.Column(db.Text))
+    word_cloud = db.deferred(db.Column(db.Text))
 
+    plots = db.relationship('PlotImage', backref='cluster_result', cascade="all, delete-orphan")
+    theme_set = db.relationship('ThemeSet')
 
 
+class ThemeSet(db.Model):
+    # A named, versioned {theme: [seeds]} set that any submission can be clustered with
+    __tablename__ = 'theme_sets'
+    __table_args__ = (db.UniqueConstraint('name', 'version'),)
 
+    id = db.Column(db.Integer, primary_key=True)
+    public_id = db.Column(db.String(36), unique=True, nullable=False, default=lambda: str(uuid.uuid4()))
+    name = db.Column(db.String(200), nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1)  # a new version is saved whenever the seeds change
+    themes = db.Column(JSON, nullable=False)  # {theme: [seeds]}, in theme order
+    content_hash = db.Column(db.String(64), nullable=False)  # sha256 of themes, to spot unchanged saves
+
+    # Seed centroids, one float32 row per theme, valid for the embedding space they were computed in
+    embedding_space = db.Column(db.String(200))
+    dim = db.Column(db.Integer)
+    centroids = db.Column(db.LargeBinary)
+    created_at = db.Column(db.DateTime(timezone=True), default=func.now())
+
+
+class PlotImage(db.Model):
+    __tablename__ = 'plot_images'
+    __table_args__ = (db.UniqueConstraint('cluster_result_id', 'kind', 'preset'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    cluster_result_id = db.Column(db.Integer, db.ForeignKey('cluster_result.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # scatter_plot, bar_chart or word_cloud
+    preset = db.Column(db.String(20), nullable=False, default='full')  # size/DPI preset, see PLOT_PRESETS
+    content_hash = db.Column(db.String(64), nullable=False)  # sha256 of the PNG, used as the ETag
+    image = db.Column(db.LargeBinary, nullable=False)  # raw PNG bytes
+    created_at = db.Column(db.DateTime(timezone=True), default=func.now())
 
 
 
+class EmbeddingCache(db.Model):
+    __tablename__ = 'embedding_cache'
+    __table_args__ = (db.UniqueConstraint('model_name', 'text_hash'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    model_name = db.Column(db.String(200), nullable=False)
+    text_hash = db.Column(db.String(64), nullable=False)  # sha256 of the normalized text
+    text = db.Column(db.Text, nullable=False)
+    dim = db.Column(db.Integer, nullable=False)
+    vector = db.Column(db.LargeBinary, nullable=False)  # float32 bytes
+    created_at = db.Column(db.DateTime(timezone=True), default=func.now())
 
 
 
+class LLMCache(db.Model):
+    __tablename__ = 'llm_cache'
+
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), unique=True, nullable=False)  # sha256 of model, prompt hash and input
+    kind = db.Column(db.String(20), nullable=False)  # 'codewords' or 'seeds'
+    model_name = db.Column(db.String(100), nullable=False)
+    prompt_hash = db.Column(db.String(16), nullable=False)
+    input_text = db.Column(db.Text, nullable=False)
+    response = db.Column(JSON, nullable=False)
+    hits = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime(timezone=True), default=func.now())
+    last_used_at = db.Column(db.DateTime(timezone=True), default=func.now(), index=True)
+
+
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    public_id = db.Column(db.String(36), unique=True, nullable=False, default=lambda: str(uuid.uuid4()))
+    kind = db.Column(db.String(30), nullable=False)  # e.g., 'generate' or 'cluster'
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)  # queued, running, done, failed, cancelled
+    stage = db.Column(db.String(50))
+    progress = db.Column(db.Float, default=0.0)  # percent done
+    payload = db.Column(JSON)
+    result = db.Column(JSON)
+    error = db.Column(db.Text)
+    timings = db.Column(JSON)  # seconds spent per stage
+    attempts = db.Column(db.Integer, default=0)
+    cancel_requested = db.Column(db.Boolean, default=False)
+    worker = db.Column(db.String(100))
+
+    submission_id = db.Column(db.Integer, db.ForeignKey('submissions.id'), nullable=True)
+
+    created_at = db.Column(db.DateTime(timezone=True), default=func.now())
+    started_at = db.Column(db.DateTime(timezone=True))
+    finished_at = db.Column(db.DateTime(timezone=True))
+    heartbeat_at = db.Column(db.DateTime(timezone=True))
+
+
+
+class CodewordVector(db.Model):
+    __tablename__ = 'codeword_vectors'
+    # Ids must never be reused: the in-process search index detects changes by count and max id
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column(db.Integer, primary_key=True)
+    feedback_id = db.Column(db.Integer, db.ForeignKey('feedbacks.id'), nullable=False, index=True)
+    submission_id = db.Column(db.Integer, db.ForeignKey('submissions.id'), nullable=False, index=True)
+    text = db.Column(db.String(255), nullable=False)
+    vector = db.Column(db.LargeBinary, nullable=False)  # unit-length float32 bytes
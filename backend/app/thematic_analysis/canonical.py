@@ -0,0 +1,204 @@
+# ------------- Codeword canonicalization -------------
+# Before clustering, codes that mean the same thing ("unclear instructions",
+# "instructions were unclear") are merged into one canonical code carrying the
+# summed number of feedback rows behind them. Clustering then sees fewer,
+# weighted points and the bar chart counts occurrences rather than distinct
+# spellings.
+#
+# Two codes are linked when the cosine similarity of their embeddings is at
+# least CANONICAL_THRESHOLD and their words don't differ by a negation or an
+# antonym (dedup.contradicts: "clear instructions" / "unclear instructions"
+# embed close together but mean the opposite). Codes are then taken from the
+# most frequent down; each code not yet merged becomes canonical and absorbs
+# the unmerged codes linked to it. Every merged code is therefore similar to
+# its canonical code itself, not just to some code in a chain of neighbours.
+# The similarity matrix is built block by block over the upper triangle, so
+# it never exists in full; for large submissions only codes in the same
+# coarse K-means cell are compared, trading a few missed merges for
+# near-linear cost.
+#
+# On the streaming clustering path (streaming=True) the embedding matrix is
+# never built either: the coarse cells are fitted chunk by chunk, and each
+# cell's codes are encoded (mostly from the embedding cache) when it is
+# compared, so memory follows the chunk and cell size instead of N.
+
+import os
+
+import numpy as np
+
+from app import metrics
+from app.thematic_analysis.dedup import contradicts, normalize_feedback
+from app.thematic_analysis.embeddings import encode, unit_vectors
+
+# scipy and sklearn are imported where they are used, as in clustering.py
+
+
+CANONICAL_THRESHOLD = float(os.getenv('CANONICAL_THRESHOLD', '0.88'))  # 1 keeps every distinct code
+CANONICAL_EXACT_MAX = int(os.getenv('CANONICAL_EXACT_MAX', '10000'))  # above this, compare codes within coarse cells only
+CANONICAL_CELL_SIZE = 1000  # average codes per coarse cell
+CANONICAL_BLOCK_ELEMENTS = 1 << 24  # similarity values computed per block (64 MB of float32)
+ENCODE_CHUNK = 4096
+
+
+def _unit_chunks(words):
+    # (start, unit embeddings of words[start:start + ENCODE_CHUNK]) for every chunk
+    for start in range(0, len(words), ENCODE_CHUNK):
+        yield start, unit_vectors(encode(words[start:start + ENCODE_CHUNK]))
+
+
+def _unit_embeddings(words):
+    # Filled chunk by chunk so there is only ever one full-size matrix
+    matrix = None
+    for start, chunk in _unit_chunks(words):
+        if matrix is None:
+            matrix = np.empty((len(words), chunk.shape[1]), dtype=np.float32)
+        matrix[start:start + len(chunk)] = chunk
+    return matrix
+
+
+def _threshold_edges(embeddings, threshold, members=None):
+    # Upper-triangle pairs (i < j) with similarity >= threshold, among `members` (default: all rows)
+    subset = embeddings if members is None else embeddings[members]
+    n = len(subset)
+    block = max(1, CANONICAL_BLOCK_ELEMENTS // max(n, 1))
+    rows, cols = [], []
+    for start in range(0, n, block):
+        # Only columns from `start` on: the lower triangle holds the same pairs
+        similarities = subset[start:start + block] @ subset[start:].T
+        r, c = np.nonzero(similarities >= threshold)
+        keep = c > r  # drop the diagonal and pairs already seen within the block
+        rows.append(r[keep] + start)
+        cols.append(c[keep] + start)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    if members is not None:
+        rows, cols = members[rows], members[cols]
+    return rows, cols
+
+
+def _cell_members(nearest, n_cells):
+    # Rows per cell, from each row's two nearest cells
+    order = np.argsort(nearest, axis=None, kind='stable')
+    rows = order // 2
+    bounds = np.searchsorted(nearest.ravel()[order], np.arange(n_cells + 1))
+    return [rows[bounds[cell]:bounds[cell + 1]] for cell in range(n_cells)]
+
+
+def _coarse_cells(embeddings):
+    # Each row's two nearest MiniBatchKMeans cells; near duplicates sit close together, so they share one
+    from sklearn.cluster import MiniBatchKMeans
+
+    n_cells = max(2, len(embeddings) // CANONICAL_CELL_SIZE)
+    kmeans = MiniBatchKMeans(n_clusters=n_cells, n_init=1, random_state=42, batch_size=4096)
+    distances = kmeans.fit_transform(embeddings)
+    return _cell_members(np.argpartition(distances, 1, axis=1)[:, :2], n_cells)
+
+
+def _streamed_cells(words):
+    # _coarse_cells fed from encode chunks: one pass fits the cells, a second assigns the words
+    from sklearn.cluster import MiniBatchKMeans
+
+    n_cells = max(2, len(words) // CANONICAL_CELL_SIZE)
+    kmeans = MiniBatchKMeans(n_clusters=n_cells, n_init=1, random_state=42, batch_size=ENCODE_CHUNK)
+    for _, chunk in _unit_chunks(words):
+        kmeans.partial_fit(chunk)
+    nearest = np.empty((len(words), 2), dtype=np.int64)
+    for start, chunk in _unit_chunks(words):
+        nearest[start:start + len(chunk)] = np.argpartition(kmeans.transform(chunk), 1, axis=1)[:, :2]
+    return _cell_members(nearest, n_cells)
+
+
+def similarity_edges(embeddings, threshold):
+    """
+    Pairs of rows with cosine similarity >= threshold, as a list of (rows,
+    cols) index arrays. Rows must be unit vectors. Up to CANONICAL_EXACT_MAX
+    rows every pair is compared; above that only pairs that share a coarse
+    cell, which keeps the cost close to linear.
+    """
+    if len(embeddings) <= CANONICAL_EXACT_MAX:
+        return [_threshold_edges(embeddings, threshold)]
+    return [_threshold_edges(embeddings, threshold, members)
+            for members in _coarse_cells(embeddings) if len(members) > 1]
+
+
+def streamed_edges(words, threshold):
+    # similarity_edges over coarse cells without the full embedding matrix
+    edges = []
+    for members in _streamed_cells(words):
+        if len(members) > 1:
+            rows, cols = _threshold_edges(_unit_embeddings([words[i] for i in members]), threshold)
+            edges.append((members[rows], members[cols]))
+    return edges
+
+
+def _compatible(words, edges):
+    # Drop the pairs whose words differ by a negation or an antonym
+    rows = np.concatenate([r for r, _ in edges]) if edges else np.empty(0, dtype=np.int64)
+    cols = np.concatenate([c for _, c in edges]) if edges else np.empty(0, dtype=np.int64)
+    tokens = {}
+
+    def words_of(i):
+        if i not in tokens:
+            tokens[i] = frozenset(normalize_feedback(words[i]).split())
+        return tokens[i]
+
+    keep = np.fromiter((not contradicts(words_of(r), words_of(c)) for r, c in zip(rows.tolist(), cols.tolist())),
+                       dtype=bool, count=len(rows))
+    return rows[keep], cols[keep]
+
+
+def _star_labels(order, rows, cols):
+    # Walk the codes in order; each unmerged code absorbs its unmerged neighbours
+    from scipy.sparse import coo_matrix
+
+    n = len(order)
+    both_rows, both_cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+    graph = coo_matrix((np.ones(len(both_rows), dtype=np.int8), (both_rows, both_cols)), shape=(n, n)).tocsr()
+    labels = np.full(n, -1, dtype=np.int64)
+    for i in order:
+        if labels[i] >= 0:
+            continue
+        labels[i] = i
+        neighbours = graph.indices[graph.indptr[i]:graph.indptr[i + 1]]
+        labels[neighbours[labels[neighbours] < 0]] = i
+    return labels
+
+
+def canonicalize(codeword_counts, threshold=None, streaming=False):
+    """
+    Merge near-synonymous codes. codeword_counts is {code: occurrences}.
+    Returns (codes, counts, aliases): the canonical codes in input order,
+    their summed counts, and {canonical code: [codes merged into it]} for
+    the codes that absorbed others. streaming=True compares codes within
+    coarse cells without ever holding all embeddings at once.
+    """
+    with metrics.span('canonicalize'):
+        return _canonicalize(codeword_counts, CANONICAL_THRESHOLD if threshold is None else threshold, streaming)
+
+
+def _canonicalize(codeword_counts, threshold, streaming=False):
+    words = list(codeword_counts)
+    counts = np.array([codeword_counts[w] for w in words], dtype=np.int64)
+    if len(words) < 2 or threshold >= 1:
+        return words, counts.tolist(), {}
+
+    edges = streamed_edges(words, threshold) if streaming else similarity_edges(_unit_embeddings(words), threshold)
+    rows, cols = _compatible(words, edges)
+
+    # Most frequent first (then the shortest, then alphabetical): each group is named after its first code
+    order = sorted(range(len(words)), key=lambda i: (-codeword_counts[words[i]], len(words[i]), words[i]))
+    labels = _star_labels(order, rows, cols)
+    totals = np.bincount(labels, weights=counts, minlength=len(words)).astype(np.int64)
+
+    aliases = {}
+    for i in order:
+        if labels[i] != i:
+            aliases.setdefault(words[labels[i]], []).append(words[i])
+
+    out_words, out_counts, seen = [], [], set()
+    for label in labels.tolist():
+        if label in seen:
+            continue
+        seen.add(label)
+        out_words.append(words[label])
+        out_counts.append(int(totals[label]))
+    return out_words, out_counts, aliases
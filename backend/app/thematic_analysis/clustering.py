@@ -0,0 +1,179 @@
+# ------------- Clustering backends -------------
+# Two interchangeable ways to fit the seeded theme clusters:
+#   exact     - KMeans + PCA on the full embedding matrix (the original path)
+#   streaming - MiniBatchKMeans + IncrementalPCA fed chunk by chunk from a
+#               generator, so the full matrix is never materialised
+# Both start from the seed centroids (n_init=1), so themes keep their meaning,
+# and both return the same dict. See benchmarks/bench_clustering.py for where
+# the streaming path starts to pay off.
+
+import io
+import os
+
+import numpy as np
+
+from app import metrics
+
+# sklearn is imported where it is used: it takes about a second to import, and
+# web workers that only serve stored results never need it.
+
+
+CLUSTER_BACKEND = os.getenv('CLUSTER_BACKEND', 'auto')  # auto, exact or streaming
+CLUSTER_LARGE_THRESHOLD = int(os.getenv('CLUSTER_LARGE_THRESHOLD', '20000'))  # auto switches to streaming above this
+CLUSTER_CHUNK_SIZE = int(os.getenv('CLUSTER_CHUNK_SIZE', '4096'))
+CLUSTER_EPOCHS = int(os.getenv('CLUSTER_EPOCHS', '3'))  # mini-batch passes over the data
+
+
+def assignment_matrix(labels, n_groups):
+    # One row per group, one column per item: A[g, i] = 1 when item i belongs to group g
+    labels = np.asarray(labels)
+    return (labels[None, :] == np.arange(n_groups)[:, None]).astype(np.float32)
+
+
+def group_centroids(embeddings, labels, n_groups):
+    # Mean embedding of each group as a single matrix product; empty groups stay zero
+    assignments = assignment_matrix(labels, n_groups)
+    sizes = assignments.sum(axis=1, keepdims=True)
+    return (assignments @ embeddings) / np.maximum(sizes, 1)
+
+
+def cosine_matrix(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit = vectors / np.where(norms == 0, 1, norms)
+    return unit @ unit.T
+
+
+def choose_backend(n_items, backend=None):
+    backend = backend or CLUSTER_BACKEND
+    if backend == 'auto':
+        return 'streaming' if n_items > CLUSTER_LARGE_THRESHOLD else 'exact'
+    if backend not in ('exact', 'streaming'):
+        raise ValueError(f"Unknown clustering backend: {backend}")
+    return backend
+
+
+def fit_kmeans(word_embeddings, theme_centers, sample_weight=None):
+    from sklearn.cluster import KMeans
+
+    kmeans = KMeans(n_clusters=len(theme_centers), init=theme_centers, n_init=1, random_state=42)
+    kmeans.fit(word_embeddings, sample_weight=sample_weight)
+    return kmeans
+
+
+def fit_pca(word_embeddings):
+    from sklearn.decomposition import PCA
+
+    pca = PCA(n_components=2)
+    coords = pca.fit_transform(word_embeddings)
+    return pca, coords
+
+
+def fit_exact(word_embeddings, theme_centers, sample_weight=None):
+    n_themes = len(theme_centers)
+    with metrics.span('kmeans'):
+        kmeans = fit_kmeans(word_embeddings, theme_centers, sample_weight)
+    labels = kmeans.labels_
+    with metrics.span('pca'):
+        pca, coords = fit_pca(word_embeddings)
+
+    return {
+        "labels": labels,
+        "coords": coords,
+        "word_centroids": group_centroids(word_embeddings, labels, n_themes),
+        "centers": kmeans.cluster_centers_,
+        "pca_mean": pca.mean_,
+        "pca_components": pca.components_,
+    }
+
+
+def fit_streaming(embedding_chunks, theme_centers, epochs=None, sample_weight=None):
+    """
+    embedding_chunks is a zero-argument callable returning a fresh iterator of
+    2-D arrays; it is called once per pass over the data. sample_weight, if
+    given, has one weight per row across all chunks.
+    """
+    with metrics.span('fit_streaming'):
+        return _fit_streaming(embedding_chunks, theme_centers, epochs or CLUSTER_EPOCHS, sample_weight)
+
+
+def _fit_streaming(embedding_chunks, theme_centers, epochs, sample_weight=None):
+    from sklearn.cluster import MiniBatchKMeans
+    from sklearn.decomposition import IncrementalPCA
+
+    n_themes = len(theme_centers)
+    # reassignment_ratio=0: never re-seed a small cluster at random, or it would lose its theme
+    kmeans = MiniBatchKMeans(n_clusters=n_themes, init=theme_centers, n_init=1, reassignment_ratio=0,
+                             random_state=42, batch_size=CLUSTER_CHUNK_SIZE)
+    pca = IncrementalPCA(n_components=2)
+
+    for epoch in range(epochs):
+        offset = 0
+        for chunk in embedding_chunks():
+            weights = None if sample_weight is None else sample_weight[offset:offset + len(chunk)]
+            offset += len(chunk)
+            kmeans.partial_fit(chunk, sample_weight=weights)
+            if epoch == 0 and len(chunk) >= 2:
+                pca.partial_fit(chunk)
+
+    # Final pass: assign labels, project, and accumulate per-theme sums
+    labels, coords = [], []
+    sums = np.zeros_like(np.asarray(theme_centers, dtype=np.float64))
+    counts = np.zeros(n_themes)
+    for chunk in embedding_chunks():
+        chunk_labels = kmeans.predict(chunk)
+        labels.append(chunk_labels)
+        coords.append(pca.transform(chunk))
+        assignments = assignment_matrix(chunk_labels, n_themes)
+        sums += assignments @ chunk
+        counts += assignments.sum(axis=1)
+
+    return {
+        "labels": np.concatenate(labels),
+        "coords": np.concatenate(coords),
+        "word_centroids": sums / np.maximum(counts, 1)[:, None],
+        "centers": kmeans.cluster_centers_,
+        "pca_mean": pca.mean_,
+        "pca_components": pca.components_,
+    }
+
+
+# ------------- Persisted state -------------
+# What a stored result needs to place new codewords without refitting:
+# the theme centres, the 2-D projection basis, and per-theme embedding sums
+# and counts (so the overlap heatmap can be updated incrementally).
+
+def fit_state(fit):
+    centroids = np.asarray(fit["word_centroids"], dtype=np.float64)
+    counts = np.bincount(np.asarray(fit["labels"], dtype=int), minlength=len(centroids)).astype(np.float64)
+    return {
+        "centers": np.asarray(fit["centers"], dtype=np.float32),
+        "pca_mean": np.asarray(fit["pca_mean"], dtype=np.float32),
+        "pca_components": np.asarray(fit["pca_components"], dtype=np.float32),
+        "centroid_sums": centroids * counts[:, None],
+        "counts": counts,
+    }
+
+
+def pack_state(state):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **state)
+    return buffer.getvalue()
+
+
+def unpack_state(blob):
+    with np.load(io.BytesIO(blob)) as data:
+        return {key: data[key] for key in data.files}
+
+
+def nearest_centers(embeddings, centers):
+    # Same rule KMeans uses to assign points: smallest squared Euclidean distance
+    distances = (
+        (embeddings ** 2).sum(axis=1, keepdims=True)
+        - 2 * embeddings @ centers.T
+        + (centers ** 2).sum(axis=1)[None, :]
+    )
+    return distances.argmin(axis=1)
+
+
+def project(embeddings, state):
+    return (embeddings - state["pca_mean"]) @ state["pca_components"].T
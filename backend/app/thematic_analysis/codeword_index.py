@@ -0,0 +1,190 @@
+# ------------- Codeword search index -------------
+# Every approved codeword is embedded once and stored (unit-length float32) in
+# the codeword_vectors table. Each process keeps an in-memory copy of that
+# table as one NumPy matrix, so "codes like X" is a single matrix-vector
+# product. The copy is refreshed incrementally: new rows (higher ids) are
+# appended; if rows were removed, the matrix is reloaded.
+#
+# CODEWORD_INDEX_BACKEND=hnsw switches unfiltered searches to an hnswlib graph
+# (optional dependency); searches filtered by submission always use the exact
+# matrix, since the subset is small.
+
+import os
+import threading
+
+import numpy as np
+
+from app import db
+from app.models import CodewordVector, Feedback, Submission
+from app.thematic_analysis.embeddings import encode, unit_vectors
+from app.thematic_analysis.utils import split_codewords
+
+
+CODEWORD_INDEX_BACKEND = os.getenv('CODEWORD_INDEX_BACKEND', 'exact')  # exact or hnsw
+INSERT_CHUNK = 1000
+CANDIDATE_FACTOR = 20  # rows scored per requested result, before merging duplicates
+
+
+class CodewordIndex:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.row_ids = np.zeros(0, dtype=np.int64)
+        self.submission_ids = np.zeros(0, dtype=np.int64)
+        self.feedback_ids = np.zeros(0, dtype=np.int64)
+        self.texts = []
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self._hnsw = None
+
+    def _append_rows(self, rows):
+        if not rows:
+            return
+        vectors = np.stack([np.frombuffer(r.vector, dtype=np.float32) for r in rows])
+        self.matrix = vectors if self.matrix.size == 0 else np.vstack([self.matrix, vectors])
+        self.row_ids = np.concatenate([self.row_ids, [r.id for r in rows]])
+        self.submission_ids = np.concatenate([self.submission_ids, [r.submission_id for r in rows]])
+        self.feedback_ids = np.concatenate([self.feedback_ids, [r.feedback_id for r in rows]])
+        self.texts.extend(r.text for r in rows)
+        if self._hnsw is not None:
+            if self._hnsw.get_max_elements() < len(self.texts):
+                self._hnsw.resize_index(2 * len(self.texts))
+            self._hnsw.add_items(vectors, np.arange(len(self.texts) - len(rows), len(self.texts)))
+
+    def refresh(self):
+        count, max_id = db.session.query(db.func.count(CodewordVector.id), db.func.max(CodewordVector.id)).one()
+        with self._lock:
+            last_id = int(self.row_ids[-1]) if len(self.row_ids) else 0
+            if (max_id or 0) == last_id and count == len(self.row_ids):
+                return
+            new_rows = CodewordVector.query.filter(CodewordVector.id > last_id).order_by(CodewordVector.id).all()
+            if count != len(self.row_ids) + len(new_rows):
+                # Rows were removed since the last load: start over
+                self._reset()
+                new_rows = CodewordVector.query.order_by(CodewordVector.id).all()
+            self._append_rows(new_rows)
+
+    def _hnsw_index(self):
+        if self._hnsw is None and len(self.texts):
+            import hnswlib
+            index = hnswlib.Index(space='ip', dim=self.matrix.shape[1])
+            index.init_index(max_elements=max(1024, 2 * len(self.texts)), ef_construction=200, M=16)
+            index.add_items(self.matrix, np.arange(len(self.texts)))
+            index.set_ef(100)
+            self._hnsw = index
+        return self._hnsw
+
+    def search(self, query_vector, k=10, submission_ids=None):
+        """
+        Top-k (submission, codeword) pairs most similar to the query, each
+        scored by its closest indexed row.
+        """
+        with self._lock:
+            if not len(self.texts):
+                return []
+            n_candidates = min(len(self.texts), k * CANDIDATE_FACTOR)
+
+            if submission_ids is None and CODEWORD_INDEX_BACKEND == 'hnsw':
+                rows, distances = self._hnsw_index().knn_query(query_vector[None, :], k=n_candidates)
+                rows, scores = rows[0], 1.0 - distances[0]
+            else:
+                rows = np.arange(len(self.texts))
+                if submission_ids is not None:
+                    rows = rows[np.isin(self.submission_ids, list(submission_ids))]
+                scores = self.matrix[rows] @ query_vector
+                if len(rows) > n_candidates:
+                    top = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+                    rows, scores = rows[top], scores[top]
+
+            merged = {}
+            for row, score in zip(rows, scores):
+                key = (int(self.submission_ids[row]), self.texts[row])
+                merged[key] = max(merged.get(key, float('-inf')), float(score))
+
+        ranked = sorted(merged.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [
+            {"submission_id": submission_id, "codeword": text, "score": round(score, 4)}
+            for (submission_id, text), score in ranked
+        ]
+
+
+_index = CodewordIndex()
+
+
+def index_feedback(feedbacks):
+    """
+    (Re)index the codewords of the given Feedback rows. Call after their
+    codewords are committed; old entries for these rows are replaced.
+    """
+    feedbacks = [fb for fb in feedbacks if fb is not None]
+    if not feedbacks:
+        return 0
+
+    CodewordVector.query.filter(
+        CodewordVector.feedback_id.in_([fb.id for fb in feedbacks])
+    ).delete(synchronize_session=False)
+
+    # Keyed by the same normalized form as the codewords table
+    entries = [(fb, word) for fb in feedbacks for _, word in split_codewords(fb.codewords)]
+    if entries:
+        vectors = unit_vectors(encode([word for _, word in entries]))
+        for start in range(0, len(entries), INSERT_CHUNK):
+            db.session.add_all([
+                CodewordVector(feedback_id=fb.id, submission_id=fb.submission_id, text=word[:255],
+                               vector=vector.tobytes())
+                for (fb, word), vector in zip(entries[start:start + INSERT_CHUNK], vectors[start:start + INSERT_CHUNK])
+            ])
+            db.session.flush()
+    db.session.commit()
+    return len(entries)
+
+
+def rebuild_index(chunk_size=1000):
+    # Index every approved feedback row from scratch (backfill for existing data)
+    CodewordVector.query.delete()
+    db.session.commit()
+    total = 0
+    last_id = 0
+    while True:
+        feedbacks = (Feedback.query
+                     .filter(Feedback.approved.is_(True), Feedback.id > last_id)
+                     .order_by(Feedback.id)
+                     .limit(chunk_size)
+                     .all())
+        if not feedbacks:
+            return total
+        total += index_feedback(feedbacks)
+        last_id = feedbacks[-1].id
+
+
+def feedback_counts(pairs):
+    # {(submission id, codeword): indexed feedback rows carrying it}, counted in the database
+    if not pairs:
+        return {}
+    rows = (db.session.query(CodewordVector.submission_id, CodewordVector.text,
+                             db.func.count(db.func.distinct(CodewordVector.feedback_id)))
+            .filter(db.or_(*[db.and_(CodewordVector.submission_id == submission_id, CodewordVector.text == text)
+                             for submission_id, text in pairs]))
+            .group_by(CodewordVector.submission_id, CodewordVector.text)
+            .all())
+    return {(submission_id, text): count for submission_id, text, count in rows}
+
+
+def search_similar(query, k=10, submission_ids=None):
+    _index.refresh()
+    query_vector = unit_vectors(encode([query]))[0]
+    db.session.commit()  # keep the query's embedding in the cache
+    results = _index.search(query_vector, k=k, submission_ids=submission_ids)
+
+    # Counted over every row of the submission, not just the rows scored as candidates
+    counts = feedback_counts([(r["submission_id"], r["codeword"]) for r in results])
+    for result in results:
+        result["feedback_count"] = counts.get((result["submission_id"], result["codeword"]), 0)
+
+    public_ids = dict(Submission.query.with_entities(Submission.id, Submission.public_id)
+                      .filter(Submission.id.in_({r["submission_id"] for r in results})))
+    for result in results:
+        result["submission_id"] = public_ids.get(result["submission_id"])
+    return results
@@ -1,269 +1,149 @@
-from sentence_transformers import SentenceTransformer
-from sklearn.cluster import KMeans
 from collections import defaultdict
 import numpy as np
-from wordcloud import WordCloud
 
-import matplotlib.patches as mpatches
-from matplotlib.patches import Ellipse
+from app import metrics
+from app.thematic_analysis.embeddings import encode
+from app.thematic_analysis.canonical import canonicalize
+from app.thematic_analysis.clustering import (
+    CLUSTER_CHUNK_SIZE, assignment_matrix, choose_backend, cosine_matrix, fit_exact, fit_streaming, fit_state,
+    group_centroids, nearest_centers, project
+)
 
-def draw_cluster_ellipse(ax, x, y, color):
-    cov = np.cov(x, y)
-    eigenvals, eigenvecs = np.linalg.eigh(cov)
-    order = eigenvals.argsort()[::-1]
-    eigenvals, eigenvecs = eigenvals[order], eigenvecs[:, order]
 
-    angle = np.degrees(np.arctan2(*eigenvecs[:, 0][::-1]))
-    width, height = 2 * np.sqrt(eigenvals)  # scale for visualization
-    ellipse = Ellipse(
-        (np.mean(x), np.mean(y)),
-        width * 2, height * 2,
-        angle=angle,
-        edgecolor=color,
-        facecolor=color,
-        alpha=0.15,
-        lw=2
-    )
-    ax.add_patch(ellipse)
+def embedding_chunks(words_list, chunk_size=None):
+    # Encode lazily, one chunk at a time; repeated passes are served by the embedding cache
+    chunk_size = chunk_size or CLUSTER_CHUNK_SIZE
+    for start in range(0, len(words_list), chunk_size):
+        yield encode(words_list[start:start + chunk_size])
 
 
-def define_themes(words_list, theme_seeds):
-    np.random.shuffle(words_list)
-    model = SentenceTransformer('all-MiniLM-L6-v2')
-    word_embeddings = model.encode(words_list)
-
-    theme_centers = []
-    theme_labels = list(theme_seeds.keys())
-
-    for theme in theme_labels:
-        seed_embeddings = model.encode(theme_seeds[theme])
-        center = np.mean(seed_embeddings, axis=0)
-        theme_centers.append(center)
-
-    theme_centers = np.array(theme_centers)
-    kmeans = KMeans(n_clusters=len(theme_labels), init=theme_centers, n_init=1, random_state=42)
-    kmeans.fit(word_embeddings)
-
-    clusters = kmeans.labels_
-    clustered_words = defaultdict(list)
-    for word, cluster_id in zip(words_list, clusters):
-        clustered_words[theme_labels[cluster_id]].append(word)
-
-    # Generate all 3 plots
-    scatter_plot = generate_scatterplot(words_list, word_embeddings, clusters, theme_labels)
-    bar_chart = generate_bar_chart(clustered_words)
-    word_cloud = generate_wordcloud(clustered_words)
-
-
-    return dict(clustered_words), scatter_plot, bar_chart, word_cloud
-
-
-# ------------- Plot Creation -------------
-from sklearn.decomposition import PCA
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import seaborn as sns
-import pandas as pd
-import io
-import base64
-
-
-theme_colors = sns.color_palette("Set2", n_colors=10).as_hex()
-
-
-def generate_scatterplot(words_list, word_embeddings, clusters, theme_labels):
-    # Reduce dimensions with PCA
-    pca = PCA(n_components=2)
-    reduced_embeddings = pca.fit_transform(word_embeddings)
-
-    # Create DataFrame
-    df = pd.DataFrame({
-        'X': reduced_embeddings[:, 0],
-        'Y': reduced_embeddings[:, 1],
-        'Theme': [theme_labels[cluster] for cluster in clusters],
-        'Word': words_list,
-
-    })
-
-    # Generate color palette
-    unique_themes = list(dict.fromkeys(theme_labels))
-    colors = plt.cm.viridis(np.linspace(0.2, 0.9, len(unique_themes)))
-    theme_palette = dict(zip(unique_themes, colors))
-
-    # Plot
-    plt.figure(figsize=(24, 15))
-
-    # Scatter plot points by theme
-    for theme, color in theme_palette.items():
-        subset = df[df['Theme'] == theme]
-        plt.scatter(subset['X'], subset['Y'], s=220, color=color, alpha=0.8, label=theme, edgecolors='none')
-        draw_cluster_ellipse(plt.gca(), subset['X'], subset['Y'], color)
-
-
-    if len(words_list) <= 20:
-        for i, row in df.iterrows():
-            plt.text(row['X'] + 0.02, row['Y'] + 0.02, row['Word'],
-                     fontsize=24, ha='left', va='bottom')
-
-    # Styling
-    # plt.title('Semantic Clustering of Words by Theme', fontsize=44, fontweight='bold', pad=20)
-    plt.xlabel('PCA Component 1', fontsize=38, labelpad=10)
-    plt.ylabel('PCA Component 2', fontsize=38, labelpad=10)
-    plt.xticks(fontsize=32)
-    plt.yticks(fontsize=32)
-
-    # Minimalist grid and remove top/right borders
-    plt.grid(linestyle='--', linewidth=0.6, alpha=0.4)
-    plt.gca().spines['top'].set_visible(False)
-    plt.gca().spines['right'].set_visible(False)
-
-    # Legend outside
-    plt.legend(
-    title='Theme',
-    title_fontsize=32,   # Larger title
-    fontsize=28,         # Larger labels
-    bbox_to_anchor=(1.05, 1),
-    loc='upper left',
-    borderaxespad=0.,
-    markerscale=2.0,     # Bigger legend markers
-    handlelength=4
-    )       # Extra spacing between marker and text
-
-
-    plt.tight_layout()
-
-    # Save to base64
-    buffer = io.BytesIO()
-    plt.savefig(buffer, format='png', bbox_inches="tight", dpi=200)
-    buffer.seek(0)
-    plt.close()
-
-    return f"data:image/png;base64,{base64.b64encode(buffer.read()).decode('utf-8')}"
-
+def cluster_codewords(codeword_counts, theme_seeds, backend=None, theme_centers=None):
+    """
+    Merge near-synonymous codes of {codeword: occurrences} (see canonical.py)
+    and cluster the canonical codes, weighted by how often they occur.
+    theme_centers are precomputed seed centroids (e.g. from a theme set).
+    """
+    # Streaming fits never hold every embedding at once, and neither does canonicalization there
+    streaming = choose_backend(len(codeword_counts), backend) == 'streaming'
+    words, counts, aliases = canonicalize(codeword_counts, streaming=streaming)
+    if len(words) < max(2, len(theme_seeds)):
+        # Too few codes left for PCA and one cluster per theme; cluster them as they are
+        words, counts, aliases = list(codeword_counts), list(codeword_counts.values()), {}
+    clustered, plot_data, state = define_themes(words, theme_seeds, backend, counts=counts,
+                                                theme_centers=theme_centers)
+    plot_data["aliases"] = aliases
+    return clustered, plot_data, state
 
-def generate_bar_chart(clustered_words):
-    # Count and sort frequencies
-    theme_counts = {theme: len(words) for theme, words in clustered_words.items()}
-    sorted_themes = sorted(theme_counts.items(), key=lambda x: x[1], reverse=True)
-    themes, counts = zip(*sorted_themes)
 
-    # Use a clean, modern color palette
-    colors = plt.cm.viridis(np.linspace(0.2, 0.8, len(themes)))
+def _seed_lists(theme_seeds):
+    # A theme without seeds falls back to its own name as the seed
+    seed_lists = [list(theme_seeds[theme]) or [theme] for theme in theme_seeds]
+    all_seeds = [seed for seeds in seed_lists for seed in seeds]
+    seed_owner = np.repeat(np.arange(len(seed_lists)), [len(seeds) for seeds in seed_lists])
+    return all_seeds, seed_owner
 
-    # Create figure
-    plt.figure(figsize=(24, 15))
-    bars = plt.bar(themes, counts, color=colors, edgecolor='none')
 
-    # Add value labels above bars
-    for bar in bars:
-        height = bar.get_height()
-        plt.text(bar.get_x() + bar.get_width()/2, height + 0.3,
-                 f"{int(height)}", ha='center', va='bottom',
-                 fontsize=20, fontweight='bold', color='#333333')
+def seed_centroids(theme_seeds):
+    # One mean seed embedding per theme, in theme order
+    all_seeds, seed_owner = _seed_lists(theme_seeds)
+    return group_centroids(encode(all_seeds), seed_owner, len(theme_seeds))
 
-    # Minimalist grid
-    plt.grid(axis='y', linestyle='--', linewidth=0.6, alpha=0.4)
-    plt.gca().spines['top'].set_visible(False)
-    plt.gca().spines['right'].set_visible(False)
-    plt.gca().spines['left'].set_visible(False)
 
-    # Labels and title
-    plt.ylabel("Frequency", fontsize=30, labelpad=15)
-    # plt.title("Theme Frequency", fontsize=38, pad=20, fontweight='bold')
-    plt.xticks(rotation=25, ha='right', fontsize=36)
-    plt.yticks(fontsize=32)
+def define_themes(words_list, theme_seeds, backend=None, counts=None, theme_centers=None):
+    """
+    Cluster codewords around the themes' seeds. With theme_centers (one
+    precomputed seed centroid per theme, in theme order) the seeds are not
+    encoded at all.
+    """
+    with metrics.span('define_themes'):
+        return _define_themes(words_list, theme_seeds, backend, counts, theme_centers)
 
-    # Legend (outside, minimalistic)
-    handles = [plt.Rectangle((0,0),1,1,color=colors[i]) for i in range(len(themes))]
-    plt.legend(
-    handles,
-    themes,
-    title="Themes",
-    title_fontsize=30,   # Bigger title font
-    fontsize=24,         # Bigger legend text
-    bbox_to_anchor=(1.08, 1),  # Slightly push further out
-    loc='upper left',
-    borderaxespad=0.5,   # Add some padding
-    labelspacing=1.2     # More space between legend items
-    )
 
-    plt.tight_layout()
+def _define_themes(words_list, theme_seeds, backend=None, counts=None, theme_centers=None):
+    # Shuffled (with their counts) so the input order doesn't bias K-means
+    order = np.random.permutation(len(words_list))
+    words_list = [words_list[i] for i in order]
+    sample_weight = None if counts is None else np.asarray(counts, dtype=np.float64)[order]
+    theme_labels = list(theme_seeds.keys())
 
-    # Save to base64
-    buffer = io.BytesIO()
-    plt.savefig(buffer, format='png', bbox_inches="tight")
-    buffer.seek(0)
-    plt.close()
+    if choose_backend(len(words_list), backend) == 'exact':
+        if theme_centers is None:
+            # Encode codewords and every theme's seeds in one batched call
+            all_seeds, seed_owner = _seed_lists(theme_seeds)
+            embeddings = encode(list(words_list) + all_seeds)
+            word_embeddings = embeddings[:len(words_list)]
+            theme_centers = group_centroids(embeddings[len(words_list):], seed_owner, len(theme_labels))
+        else:
+            word_embeddings = encode(words_list)
+        fit = fit_exact(word_embeddings, theme_centers, sample_weight)
+    else:
+        # Too many codewords for one matrix: stream them through the mini-batch backend
+        if theme_centers is None:
+            theme_centers = seed_centroids(theme_seeds)
+        fit = fit_streaming(lambda: embedding_chunks(words_list), theme_centers, sample_weight=sample_weight)
+
+    clusters = fit["labels"]
+    clustered_words = defaultdict(list)
+    for word, cluster_id in zip(words_list, clusters):
+        clustered_words[theme_labels[cluster_id]].append(word)
 
-    return f"data:image/png;base64,{base64.b64encode(buffer.read()).decode('utf-8')}"
+    # Theme overlap from the same embedding matrix: cosine of per-theme mean codeword vectors
+    populated = [i for i in range(len(theme_labels)) if theme_labels[i] in clustered_words]
+    similarity_matrix = cosine_matrix(fit["word_centroids"][populated])
+    reduced_embeddings = fit["coords"]
+
+    # Everything the 3 plots need; they are rendered later, on first request
+    plot_data = {
+        "words": list(words_list),
+        "labels": [int(c) for c in clusters],
+        "themes": theme_labels,
+        "coords": np.round(reduced_embeddings, 5).tolist(),
+        "overlap_themes": [theme_labels[i] for i in populated],
+        "overlap": np.round(similarity_matrix, 5).tolist(),
+    }
+    if sample_weight is not None:
+        plot_data["counts"] = sample_weight.astype(int).tolist()
 
+    return dict(clustered_words), plot_data, fit_state(fit)
 
 
-def generate_wordcloud(clustered_words):
+def assign_to_themes(words_list, plot_data, state, counts=None):
     """
-    Generate a heatmap showing overlap (cosine similarity) between themes.
-    Replaces the word cloud for better analytical insight.
+    Place new codewords into an existing clustering without refitting: nearest
+    stored centre for the theme, stored PCA basis for the scatter position.
+    Updates plot_data and state in place and returns {theme: [new words]}.
     """
-    # Themes
-    themes = list(clustered_words.keys())
-
-    # If less than 2 themes, return empty plot
-    if len(themes) < 2:
-        plt.figure(figsize=(24, 15))
-        plt.text(0.5, 0.5, "Not enough themes for overlap matrix",
-                 ha='center', va='center', fontsize=26, color='#666666')
-        plt.axis('off')
-        buffer = io.BytesIO()
-        plt.savefig(buffer, format='png', dpi=200, transparent=True)
-        buffer.seek(0)
-        plt.close()
-        return f"data:image/png;base64,{base64.b64encode(buffer.read()).decode('utf-8')}"
+    with metrics.span('assign_to_themes'):
+        return _assign_to_themes(words_list, plot_data, state, counts)
 
-    # Use SentenceTransformer to encode each theme's words
-    model = SentenceTransformer('all-MiniLM-L6-v2')
-
-    # Create embeddings per theme (average of its words)
-    theme_embeddings = []
-    for theme in themes:
-        words = clustered_words[theme]
-        if words:
-            emb = model.encode(words)
-            avg_emb = np.mean(emb, axis=0)
-        else:
-            avg_emb = np.zeros(model.get_sentence_embedding_dimension())
-        theme_embeddings.append(avg_emb)
 
-    # Compute cosine similarity matrix
-    from sklearn.metrics.pairwise import cosine_similarity
-    similarity_matrix = cosine_similarity(theme_embeddings)
+def _assign_to_themes(words_list, plot_data, state, counts=None):
+    theme_labels = plot_data["themes"]
+    embeddings = encode(words_list).astype(np.float64)
+    labels = nearest_centers(embeddings, state["centers"].astype(np.float64))
+    coords = project(embeddings, state)
 
-    # Plot heatmap
-    plt.figure(figsize=(24, 15))
-    sns.heatmap(
-        similarity_matrix,
-        xticklabels=themes,
-        yticklabels=themes,
-        cmap="coolwarm",
-        annot=True,
-        fmt=".2f",
-        square=True,
-        annot_kws={"size": 32, "weight": "bold"},
-        cbar_kws={"shrink": 0.7}
-    )
+    # Running per-theme sums keep the overlap heatmap exact without the old embeddings
+    assignments = assignment_matrix(labels, len(theme_labels)).astype(np.float64)
+    state["centroid_sums"] = state["centroid_sums"] + assignments @ embeddings
+    state["counts"] = state["counts"] + assignments.sum(axis=1)
 
-    plt.xticks(rotation=30, ha='right', fontsize=38, weight='bold')
-    plt.yticks(rotation=0, fontsize=38, weight='bold')
+    populated = [i for i in range(len(theme_labels)) if state["counts"][i] > 0]
+    centroids = state["centroid_sums"] / np.maximum(state["counts"], 1)[:, None]
 
-    plt.tight_layout()
+    plot_data["words"] = plot_data["words"] + list(words_list)
+    plot_data["labels"] = plot_data["labels"] + [int(c) for c in labels]
+    plot_data["coords"] = plot_data["coords"] + np.round(coords, 5).tolist()
+    if "counts" in plot_data:
+        plot_data["counts"] = plot_data["counts"] + [int(c) for c in (counts or [1] * len(words_list))]
+    plot_data["overlap_themes"] = [theme_labels[i] for i in populated]
+    plot_data["overlap"] = np.round(cosine_matrix(centroids[populated]), 5).tolist()
 
-    # Save to base64
-    buffer = io.BytesIO()
-    plt.savefig(buffer, format='png', dpi=200, bbox_inches="tight", transparent=True)
-    buffer.seek(0)
-    plt.close()
+    added = defaultdict(list)
+    for word, cluster_id in zip(words_list, labels):
+        added[theme_labels[cluster_id]].append(word)
+    return dict(added)
 
-    return f"data:image/png;base64,{base64.b64encode(buffer.read()).decode('utf-8')}"
 
 # run a test if __name__ == "__main__":
 if __name__ == "__main__":
@@ -281,7 +161,7 @@ if __name__ == "__main__":
         "Negative": ["improved", "not expected"]
     }
 
-    results = define_themes(feedback_list, theme_seeds)
+    results = define_themes(feedback_list, theme_seeds)[:2]
     print("-----------------------------------------")
     print(results)
     print("-----------------------------------------")
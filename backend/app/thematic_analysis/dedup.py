@@ -0,0 +1,153 @@
+# ------------- Duplicate feedback -------------
+# Survey exports repeat themselves ("Good", "good.", "The labs were great!!").
+# Before coding, responses are grouped so only one representative per group is
+# sent to the LLM and its codewords are copied to the rest.
+#
+# By default only exact duplicates are grouped: responses that are equal
+# apart from case and whitespace. DEDUP_MODE=near also groups near duplicates,
+# found with MinHash over character shingles (punctuation ignored): LSH
+# buckets propose candidates and the true Jaccard similarity of the shingle
+# sets decides. A response only joins a group when it is close to the group's
+# representative itself, so groups don't drift through chains of small edits.
+#
+# Character similarity can't see meaning: "I liked the labs" and "I disliked
+# the labs" share most shingles. Near duplicates are therefore never merged
+# when their words differ by a negation or an antonym.
+
+import hashlib
+import os
+import re
+import zlib
+from collections import Counter
+
+import numpy as np
+
+from app.thematic_analysis.embeddings import normalize_text
+
+
+DEDUP_MODE = os.getenv('DEDUP_MODE', 'exact')  # off, exact or near
+DEDUP_THRESHOLD = float(os.getenv('DEDUP_THRESHOLD', '0.85'))  # Jaccard similarity of shingle sets for near duplicates
+
+SHINGLE_SIZE = 4
+NUM_PERM = 64
+BANDS = 16  # 4 rows per band: pairs above ~0.5 similarity almost always share a bucket
+BUCKET_MAX = 32  # representatives kept per bucket, so templated answers don't make it quadratic
+MAX_CANDIDATES = 8  # representatives compared exactly, those sharing the most buckets first
+_PRIME = (1 << 31) - 1
+
+_rng = np.random.default_rng(20240501)
+_A = _rng.integers(1, _PRIME, size=NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, _PRIME, size=NUM_PERM, dtype=np.uint64)
+
+_PUNCTUATION = re.compile(r'[^\w\s]+')
+
+# Words whose presence on one side only flips the meaning ("didn't" splits into "didn t")
+NEGATIONS = frozenset((
+    "not", "no", "never", "nor", "neither", "none", "nothing", "nobody", "without", "t",
+    "cannot", "cant", "dont", "didnt", "doesnt", "isnt", "wasnt", "werent", "arent", "wont",
+    "wouldnt", "shouldnt", "couldnt", "hardly", "barely", "lacking", "lacked",
+))
+NEGATING_PREFIXES = ("un", "dis", "in", "im", "ir", "il", "non", "mis")
+ANTONYMS = frozenset(frozenset(pair) for pair in (
+    ("good", "bad"), ("great", "terrible"), ("great", "awful"), ("better", "worse"), ("best", "worst"),
+    ("like", "hate"), ("liked", "hated"), ("love", "hate"), ("loved", "hated"), ("enjoyed", "hated"),
+    ("easy", "hard"), ("easy", "difficult"), ("clear", "confusing"), ("fast", "slow"),
+    ("more", "less"), ("too", "enough"), ("high", "low"), ("positive", "negative"),
+    ("interesting", "boring"), ("engaging", "boring"), ("always", "never"), ("agree", "disagree"),
+))
+
+
+def normalize_feedback(text):
+    # "  The labs were GREAT!! " -> "the labs were great"
+    return ' '.join(_PUNCTUATION.sub(' ', str(text).lower()).split())
+
+
+def _opposite(a, b):
+    # "helpful"/"unhelpful", "useful"/"useless", "good"/"bad"
+    if frozenset((a, b)) in ANTONYMS:
+        return True
+    for word, other in ((a, b), (b, a)):
+        if any(other == prefix + word for prefix in NEGATING_PREFIXES):
+            return True
+        if word.endswith('ful') and other == word[:-3] + 'less':
+            return True
+    return False
+
+
+def contradicts(words_a, words_b):
+    """
+    True when two responses' word sets differ by a negation or by a pair of
+    opposite words, i.e. they may say opposite things.
+    """
+    only_a, only_b = words_a - words_b, words_b - words_a
+    if (only_a | only_b) & NEGATIONS:
+        return True
+    return any(_opposite(a, b) for a in only_a for b in only_b)
+
+
+def _shingles(normalized):
+    if len(normalized) <= SHINGLE_SIZE:
+        return {zlib.crc32(normalized.encode('utf-8'))}
+    return {zlib.crc32(normalized[i:i + SHINGLE_SIZE].encode('utf-8'))
+            for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+
+def _signature(shingles):
+    hashes = np.fromiter(shingles, dtype=np.uint64, count=len(shingles)) % _PRIME
+    return ((_A[:, None] * hashes[None, :] + _B[:, None]) % _PRIME).min(axis=1)
+
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b)
+
+
+def find_duplicates(texts, mode=None, threshold=None):
+    """
+    Group duplicate responses. Returns one index per text: the position of its
+    group's representative (the first response of the group), or its own
+    position when it is unique or represents a group.
+    """
+    mode = mode or DEDUP_MODE
+    threshold = DEDUP_THRESHOLD if threshold is None else threshold
+    representatives = list(range(len(texts)))
+    if mode == 'off':
+        return representatives
+
+    near = mode == 'near'
+    by_hash = {}
+    buckets = {}
+    rep_shingles = {}
+    rep_words = {}
+    for i, text in enumerate(texts):
+        normalized = normalize_feedback(text) if near else normalize_text(text)
+        key = hashlib.sha1(normalized.encode('utf-8')).digest()
+        if key in by_hash:
+            representatives[i] = by_hash[key]
+            continue
+        by_hash[key] = i
+        if not near or not normalized:
+            continue
+
+        shingles = _shingles(normalized)
+        words = frozenset(normalized.split())
+        bands = _signature(shingles).reshape(BANDS, -1)
+        band_keys = [(b, band.tobytes()) for b, band in enumerate(bands)]
+
+        candidates = Counter(rep for band_key in band_keys for rep in buckets.get(band_key, ()))
+        best, best_score = None, 0.0
+        for rep, _ in candidates.most_common(MAX_CANDIDATES):
+            score = _jaccard(shingles, rep_shingles[rep])
+            if score >= threshold and score > best_score and not contradicts(words, rep_words[rep]):
+                best, best_score = rep, score
+        if best is not None:
+            representatives[i] = best
+            by_hash[key] = best
+            continue
+
+        rep_shingles[i] = shingles
+        rep_words[i] = words
+        for band_key in band_keys:
+            bucket = buckets.setdefault(band_key, [])
+            if len(bucket) < BUCKET_MAX:
+                bucket.append(i)
+    return representatives
@@ -0,0 +1,316 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from app import metrics
+
+
+DEFAULT_MODEL = os.getenv('EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+DEFAULT_DEVICE = os.getenv('EMBEDDING_DEVICE') or None  # None lets torch pick
+LRU_SIZE = int(os.getenv('EMBEDDING_LRU_SIZE', '50000'))
+
+# torch, onnx (ONNX Runtime, needs pip install "sentence-transformers[onnx]") or
+# quantized (torch with its Linear layers dynamically quantized to int8)
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch')
+EMBEDDING_ONNX_FILE = os.getenv('EMBEDDING_ONNX_FILE') or None  # e.g. onnx/model_qint8_avx512_vnni.onnx from the model repo
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', '64'))
+EMBEDDING_THREADS = int(os.getenv('EMBEDDING_THREADS', '0'))  # intra-op threads for torch / ONNX Runtime, 0 = library default
+BACKENDS = ('torch', 'onnx', 'quantized')
+
+
+# ------------- Shared model registry -------------
+# One SentenceTransformer per (model name, device, backend) for the whole
+# process. Loading the model takes seconds and a few hundred MB, so every
+# encoder in the pipeline goes through get_model() instead of building its own.
+# sentence_transformers (and torch) are only imported on the first load.
+
+_models = {}
+_load_times = {}
+_registry_lock = threading.Lock()
+
+
+def load_model(name, device=None, backend=None):
+    # Build a SentenceTransformer for one of BACKENDS; the ONNX and int8 variants only run on CPU
+    backend = backend or EMBEDDING_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    from sentence_transformers import SentenceTransformer
+
+    if backend == 'onnx':
+        model_kwargs = {"provider": "CPUExecutionProvider"}
+        if EMBEDDING_ONNX_FILE:
+            model_kwargs["file_name"] = EMBEDDING_ONNX_FILE
+        if EMBEDDING_THREADS:
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = EMBEDDING_THREADS
+            model_kwargs["session_options"] = options
+        return SentenceTransformer(name, device='cpu', backend='onnx', model_kwargs=model_kwargs)
+
+    if EMBEDDING_THREADS:
+        import torch
+        torch.set_num_threads(EMBEDDING_THREADS)
+    if backend == 'quantized':
+        import torch
+        model = SentenceTransformer(name, device='cpu')
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return SentenceTransformer(name, device=device)
+
+
+def get_model(name=None, device=None, backend=None):
+    name = name or DEFAULT_MODEL
+    device = device or DEFAULT_DEVICE
+    backend = backend or EMBEDDING_BACKEND
+    key = (name, device, backend)
+
+    model = _models.get(key)
+    if model is not None:
+        return model
+
+    with _registry_lock:
+        # Another thread may have loaded it while we waited for the lock
+        model = _models.get(key)
+        if model is None:
+            start = time.perf_counter()
+            with metrics.span('model_load'):
+                model = load_model(name, device, backend)
+            _load_times[key] = time.perf_counter() - start
+            _models[key] = model
+    return model
+
+
+def register_model(model, name=None, device=None, backend=None):
+    # Install a ready-made encoder (anything with .encode(texts)), e.g. a stub for offline benchmarks
+    with _registry_lock:
+        key = (name or DEFAULT_MODEL, device or DEFAULT_DEVICE, backend or EMBEDDING_BACKEND)
+        _models[key] = model
+        _load_times[key] = 0.0
+    return model
+
+
+def embedding_space(model_name, backend=None):
+    """
+    Name the cached vectors are stored under. torch and plain ONNX produce the
+    same fp32 vectors and share a cache; int8 models get their own.
+    """
+    backend = backend or EMBEDDING_BACKEND
+    if backend == 'quantized':
+        return f"{model_name}@int8"
+    if backend == 'onnx' and EMBEDDING_ONNX_FILE:
+        return f"{model_name}@{EMBEDDING_ONNX_FILE}"
+    return model_name
+
+
+def warm_up(name=None, device=None):
+    model = get_model(name, device)
+    # First encode call initializes tokenizer/kernels, so pay that here too
+    model.encode(['warm up'])
+    return model
+
+
+# ------------- Embedding cache -------------
+# encode() looks texts up in a bounded in-memory LRU, then in the
+# embedding_cache table, and only runs the model for what is left. Keys are
+# (embedding space, sha256 of the normalized text), so re-clustering an
+# unchanged submission does no inference at all.
+
+_lru = OrderedDict()
+_lru_lock = threading.Lock()
+_cache_counts = {"lru_hits": 0, "db_hits": 0, "encoded": 0}
+
+DB_LOOKUP_CHUNK = 500
+
+
+def normalize_text(text):
+    # all-MiniLM-L6-v2 is uncased, so lowercasing does not change the vector
+    return ' '.join(str(text).lower().split())
+
+
+def _text_hash(normalized):
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def _lru_get(key):
+    with _lru_lock:
+        vector = _lru.get(key)
+        if vector is not None:
+            _lru.move_to_end(key)
+        return vector
+
+
+def _lru_put(key, vector):
+    with _lru_lock:
+        _lru[key] = vector
+        _lru.move_to_end(key)
+        while len(_lru) > LRU_SIZE:
+            _lru.popitem(last=False)
+
+
+def _db_available():
+    from flask import has_app_context
+    return has_app_context()
+
+
+def _db_lookup(model_name, hashes):
+    from app.models import EmbeddingCache
+
+    found = {}
+    for start in range(0, len(hashes), DB_LOOKUP_CHUNK):
+        chunk = hashes[start:start + DB_LOOKUP_CHUNK]
+        rows = EmbeddingCache.query.with_entities(
+            EmbeddingCache.text_hash, EmbeddingCache.vector
+        ).filter(
+            EmbeddingCache.model_name == model_name,
+            EmbeddingCache.text_hash.in_(chunk)
+        ).all()
+        for text_hash, vector in rows:
+            found[text_hash] = np.frombuffer(vector, dtype=np.float32)
+    return found
+
+
+def _db_store(model_name, entries):
+    from app import db
+    from app.models import EmbeddingCache
+    from sqlalchemy.exc import IntegrityError
+
+    # A savepoint inside the caller's transaction: the rows are committed with the
+    # caller's work, and a failed insert never rolls back anything but the cache
+    try:
+        with db.session.begin_nested():
+            db.session.add_all([
+                EmbeddingCache(
+                    model_name=model_name,
+                    text_hash=text_hash,
+                    text=text,
+                    dim=vector.shape[0],
+                    vector=vector.astype(np.float32).tobytes()
+                )
+                for text_hash, text, vector in entries
+            ])
+    except IntegrityError:
+        # A concurrent request cached the same text first; its vector is identical
+        pass
+
+
+def encode(texts, model_name=None, device=None):
+    """
+    Encode texts with the shared model, going through the embedding cache.
+    Returns a float32 array with one row per input text, in input order.
+    """
+    with metrics.span('encode'):
+        return _encode(texts, model_name, device)
+
+
+def _encode(texts, model_name=None, device=None):
+    model_name = model_name or DEFAULT_MODEL
+    space = embedding_space(model_name)
+    normalized = [normalize_text(t) for t in texts]
+    if not normalized:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    hashes = {}
+    vectors = {}
+    for text in normalized:
+        if text in hashes:
+            continue
+        text_hash = _text_hash(text)
+        hashes[text] = text_hash
+        vector = _lru_get((space, text_hash))
+        if vector is not None:
+            vectors[text] = vector
+            _cache_counts["lru_hits"] += 1
+            metrics.inc('embedding_cache_hits_total', level='lru')
+
+    missing = [t for t in hashes if t not in vectors]
+    use_db = _db_available()
+
+    if missing and use_db:
+        found = _db_lookup(space, [hashes[t] for t in missing])
+        for text in missing:
+            vector = found.get(hashes[text])
+            if vector is not None:
+                vectors[text] = vector
+                _lru_put((space, hashes[text]), vector)
+                _cache_counts["db_hits"] += 1
+                metrics.inc('embedding_cache_hits_total', level='db')
+        missing = [t for t in missing if t not in vectors]
+
+    if missing:
+        model = get_model(model_name, device)
+        # One call for every miss: SentenceTransformer sorts its inputs by length
+        # before batching, so each batch pads to similar lengths
+        with metrics.span('encode_model'):
+            encoded = model.encode(missing, batch_size=EMBEDDING_BATCH_SIZE, convert_to_numpy=True)
+        encoded = np.asarray(encoded, dtype=np.float32)
+        _cache_counts["encoded"] += len(missing)
+        metrics.inc('embeddings_encoded_total', len(missing))
+        for text, vector in zip(missing, encoded):
+            vectors[text] = vector
+            _lru_put((space, hashes[text]), vector)
+        if use_db:
+            _db_store(space, [(hashes[t], t, vectors[t]) for t in missing])
+
+    return np.stack([vectors[t] for t in normalized])
+
+
+def unit_vectors(vectors):
+    # Rows scaled to unit length (float32), so dot products are cosine similarities; zero rows stay zero
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def clear_memory_cache():
+    with _lru_lock:
+        _lru.clear()
+
+
+def cache_stats():
+    with _lru_lock:
+        size = len(_lru)
+    return dict(_cache_counts, lru_size=size, lru_capacity=LRU_SIZE)
+
+
+def _resident_memory_bytes():
+    # Current RSS from /proc on Linux, falling back to the peak RSS elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is bytes on macOS and kilobytes on Linux
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except (ImportError, OSError):
+        return None
+
+
+def _device_name(model, device):
+    # Encoders installed with register_model only promise .encode(); use the device they were registered for
+    device = getattr(model, "device", device)
+    return None if device is None else str(device)
+
+
+def model_stats():
+    return {
+        "models": [
+            {
+                "name": name,
+                "device": _device_name(model, device),
+                "backend": backend,
+                "load_time_s": round(_load_times.get((name, device, backend), 0.0), 3),
+            }
+            for (name, device, backend), model in list(_models.items())
+        ],
+        "embedding_cache": cache_stats(),
+        "resident_memory_bytes": _resident_memory_bytes(),
+        "pid": os.getpid(),
+    }
@@ -0,0 +1,236 @@
+import hashlib
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func
+
+from app import metrics
+from app.thematic_analysis.embeddings import normalize_text
+
+
+# ------------- LLM response cache -------------
+# Survey exports repeat the same answers ("n/a", "good class", pasted text), so
+# OpenAI replies are cached in the llm_cache table keyed by model, a hash of the
+# prompt template and the normalized input. Changing a prompt changes its hash,
+# which retires the old entries without a manual flush.
+#
+# Writes happen in a savepoint of the caller's session and are committed with
+# the caller's work; the cache never commits or rolls back on its own. Lookups
+# don't write at all: hits are tallied in memory and written (with
+# last_used_at, which drives eviction) by the next store or evict.
+
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(30 * 24 * 3600)))  # seconds
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "100000"))
+EVICT_EVERY = 100  # check the table size once per this many stores
+
+LOOKUP_CHUNK = 500
+
+_counts = {"hits": 0, "misses": 0, "bypassed": 0, "stored": 0, "evicted": 0}
+_counts_lock = threading.Lock()
+_touched = {}  # {entry id: hits since the last write}
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]
+
+
+def cache_key(model_name, prompt_version, text):
+    raw = f"{model_name}\n{prompt_version}\n{normalize_text(text)}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _count(name, n=1):
+    with _counts_lock:
+        _counts[name] += n
+    metrics.inc(f'llm_cache_{name}_total', n)
+
+
+def _enabled():
+    from flask import has_app_context
+    return has_app_context()
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _is_fresh(entry):
+    created = entry.created_at
+    if created is None:
+        return True
+    if created.tzinfo is None:  # SQLite drops the timezone
+        created = created.replace(tzinfo=timezone.utc)
+    return _now() - created <= timedelta(seconds=LLM_CACHE_TTL)
+
+
+def lookup_many(model_name, prompt_version, texts):
+    """
+    Return {index: cached response} for the texts that have a fresh entry.
+    prompt_version may be a tuple of versions whose replies are
+    interchangeable; the first one with an entry wins. Outside an app context
+    the cache is skipped and everything is a miss.
+    """
+    if not _enabled():
+        return {}
+    from app.models import LLMCache
+
+    versions = (prompt_version,) if isinstance(prompt_version, str) else tuple(prompt_version)
+    candidates = [[cache_key(model_name, version, text) for version in versions] for text in texts]
+    entries = {}
+    unique_keys = list(dict.fromkeys(key for keys in candidates for key in keys))
+    for start in range(0, len(unique_keys), LOOKUP_CHUNK):
+        chunk = unique_keys[start:start + LOOKUP_CHUNK]
+        for entry in LLMCache.query.filter(LLMCache.cache_key.in_(chunk)).all():
+            if _is_fresh(entry):
+                entries[entry.cache_key] = entry
+
+    found = {}
+    touched = {}
+    for i, keys in enumerate(candidates):
+        entry = next((entries[key] for key in keys if key in entries), None)
+        if entry is not None:
+            found[i] = entry.response
+            touched[entry.id] = touched.get(entry.id, 0) + 1
+    with _counts_lock:
+        for entry_id, hits in touched.items():
+            _touched[entry_id] = _touched.get(entry_id, 0) + hits
+    _count("hits", len(found))
+    _count("misses", len(texts) - len(found))
+    return found
+
+
+def _write_touches():
+    # Flush the hits tallied by lookups; entries hit equally often share one UPDATE
+    from app.models import LLMCache
+
+    with _counts_lock:
+        touched = dict(_touched)
+        _touched.clear()
+    by_hits = {}
+    for entry_id, hits in touched.items():
+        by_hits.setdefault(hits, []).append(entry_id)
+    now = _now()
+    for hits, ids in by_hits.items():
+        for start in range(0, len(ids), LOOKUP_CHUNK):
+            LLMCache.query.filter(LLMCache.id.in_(ids[start:start + LOOKUP_CHUNK])).update(
+                {LLMCache.hits: func.coalesce(LLMCache.hits, 0) + hits, LLMCache.last_used_at: now},
+                synchronize_session=False)
+
+
+def lookup(model_name, prompt_version, text):
+    return lookup_many(model_name, prompt_version, [text]).get(0)
+
+
+def store_many(kind, model_name, prompt_version, items):
+    """
+    Cache (text, response) pairs, replacing stale or bypassed entries. The
+    rows are written in a savepoint and committed by the caller.
+    """
+    if not _enabled() or not items:
+        return
+    from app import db
+    from sqlalchemy.exc import IntegrityError
+
+    by_key = {}
+    for text, response in items:
+        by_key[cache_key(model_name, prompt_version, text)] = (text, response)
+
+    with db.session.begin_nested():
+        _write_touches()
+    try:
+        with db.session.begin_nested():
+            _upsert(kind, model_name, prompt_version, by_key)
+        stored = len(by_key)
+    except IntegrityError:
+        # Another worker stored some of these inputs concurrently: keep theirs, store the rest one by one
+        stored = 0
+        for key, item in by_key.items():
+            try:
+                with db.session.begin_nested():
+                    _upsert(kind, model_name, prompt_version, {key: item})
+                stored += 1
+            except IntegrityError:
+                pass
+    if not stored:
+        return
+
+    with _counts_lock:
+        before = _counts["stored"]
+        _counts["stored"] += stored
+        due = before // EVICT_EVERY != _counts["stored"] // EVICT_EVERY
+    if due:
+        evict()
+
+
+def _upsert(kind, model_name, prompt_version, by_key):
+    from app import db
+    from app.models import LLMCache
+
+    keys = list(by_key)
+    existing = {}
+    for start in range(0, len(keys), LOOKUP_CHUNK):
+        chunk = keys[start:start + LOOKUP_CHUNK]
+        for entry in LLMCache.query.filter(LLMCache.cache_key.in_(chunk)).all():
+            existing[entry.cache_key] = entry
+
+    now = _now()
+    for key, (text, response) in by_key.items():
+        entry = existing.get(key)
+        if entry is None:
+            db.session.add(LLMCache(
+                cache_key=key,
+                kind=kind,
+                model_name=model_name,
+                prompt_hash=prompt_version,
+                input_text=normalize_text(text),
+                response=response,
+                hits=0,
+                created_at=now,
+                last_used_at=now
+            ))
+        else:
+            entry.response = response
+            entry.created_at = now
+            entry.last_used_at = now
+
+
+def store(kind, model_name, prompt_version, text, response):
+    store_many(kind, model_name, prompt_version, [(text, response)])
+
+
+def record_bypass(n=1):
+    _count("bypassed", n)
+
+
+def evict():
+    """
+    Drop expired entries, then the least recently used ones above
+    LLM_CACHE_MAX_ENTRIES. Runs in a savepoint; the caller commits.
+    """
+    from app import db
+    from app.models import LLMCache
+
+    cutoff = _now() - timedelta(seconds=LLM_CACHE_TTL)
+    with db.session.begin_nested():
+        # Recent hits count towards last_used_at before the least recently used rows are picked
+        _write_touches()
+        removed = LLMCache.query.filter(LLMCache.created_at < cutoff).delete(synchronize_session=False)
+
+        overflow = LLMCache.query.count() - LLM_CACHE_MAX_ENTRIES
+        if overflow > 0:
+            oldest = db.session.query(LLMCache.id).order_by(LLMCache.last_used_at.asc()).limit(overflow).subquery()
+            removed += LLMCache.query.filter(LLMCache.id.in_(db.select(oldest.c.id))).delete(synchronize_session=False)
+
+    _count("evicted", removed)
+    return removed
+
+
+def cache_stats():
+    with _counts_lock:
+        stats = dict(_counts)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+    stats["ttl_s"] = LLM_CACHE_TTL
+    stats["max_entries"] = LLM_CACHE_MAX_ENTRIES
+    return stats
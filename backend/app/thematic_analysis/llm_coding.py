@@ -1,12 +1,40 @@
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
+import json
 import os
+import random
+import threading
+import time
 
+from app import metrics
+from app.thematic_analysis import llm_cache
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    # Built on first use: importing openai is slow, and a worker that never calls it shouldn't pay
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from openai import OpenAI
+                _client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _client
+
+
+# Concurrency and retry settings for bulk coding (OPENAI_BASE_URL points the client at a stub server)
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "30"))
+LLM_BATCH_SIZE = int(os.getenv("LLM_BATCH_SIZE", "1"))  # feedback items per chat completion; 1 = one call per item
+
+CODING_MODEL = "gpt-4o-mini-2024-07-18"
 
 SYSTEM_PROMPT = """
 System Role:
@@ -49,10 +77,42 @@ Output:
 engaging lectures, passionate professor, homework confusion, mismatch in difficulty, unsupported learning
 """
 
+BATCH_INSTRUCTIONS = """
+Batch Mode (overrides the output format above):
+You will receive a JSON array of feedback items, each with an "id" and a "text".
+Code every item independently using the rules above.
+Respond with a JSON object of the form {"results": [{"id": <id>, "codes": ["code", ...]}, ...]}
+with exactly one entry per input item, in the same order. Use an empty list when an item has no meaningful codes.
+"""
+
 
-def generate_codewords(feedback_text):
-    response = client.chat.completions.create(
-        model="gpt-4o-mini-2024-07-18",
+CODING_PROMPT_VERSION = llm_cache.prompt_hash(SYSTEM_PROMPT)
+# Batched replies are cached under the prompt they were produced with, so editing
+# BATCH_INSTRUCTIONS retires them; lookups accept a reply from either mode
+BATCH_PROMPT_VERSION = llm_cache.prompt_hash(SYSTEM_PROMPT + BATCH_INSTRUCTIONS)
+CODING_PROMPT_VERSIONS = (CODING_PROMPT_VERSION, BATCH_PROMPT_VERSION)
+
+
+def _chat(api_client, kind, **request):
+    # Every chat completion goes through here so calls, errors and tokens are counted
+    metrics.inc('llm_calls_total', kind=kind, model=request["model"])
+    try:
+        with metrics.span('llm_call'):
+            response = api_client.chat.completions.create(**request)
+    except Exception:
+        metrics.inc('llm_errors_total', kind=kind, model=request["model"])
+        raise
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        metrics.inc('llm_tokens_total', usage.prompt_tokens or 0, type='prompt', model=request["model"])
+        metrics.inc('llm_tokens_total', usage.completion_tokens or 0, type='completion', model=request["model"])
+    return response
+
+
+def _request_codewords(feedback_text, api_client=None):
+    response = _chat(
+        api_client or get_client(), 'codewords',
+        model=CODING_MODEL,
         messages=[
             {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": f"Feedback: \"{feedback_text}\""}
@@ -64,24 +124,207 @@ def generate_codewords(feedback_text):
     return codewords
 
 
-def generate_seed_words(theme: str) -> list:
-    prompt = f"""You are helping a researcher create seed words for a theme in educational feedback analysis.
+def generate_codewords(feedback_text, api_client=None, use_cache=True):
+    # use_cache=False forces a fresh answer, which then replaces the cached one
+    if use_cache:
+        cached = llm_cache.lookup(CODING_MODEL, CODING_PROMPT_VERSIONS, feedback_text)
+        if cached is not None:
+            return cached
+    else:
+        llm_cache.record_bypass()
+
+    codewords = _request_codewords(feedback_text, api_client)
+    llm_cache.store('codewords', CODING_MODEL, CODING_PROMPT_VERSION, feedback_text, codewords)
+    return codewords
+
+
+def parse_batch_response(content, n_items):
+    # One code list per item, or None for every item when the reply is unusable
+    try:
+        data = json.loads(content)
+    except (TypeError, ValueError):
+        return [None] * n_items
+
+    items = data.get("results") if isinstance(data, dict) else data
+    if not isinstance(items, list) or len(items) != n_items:
+        return [None] * n_items
+
+    parsed = [None] * n_items
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        idx, codes = item.get("id"), item.get("codes")
+        if isinstance(idx, int) and 0 <= idx < n_items and isinstance(codes, list) and parsed[idx] is None:
+            parsed[idx] = [str(code).strip() for code in codes if str(code).strip()]
+    return parsed
+
+
+def generate_codewords_batch(feedback_texts, api_client=None):
+    """
+    Code several feedback texts in one chat completion.
+    Returns one code list per input; items the reply did not cover are None.
+    """
+    payload = json.dumps([{"id": i, "text": text} for i, text in enumerate(feedback_texts)])
+    response = _chat(
+        api_client or get_client(), 'codewords_batch',
+        model=CODING_MODEL,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT + BATCH_INSTRUCTIONS},
+            {"role": "user", "content": f"Feedback items: {payload}"}
+        ],
+        response_format={"type": "json_object"},
+    )
+    return parse_batch_response(response.choices[0].message.content, len(feedback_texts))
+
+
+# ------------- Bulk coding -------------
+
+def _is_retryable(error):
+    from openai import APIConnectionError, APIStatusError, RateLimitError
+
+    if isinstance(error, (RateLimitError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+def _backoff_delay(error, attempt):
+    # Honour Retry-After when the server sends one, otherwise exponential backoff with jitter
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        if retry_after is not None:
+            return min(float(retry_after), LLM_BACKOFF_MAX)
+    except ValueError:
+        pass
+    delay = LLM_BACKOFF_BASE * (2 ** attempt)
+    return min(delay * (1 + random.random()), LLM_BACKOFF_MAX)
+
+
+def call_with_retries(fn, *args, max_retries=None, **kwargs):
+    max_retries = LLM_MAX_RETRIES if max_retries is None else max_retries
+    attempt = 0
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if not _is_retryable(e) or attempt >= max_retries:
+                raise
+            metrics.inc('llm_retries_total')
+            time.sleep(_backoff_delay(e, attempt))
+            attempt += 1
+
+
+def generate_codewords_bulk(feedback_texts, max_workers=None, max_retries=None, batch_size=None,
+                            use_cache=True):
+    """
+    Code many feedback texts concurrently.
+
+    Cached answers are looked up up front and only the misses are sent to the
+    API. With batch_size > 1, misses are packed into batched completions and
+    any item a batch fails to return falls back to its own per-item call.
+
+    Returns one (codewords, error) tuple per input, in input order. A failed
+    item gets ([], "error message") and does not affect the others.
+    """
+    if not feedback_texts:
+        return []
+
+    if use_cache:
+        cached = llm_cache.lookup_many(CODING_MODEL, CODING_PROMPT_VERSIONS, feedback_texts)
+    else:
+        cached = {}
+        llm_cache.record_bypass(len(feedback_texts))
+
+    results = [(cached[i], None) if i in cached else None for i in range(len(feedback_texts))]
+    pending = [i for i, result in enumerate(results) if result is None]
+
+    # Calls run on pool threads, so the request's trace only sees this wall-clock span
+    with metrics.span('llm_coding'):
+        coded = _code_uncached([feedback_texts[i] for i in pending], max_workers, max_retries, batch_size)
+    by_version = {}
+    for i, (codewords, error, prompt_version) in zip(pending, coded):
+        results[i] = (codewords, error)
+        if error is None:
+            by_version.setdefault(prompt_version, []).append((feedback_texts[i], codewords))
+
+    # Cache in the calling thread, which owns the app context and DB session
+    for prompt_version, items in by_version.items():
+        llm_cache.store_many('codewords', CODING_MODEL, prompt_version, items)
+    return results
+
+
+def _code_uncached(feedback_texts, max_workers, max_retries, batch_size):
+    # One (codewords, error, prompt version that produced them) per text
+    if not feedback_texts:
+        return []
+
+    # Retries are handled here, so switch off the SDK's own retry loop
+    api_client = get_client().with_options(max_retries=0)
+    batch_size = max(1, batch_size or LLM_BATCH_SIZE)
+
+    def code_one(feedback_text):
+        try:
+            codewords = call_with_retries(_request_codewords, feedback_text, api_client,
+                                          max_retries=max_retries)
+            return codewords, None, CODING_PROMPT_VERSION
+        except Exception as e:
+            print("Coding failed:", str(e))
+            return [], str(e), CODING_PROMPT_VERSION
+
+    def code_batch(batch):
+        try:
+            return call_with_retries(generate_codewords_batch, batch, api_client,
+                                     max_retries=max_retries)
+        except Exception as e:
+            print("Batch coding failed, falling back to per-item calls:", str(e))
+            return [None] * len(batch)
+
+    workers = max(1, max_workers or LLM_CONCURRENCY)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if batch_size == 1:
+            return list(executor.map(code_one, feedback_texts))
+
+        batches = [feedback_texts[i:i + batch_size] for i in range(0, len(feedback_texts), batch_size)]
+        batched = [codes for batch_codes in executor.map(code_batch, batches) for codes in batch_codes]
+        results = [(codes, None, BATCH_PROMPT_VERSION) if codes is not None else None for codes in batched]
+
+        retry_idx = [i for i, result in enumerate(results) if result is None]
+        for i, result in zip(retry_idx, executor.map(code_one, [feedback_texts[i] for i in retry_idx])):
+            results[i] = result
+        return results
+
+
+SEED_MODEL = "gpt-3.5-turbo-0125"
+
+SEED_PROMPT = """You are helping a researcher create seed words for a theme in educational feedback analysis.
 
 Theme: "{theme}"
 
 Provide 3 short, distinct seed words or phrases that are semantically related to this theme.
 Respond as a lower-case, comma-separated list only, no extra explanation."""
 
-    client = OpenAI()
+SEED_PROMPT_VERSION = llm_cache.prompt_hash(SEED_PROMPT)
+
+
+def generate_seed_words(theme: str, use_cache: bool = True) -> list:
+    if use_cache:
+        cached = llm_cache.lookup(SEED_MODEL, SEED_PROMPT_VERSION, theme)
+        if cached is not None:
+            return cached
+    else:
+        llm_cache.record_bypass()
 
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo-0125",
-        messages=[{"role": "user", "content": prompt}],
+    response = _chat(
+        get_client(), 'seeds',
+        model=SEED_MODEL,
+        messages=[{"role": "user", "content": SEED_PROMPT.format(theme=theme)}],
         temperature=0.3
     )
 
     seed_text = response.choices[0].message.content.strip()
-    return [s.strip() for s in seed_text.split(',') if s.strip()]
+    seeds = [s.strip() for s in seed_text.split(',') if s.strip()]
+    llm_cache.store('seeds', SEED_MODEL, SEED_PROMPT_VERSION, theme, seeds)
+    return seeds
 
 
 
@@ -0,0 +1,331 @@
+# ------------- Plot Creation -------------
+# Charts are drawn with the object-oriented Figure API, never through
+# matplotlib.pyplot, so nothing here touches global state and renders are safe
+# in threaded Flask. render_plots() fans the charts out to a process pool, so
+# producing all three costs about as much as the slowest one.
+# matplotlib and seaborn are imported inside the drawing functions, so importing
+# this module (every web worker does) stays cheap.
+
+import io
+import multiprocessing
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from app import metrics
+
+
+PLOT_KINDS = ("scatter_plot", "bar_chart", "word_cloud")
+
+# Same layout at every size; only the pixel density changes
+PLOT_PRESETS = {
+    "full": {"figsize": (24, 15), "dpi": 200},  # export quality
+    "thumb": {"figsize": (24, 15), "dpi": 40},  # previews, ~960x600 px
+}
+
+PLOT_PROCESSES = int(os.getenv('PLOT_PROCESSES', '3'))  # 0 renders in the calling process
+SCATTER_DENSITY_THRESHOLD = int(os.getenv('SCATTER_DENSITY_THRESHOLD', '2000'))  # above this, hexbin instead of points
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _new_figure(preset):
+    from matplotlib.figure import Figure
+
+    size = PLOT_PRESETS[preset]
+    return Figure(figsize=size["figsize"], dpi=size["dpi"])
+
+
+def _png_bytes(fig, **savefig_kwargs):
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', **savefig_kwargs)
+    return buffer.getvalue()
+
+
+def draw_cluster_ellipse(ax, x, y, color):
+    from matplotlib.patches import Ellipse
+
+    cov = np.cov(x, y)
+    eigenvals, eigenvecs = np.linalg.eigh(cov)
+    order = eigenvals.argsort()[::-1]
+    eigenvals, eigenvecs = eigenvals[order], eigenvecs[:, order]
+
+    angle = np.degrees(np.arctan2(*eigenvecs[:, 0][::-1]))
+    width, height = 2 * np.sqrt(eigenvals)  # scale for visualization
+    ellipse = Ellipse(
+        (np.mean(x), np.mean(y)),
+        width * 2, height * 2,
+        angle=angle,
+        edgecolor=color,
+        facecolor=color,
+        alpha=0.15,
+        lw=2
+    )
+    ax.add_patch(ellipse)
+
+
+def theme_slices(clusters, n_themes):
+    # Sort once and slice, instead of filtering the whole array once per theme
+    clusters = np.asarray(clusters, dtype=int)
+    order = np.argsort(clusters, kind='stable')
+    bounds = np.searchsorted(clusters[order], np.arange(n_themes + 1))
+    return order, bounds
+
+
+def generate_scatterplot(words_list, reduced_embeddings, clusters, theme_labels, preset="full"):
+    from matplotlib import colormaps
+
+    reduced_embeddings = np.asarray(reduced_embeddings, dtype=float).reshape(-1, 2)
+    n_points = len(reduced_embeddings)
+    dense = n_points > SCATTER_DENSITY_THRESHOLD
+
+    # Generate color palette
+    colors = colormaps['viridis'](np.linspace(0.2, 0.9, len(theme_labels)))
+    order, bounds = theme_slices(clusters, len(theme_labels))
+
+    # Plot
+    fig = _new_figure(preset)
+    ax = fig.subplots()
+
+    if dense:
+        # Too many points to draw one by one: show overall density, then each theme's extent
+        ax.hexbin(reduced_embeddings[:, 0], reduced_embeddings[:, 1], gridsize=80,
+                  cmap='Greys', bins='log', mincnt=1, linewidths=0)
+
+    # Scatter plot points by theme
+    for idx, (theme, color) in enumerate(zip(theme_labels, colors)):
+        members = order[bounds[idx]:bounds[idx + 1]]
+        if len(members) == 0:
+            continue
+        x, y = reduced_embeddings[members, 0], reduced_embeddings[members, 1]
+        if dense:
+            ax.scatter([x.mean()], [y.mean()], s=900, color=color, marker='X', label=theme, edgecolors='white')
+        else:
+            ax.scatter(x, y, s=220, color=color, alpha=0.8, label=theme, edgecolors='none')
+        if len(members) > 1:
+            draw_cluster_ellipse(ax, x, y, color)
+
+
+    if n_points <= 20:
+        for word, (x, y) in zip(words_list, reduced_embeddings):
+            ax.text(x + 0.02, y + 0.02, word,
+                    fontsize=24, ha='left', va='bottom')
+
+    # Styling
+    ax.set_xlabel('PCA Component 1', fontsize=38, labelpad=10)
+    ax.set_ylabel('PCA Component 2', fontsize=38, labelpad=10)
+    ax.tick_params(axis='both', labelsize=32)
+
+    # Minimalist grid and remove top/right borders
+    ax.grid(linestyle='--', linewidth=0.6, alpha=0.4)
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+
+    # Legend outside
+    ax.legend(
+    title='Theme',
+    title_fontsize=32,   # Larger title
+    fontsize=28,         # Larger labels
+    bbox_to_anchor=(1.05, 1),
+    loc='upper left',
+    borderaxespad=0.,
+    markerscale=0.5 if dense else 2.0,  # Bigger legend markers (centroid markers are already large)
+    handlelength=4
+    )       # Extra spacing between marker and text
+
+
+    fig.tight_layout()
+
+    return _png_bytes(fig, bbox_inches="tight")
+
+
+def generate_bar_chart(theme_counts, preset="full"):
+    from matplotlib import colormaps
+    from matplotlib.patches import Rectangle
+
+    # Sort frequencies ({theme: number of codeword occurrences})
+    sorted_themes = sorted(theme_counts.items(), key=lambda x: x[1], reverse=True)
+    themes, counts = zip(*sorted_themes)
+
+    # Use a clean, modern color palette
+    colors = colormaps['viridis'](np.linspace(0.2, 0.8, len(themes)))
+
+    # Create figure
+    fig = _new_figure(preset)
+    ax = fig.subplots()
+    bars = ax.bar(themes, counts, color=colors, edgecolor='none')
+
+    # Add value labels above bars
+    for bar in bars:
+        height = bar.get_height()
+        ax.text(bar.get_x() + bar.get_width()/2, height + 0.3,
+                f"{int(height)}", ha='center', va='bottom',
+                fontsize=20, fontweight='bold', color='#333333')
+
+    # Minimalist grid
+    ax.grid(axis='y', linestyle='--', linewidth=0.6, alpha=0.4)
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    ax.spines['left'].set_visible(False)
+
+    # Labels and title
+    ax.set_ylabel("Frequency", fontsize=30, labelpad=15)
+    ax.tick_params(axis='x', labelsize=36, labelrotation=25)
+    for label in ax.get_xticklabels():
+        label.set_horizontalalignment('right')
+    ax.tick_params(axis='y', labelsize=32)
+
+    # Legend (outside, minimalistic)
+    handles = [Rectangle((0,0),1,1,color=colors[i]) for i in range(len(themes))]
+    ax.legend(
+    handles,
+    themes,
+    title="Themes",
+    title_fontsize=30,   # Bigger title font
+    fontsize=24,         # Bigger legend text
+    bbox_to_anchor=(1.08, 1),  # Slightly push further out
+    loc='upper left',
+    borderaxespad=0.5,   # Add some padding
+    labelspacing=1.2     # More space between legend items
+    )
+
+    fig.tight_layout()
+
+    return _png_bytes(fig, bbox_inches="tight")
+
+
+
+def generate_wordcloud(themes, similarity_matrix, preset="full"):
+    """
+    Generate a heatmap showing overlap (cosine similarity) between themes.
+    Replaces the word cloud for better analytical insight.
+    """
+    import seaborn as sns
+
+    fig = _new_figure(preset)
+
+    # If less than 2 themes, return empty plot
+    if len(themes) < 2:
+        ax = fig.subplots()
+        ax.text(0.5, 0.5, "Not enough themes for overlap matrix",
+                ha='center', va='center', fontsize=26, color='#666666')
+        ax.axis('off')
+        return _png_bytes(fig, transparent=True)
+
+    # Plot heatmap
+    ax = fig.subplots()
+    sns.heatmap(
+        similarity_matrix,
+        xticklabels=themes,
+        yticklabels=themes,
+        cmap="coolwarm",
+        annot=True,
+        fmt=".2f",
+        square=True,
+        annot_kws={"size": 32, "weight": "bold"},
+        cbar_kws={"shrink": 0.7},
+        ax=ax
+    )
+
+    ax.set_xticklabels(themes, rotation=30, ha='right', fontsize=38, weight='bold')
+    ax.set_yticklabels(themes, rotation=0, fontsize=38, weight='bold')
+
+    fig.tight_layout()
+
+    return _png_bytes(fig, bbox_inches="tight", transparent=True)
+
+
+def render_plot(kind, plot_data, preset="full"):
+    # PNG bytes for one of PLOT_KINDS, drawn from the plot_data saved by define_themes
+    with metrics.span(f'plot:{kind}'):
+        return _render_plot(kind, plot_data, preset)
+
+
+def _render_plot(kind, plot_data, preset):
+    words = plot_data["words"]
+    labels = np.asarray(plot_data["labels"], dtype=int)
+    themes = plot_data["themes"]
+
+    if kind == "scatter_plot":
+        coords = np.asarray(plot_data["coords"], dtype=float).reshape(-1, 2)
+        return generate_scatterplot(words, coords, labels, themes, preset)
+    if kind == "bar_chart":
+        # Occurrences behind each canonical code; results saved before canonicalization count 1 per code
+        counts = plot_data.get("counts") or [1] * len(words)
+        theme_counts = defaultdict(int)
+        for cluster_id, count in zip(labels, counts):
+            theme_counts[themes[cluster_id]] += count
+        return generate_bar_chart(dict(theme_counts), preset)
+    if kind == "word_cloud":
+        return generate_wordcloud(plot_data["overlap_themes"], np.asarray(plot_data["overlap"]), preset)
+    raise ValueError(f"Unknown plot kind: {kind}")
+
+
+def scatter_points(plot_data, include_words=True):
+    """
+    Compact columnar export of the 2-D scatter, for client-side rendering.
+    """
+    coords = np.asarray(plot_data["coords"], dtype=float).reshape(-1, 2)
+    points = {
+        "themes": plot_data["themes"],
+        "x": np.round(coords[:, 0], 4).tolist(),
+        "y": np.round(coords[:, 1], 4).tolist(),
+        "labels": plot_data["labels"],
+    }
+    if include_words:
+        points["words"] = plot_data["words"]
+    if "counts" in plot_data:
+        points["counts"] = plot_data["counts"]
+    return points
+
+
+def scatter_points_binary(plot_data):
+    # N float32 x, then N float32 y, then N uint16 theme labels (little-endian)
+    coords = np.asarray(plot_data["coords"], dtype='<f4').reshape(-1, 2)
+    labels = np.asarray(plot_data["labels"], dtype='<u2')
+    return coords[:, 0].tobytes() + coords[:, 1].tobytes() + labels.tobytes()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, not fork: forking a threaded server (or a loaded torch) is unsafe
+            _pool = ProcessPoolExecutor(max_workers=PLOT_PROCESSES,
+                                        mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        _pool = None
+
+
+def render_plots(plot_data, kinds=PLOT_KINDS, preset="full"):
+    """
+    Render several plots in parallel worker processes. Returns {kind: png bytes}.
+    """
+    if preset not in PLOT_PRESETS:
+        raise ValueError(f"Unknown plot preset: {preset}")
+    with metrics.span('render_plots'):
+        return _render_plots(plot_data, kinds, preset)
+
+
+def _render_plots(plot_data, kinds, preset):
+    if PLOT_PROCESSES <= 0:
+        return {kind: render_plot(kind, plot_data, preset) for kind in kinds}
+
+    try:
+        pool = _get_pool()
+        futures = {kind: pool.submit(render_plot, kind, plot_data, preset) for kind in kinds}
+        return {kind: future.result() for kind, future in futures.items()}
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM); start a fresh pool next time and finish inline
+        _reset_pool()
+        return {kind: render_plot(kind, plot_data, preset) for kind in kinds}
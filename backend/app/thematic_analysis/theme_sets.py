@@ -0,0 +1,114 @@
+# ------------- Theme library -------------
+# Named, versioned {theme: [seeds]} sets that can be reused across
+# submissions and courses. Saving a set whose themes and seeds are unchanged
+# returns the existing version; any change creates version n + 1, so results
+# clustered with an older version keep pointing at the seeds they used.
+#
+# Each set stores its seed centroids (one float32 vector per theme), so
+# clustering with it skips seed encoding. The vectors are tagged with the
+# embedding space they came from and recomputed when EMBEDDING_MODEL or
+# EMBEDDING_BACKEND changes.
+
+import hashlib
+import json
+
+import numpy as np
+from sqlalchemy.exc import IntegrityError
+
+from app.models import ThemeSet, db
+from app.thematic_analysis.core import seed_centroids
+from app.thematic_analysis.embeddings import DEFAULT_MODEL, embedding_space
+
+
+NAME_MAX_LENGTH = 200  # ThemeSet.name is a String(200)
+
+
+class ThemeSetError(ValueError):
+    pass
+
+
+def normalize_theme_seeds(theme_seeds):
+    # {" Labs ": "Lab, equipment,lab"} -> {"Labs": ["lab", "equipment"]}; empty themes are dropped
+    if not isinstance(theme_seeds, dict):
+        raise ThemeSetError('themes must be an object of {"theme": ["seed", ...]}')
+    normalized = {}
+    for theme, seeds in theme_seeds.items():
+        if not isinstance(theme, str):
+            raise ThemeSetError("Theme names must be strings")
+        theme = theme.strip()
+        if isinstance(seeds, str):
+            seeds = seeds.split(',')
+        if not isinstance(seeds, list) or not all(isinstance(s, str) for s in seeds):
+            raise ThemeSetError(f"Seeds of theme '{theme}' must be a string or a list of strings")
+        if theme:
+            normalized[theme] = list(dict.fromkeys(s.strip().lower() for s in seeds if s.strip()))
+    if not normalized:
+        raise ThemeSetError("themes must contain at least one theme")
+    return normalized
+
+
+def _content_hash(theme_seeds):
+    # Theme order is part of the set: it fixes the cluster label of each theme
+    return hashlib.sha256(json.dumps(list(theme_seeds.items())).encode('utf-8')).hexdigest()
+
+
+def latest_version(name):
+    return ThemeSet.query.filter_by(name=name).order_by(ThemeSet.version.desc()).first()
+
+
+def save_theme_set(name, theme_seeds):
+    """
+    Save {theme: [seeds]} under name. Returns (theme_set, created); created is
+    False when the latest version already has exactly these themes. Raises
+    ThemeSetError for a missing name or malformed themes.
+    """
+    if not isinstance(name, str) or not name.strip():
+        raise ThemeSetError("name is required")
+    if len(name.strip()) > NAME_MAX_LENGTH:
+        raise ThemeSetError(f"name must be at most {NAME_MAX_LENGTH} characters")
+    name = name.strip()
+    theme_seeds = normalize_theme_seeds(theme_seeds)
+    content_hash = _content_hash(theme_seeds)
+    latest = latest_version(name)
+    if latest is not None and latest.content_hash == content_hash:
+        return latest, False
+
+    theme_set = ThemeSet(name=name, version=(latest.version + 1) if latest else 1,
+                         themes=theme_seeds, content_hash=content_hash)
+    _store_centroids(theme_set)
+    db.session.add(theme_set)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Saved concurrently under the same version number; use that one if it has our seeds
+        db.session.rollback()
+        latest = latest_version(name)
+        if latest.content_hash != content_hash:
+            raise
+        return latest, False
+    return theme_set, True
+
+
+def _store_centroids(theme_set):
+    centroids = np.asarray(seed_centroids(theme_set.themes), dtype=np.float32)
+    theme_set.centroids = centroids.tobytes()
+    theme_set.dim = centroids.shape[1]
+    theme_set.embedding_space = embedding_space(DEFAULT_MODEL)
+
+
+def theme_centers(theme_set):
+    # Stored seed centroids as a (themes x dim) array, recomputed if the embedding model changed
+    if theme_set.centroids is None or theme_set.embedding_space != embedding_space(DEFAULT_MODEL):
+        _store_centroids(theme_set)
+        db.session.commit()
+    return np.frombuffer(theme_set.centroids, dtype=np.float32).reshape(len(theme_set.themes), theme_set.dim)
+
+
+def theme_set_to_dict(theme_set):
+    return {
+        "id": theme_set.public_id,
+        "name": theme_set.name,
+        "version": theme_set.version,
+        "themes": theme_set.themes,
+        "created_at": theme_set.created_at.isoformat() if theme_set.created_at else None,
+    }
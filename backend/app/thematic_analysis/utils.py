@@ -1,45 +1,463 @@
-from app.models import Theme, Seed, db
+from app.models import Theme, Seed, ClusterResult, PlotImage, Feedback, Codeword, db
+from app import metrics
+from app.thematic_analysis.core import cluster_codewords, assign_to_themes
+from app.thematic_analysis.clustering import pack_state, unpack_state
+from app.thematic_analysis.plots import render_plots, PLOT_KINDS
+from app.thematic_analysis.embeddings import normalize_text
+from app.thematic_analysis.dedup import find_duplicates
+from app.thematic_analysis.theme_sets import theme_centers
+from app.thematic_analysis.llm_coding import generate_codewords_bulk
+from sqlalchemy import bindparam, delete, insert, update
+from sqlalchemy.orm import aliased
+from sqlalchemy.exc import IntegrityError
 from collections import Counter
+import base64
+import binascii
+import hashlib
+import json
 
 
+CODEWORD_CHUNK = 1000  # feedback rows per statement when rewriting codeword rows
+FEEDBACK_CHUNK = 1000  # rows per bulk INSERT/UPDATE of feedback
 
-def process_themes_and_seeds(submission, themes, seeds):
-    for i in range(len(themes)):
-        theme_name = themes.get(f'theme[{i}]', '').strip()
-        seed_str = seeds.get(f'seeds[{i}]', '')
 
+def parse_theme_seeds(themes, seeds):
+    # {"theme[0]": "Labs"}, {"seeds[0]": "lab, equipment"} -> {"Labs": ["lab", "equipment"]}
+    theme_seeds = {}
+    for i in range(len(themes)):
+        theme_name = (themes.get(f'theme[{i}]') or '').strip()
         if not theme_name:
             continue  # Skip empty themes
+        seed_str = seeds.get(f'seeds[{i}]', '')
+        theme_seeds[theme_name] = [s.strip().lower() for s in seed_str.split(',') if s.strip()]
+    return theme_seeds
 
-        theme = Theme(name=theme_name, submission=submission)
-        seed_list = [s.strip().lower() for s in seed_str.split(',') if s.strip()]
 
+def process_themes_and_seeds(submission, theme_seeds):
+    # One set of Theme/Seed rows per submission, only rewritten when the themes change
+    current = {theme.name: [seed.text for seed in theme.seeds] for theme in submission.themes}
+    if current == theme_seeds:
+        return
+    # delete-orphan removes the old rows
+    submission.themes = [
+        Theme(name=theme_name, seeds=[Seed(text=seed_text) for seed_text in seed_list])
+        for theme_name, seed_list in theme_seeds.items()
+    ]
 
-        for seed_text in seed_list:
-            seed = Seed(text=seed_text, theme=theme)
-            db.session.add(seed)
 
-        db.session.add(theme)
+def split_codewords(value):
+    # "Teamwork, leadership ,teamwork" -> ["Teamwork", "leadership"], deduplicated on the normalized form
+    words = value if isinstance(value, list) else (value or '').split(',')
+    unique = {}
+    for word in words:
+        word = ' '.join(str(word).split())[:255]
+        if word:
+            unique.setdefault(normalize_text(word), word)
+    return [(text, normalized) for normalized, text in unique.items()]
 
 
+def sync_codewords(feedbacks):
+    """
+    Rewrite the Codeword rows of the given feedback rows from their
+    codewords strings. The rows must already have ids (flushed).
+    """
+    feedbacks = list(feedbacks)
+    for start in range(0, len(feedbacks), CODEWORD_CHUNK):
+        chunk = feedbacks[start:start + CODEWORD_CHUNK]
+        db.session.execute(delete(Codeword).where(Codeword.feedback_id.in_([fb.id for fb in chunk])))
+        rows = [
+            {"feedback_id": fb.id, "submission_id": fb.submission_id, "text": text, "normalized_text": normalized}
+            for fb in chunk
+            for text, normalized in split_codewords(fb.codewords)
+        ]
+        if rows:
+            db.session.execute(insert(Codeword), rows)
+            metrics.inc('rows_total', len(rows), table='codewords', op='insert')
 
-def get_codewords(submission_id):
-    from app.models import Feedback
 
-    feedbacks = Feedback.query.filter_by(submission_id=submission_id).all()
-    codewords = []
+def insert_feedback(submission_id, feedback_texts, codewords=None, student_names=None, returning=True):
+    """
+    Bulk-insert Feedback rows, one multi-row INSERT ... RETURNING per chunk.
+    Returns (id, submission_id, codewords) rows in input order. Without
+    codewords the column is left out so it stays SQL NULL (uncoded).
+    returning=False skips the RETURNING clause (a plain executemany, which
+    SQLite doesn't have to split row by row) and returns the row count.
+    """
+    inserted = []
+    for start in range(0, len(feedback_texts), FEEDBACK_CHUNK):
+        texts = feedback_texts[start:start + FEEDBACK_CHUNK]
+        rows = [{"feedback_text": text, "submission_id": submission_id} for text in texts]
+        if codewords is not None:
+            for row, words in zip(rows, codewords[start:start + FEEDBACK_CHUNK]):
+                row["codewords"] = words
+        if student_names is not None:
+            for row, name in zip(rows, student_names[start:start + FEEDBACK_CHUNK]):
+                row["student_name"] = name
+        if not returning:
+            db.session.execute(insert(Feedback), rows)
+            inserted.extend(rows)
+            continue
+        inserted.extend(db.session.execute(
+            insert(Feedback).returning(Feedback.id, Feedback.submission_id, Feedback.codewords,
+                                       sort_by_parameter_order=True),
+            rows
+        ).all())
+    metrics.inc('rows_total', len(inserted), table='feedbacks', op='insert')
+    return inserted if returning else len(inserted)
+
+
+def approve_feedback(entries):
+    """
+    Save approved codewords for [{"feedback_id", "codewords"}] with one
+    executemany UPDATE per chunk. Unknown ids are skipped.
+    Returns (id, submission_id, codewords) rows for the updated feedback.
+    """
+    approved = {}
+    for entry in entries:
+        approved[int(entry["feedback_id"])] = ','.join(entry["codewords"])
+    ids = list(approved)
+
+    updated = []
+    for start in range(0, len(ids), FEEDBACK_CHUNK):
+        chunk = ids[start:start + FEEDBACK_CHUNK]
+        # Core executemany on the table: ids that don't exist simply match no row
+        feedbacks = Feedback.__table__
+        db.session.execute(
+            update(feedbacks).where(feedbacks.c.id == bindparam("fid")).values(
+                codewords=bindparam("words"), approved=True),
+            [{"fid": fid, "words": approved[fid]} for fid in chunk]
+        )
+        updated.extend(db.session.query(Feedback.id, Feedback.submission_id, Feedback.codewords)
+                       .filter(Feedback.id.in_(chunk)).all())
+    metrics.inc('rows_total', len(updated), table='feedbacks', op='update')
+    return updated
+
+
+# ------------- Duplicate feedback -------------
+
+def code_feedback(feedback_texts, batch_size=None, representatives=None):
+    """
+    Code feedback with one LLM request per group of duplicates (see dedup.py).
+    Returns (coded, representatives): a (codewords, error) tuple for every
+    text, copied from its representative, and each text's representative index.
+    """
+    if representatives is None:
+        representatives = find_duplicates(feedback_texts)
+    unique = [i for i, rep in enumerate(representatives) if rep == i]
+    metrics.inc('dedup_collapsed_total', len(feedback_texts) - len(unique))
+
+    coded_unique = dict(zip(unique, generate_codewords_bulk([feedback_texts[i] for i in unique],
+                                                             batch_size=batch_size)))
+    return [coded_unique[rep] for rep in representatives], representatives
+
 
-    for fb in feedbacks:
-        if fb.codewords:
-            # Handle comma-separated string like: "teamwork, leadership"
-            words = [word.strip().lower() for word in fb.codewords.split(',') if word.strip()]
-            codewords.extend(words)
+def link_duplicates(pairs):
+    # [(feedback_id, representative_id)] -> one executemany UPDATE per chunk
+    feedbacks = Feedback.__table__
+    for start in range(0, len(pairs), FEEDBACK_CHUNK):
+        db.session.execute(
+            update(feedbacks).where(feedbacks.c.id == bindparam("fid")).values(representative_id=bindparam("rid")),
+            [{"fid": fid, "rid": rid} for fid, rid in pairs[start:start + FEEDBACK_CHUNK]]
+        )
+    metrics.inc('rows_total', len(pairs), table='feedbacks', op='update')
 
-    return list(set(codewords))  
+
+def dedup_uncoded(submission_id):
+    """
+    Group a submission's uncoded, unlinked feedback and link every duplicate
+    to its representative, so only representatives get coded. Returns the
+    number of rows linked.
+    """
+    rows = (db.session.query(Feedback.id, Feedback.feedback_text)
+            .filter_by(submission_id=submission_id, codewords=None, representative_id=None)
+            .order_by(Feedback.id)
+            .all())
+    representatives = find_duplicates([row.feedback_text for row in rows])
+    pairs = [(row.id, rows[rep].id) for row, rep in zip(rows, representatives) if rows[rep].id != row.id]
+    link_duplicates(pairs)
+    metrics.inc('dedup_collapsed_total', len(pairs))
+    return len(pairs)
+
+
+def copy_representative_codewords(submission_id):
+    """
+    Fill in the codewords of linked duplicates from their (coded)
+    representatives. Returns the number of rows updated.
+    """
+    representative = aliased(Feedback)
+    copied = 0
+    while True:
+        members = (Feedback.query
+                   .join(representative, Feedback.representative_id == representative.id)
+                   .filter(Feedback.submission_id == submission_id, Feedback.codewords.is_(None),
+                           representative.codewords.is_not(None))
+                   .add_columns(representative.codewords)
+                   .order_by(Feedback.id)
+                   .limit(FEEDBACK_CHUNK)
+                   .all())
+        if not members:
+            return copied
+        for member, codewords in members:
+            member.codewords = codewords
+        sync_codewords([member for member, _ in members])
+        db.session.commit()
+        copied += len(members)
+
+
+def backfill_codewords(chunk_size=CODEWORD_CHUNK):
+    # Fill the codewords table from Feedback.codewords for rows saved before it existed
+    last_id = 0
+    total = 0
+    while True:
+        feedbacks = (db.session.query(Feedback.id, Feedback.submission_id, Feedback.codewords)
+                     .filter(Feedback.id > last_id)
+                     .order_by(Feedback.id)
+                     .limit(chunk_size)
+                     .all())
+        if not feedbacks:
+            return total
+        sync_codewords(feedbacks)
+        db.session.commit()
+        total += len(feedbacks)
+        last_id = feedbacks[-1].id
+
+
+def get_codewords(submission_id):
+    # Distinct normalized codewords, deduplicated by the database
+    rows = (db.session.query(Codeword.normalized_text)
+            .filter(Codeword.submission_id == submission_id)
+            .group_by(Codeword.normalized_text)
+            .all())
+    return [word for (word,) in rows]
 
 
 
 def get_codeword_counts(submission_id):
-    words = get_codewords(submission_id)
-    return Counter(words)
+    # How many feedback rows carry each codeword
+    rows = (db.session.query(Codeword.normalized_text, db.func.count(Codeword.id))
+            .filter(Codeword.submission_id == submission_id)
+            .group_by(Codeword.normalized_text)
+            .all())
+    return Counter(dict(rows))
+
+
+
+def pasted_code_counts(submission_id, plot_data):
+    # Occurrences in a manual result that don't come from coded feedback rows, i.e. the pasted codes
+    stored = get_codeword_counts(submission_id)
+    aliases = plot_data.get("aliases") or {}
+    words = plot_data["words"]
+    pasted = Counter()
+    for word, count in zip(words, plot_data.get("counts") or [1] * len(words)):
+        from_feedback = stored[word] + sum(stored[alias] for alias in aliases.get(word, ()))
+        if count > from_feedback:
+            pasted[word] = count - from_feedback
+    return pasted
+
+
+def save_cluster_result(submission_id, clustered, plot_data, theme_seeds=None, state=None, timings=None,
+                        theme_set_id=None):
+    # Save or update result; stored plot images are dropped and re-rendered on demand
+    model_state = pack_state(state) if state is not None else None
+    timings = metrics.rounded(timings) if timings else None
+    cluster_result = ClusterResult.query.filter_by(submission_id=submission_id).first()
+    if cluster_result:
+        cluster_result.results = json.dumps(clustered)
+        cluster_result.plot_data = plot_data
+        cluster_result.theme_seeds = theme_seeds
+        cluster_result.theme_set_id = theme_set_id
+        cluster_result.model_state = model_state
+        cluster_result.timings = timings
+        cluster_result.version = (cluster_result.version or 1) + 1
+        cluster_result.plots = []
+        cluster_result.scatter_plot = cluster_result.bar_chart = cluster_result.word_cloud = None
+    else:
+        cluster_result = ClusterResult(
+            submission_id=submission_id,
+            results=json.dumps(clustered),
+            plot_data=plot_data,
+            theme_seeds=theme_seeds,
+            theme_set_id=theme_set_id,
+            model_state=model_state,
+            timings=timings,
+            version=1
+        )
+        db.session.add(cluster_result)
+    return cluster_result
+
+
+def append_to_cluster_result(cluster_result, codewords):
+    """
+    Assign new codewords to the stored theme centres of an existing result
+    (no refit), updating its results, plot data and counts in place.
+    Returns {theme: [new codewords]}.
+    """
+    plot_data = dict(cluster_result.plot_data)
+    occurrences = Counter(codewords)
+
+    # Codes already in the result (or merged into one of its codes) only add to its count
+    index = {word: i for i, word in enumerate(plot_data["words"])}
+    for canonical, merged in (plot_data.get("aliases") or {}).items():
+        for word in merged:
+            index.setdefault(word, index.get(canonical))
+    if "counts" in plot_data:
+        counts = list(plot_data["counts"])
+        for word, n in occurrences.items():
+            if index.get(word) is not None:
+                counts[index[word]] += n
+        plot_data["counts"] = counts
+
+    new_words = [w for w in occurrences if index.get(w) is None]
+    if not new_words:
+        if "counts" in plot_data:
+            cluster_result.plot_data = plot_data
+            cluster_result.version = (cluster_result.version or 1) + 1
+            cluster_result.plots = []
+        return {}
+
+    state = unpack_state(cluster_result.model_state)
+    with metrics.trace() as timings:
+        added = assign_to_themes(new_words, plot_data, state, [occurrences[w] for w in new_words])
+    add_timings(cluster_result, timings)
+
+    clustered = json.loads(cluster_result.results)
+    for theme, words in added.items():
+        clustered.setdefault(theme, []).extend(words)
+
+    cluster_result.results = json.dumps(clustered)
+    cluster_result.plot_data = plot_data
+    cluster_result.model_state = pack_state(state)
+    cluster_result.version = (cluster_result.version or 1) + 1
+    cluster_result.plots = []  # charts re-render from the updated plot data
+    return added
+
+
+def _store_plot(cluster_result, kind, preset, png):
+    plot = PlotImage(
+        cluster_result_id=cluster_result.id,
+        kind=kind,
+        preset=preset,
+        content_hash=hashlib.sha256(png).hexdigest(),
+        image=png
+    )
+    db.session.add(plot)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Rendered concurrently by another request; use the stored copy
+        db.session.rollback()
+        plot = PlotImage.query.filter_by(cluster_result_id=cluster_result.id, kind=kind, preset=preset).first()
+    return plot
+
+
+def legacy_plot_png(cluster_result, kind):
+    # PNG bytes of a plot stored as a base64 data URI by older versions, or None
+    data_uri = getattr(cluster_result, kind)
+    if not data_uri:
+        return None
+    try:
+        return base64.b64decode(data_uri.split(',', 1)[-1], validate=True)
+    except (binascii.Error, ValueError):
+        print(f"Unreadable legacy {kind} for cluster result {cluster_result.id}")
+        return None
+
+
+def get_or_render_plot(cluster_result, kind, preset='full'):
+    """
+    Return the stored PlotImage for a result, rendering and saving it on first use.
+    Results from before plot_data existed serve their old image at every size.
+    None when the result has nothing to render or serve.
+    """
+    plot = PlotImage.query.filter_by(cluster_result_id=cluster_result.id, kind=kind, preset=preset).first()
+    if plot is not None:
+        return plot
+    if not cluster_result.plot_data:
+        if preset != 'full':
+            return get_or_render_plot(cluster_result, kind, 'full')
+        png = legacy_plot_png(cluster_result, kind)
+        return _store_plot(cluster_result, kind, preset, png) if png else None
+
+    with metrics.trace() as timings:
+        png = render_plots(cluster_result.plot_data, [kind], preset)[kind]
+    add_timings(cluster_result, timings)
+    return _store_plot(cluster_result, kind, preset, png)
+
+
+def prerender_plots(cluster_result, preset='full'):
+    # Render every missing plot for a result in parallel
+    stored = {kind for (kind,) in PlotImage.query.with_entities(PlotImage.kind)
+              .filter_by(cluster_result_id=cluster_result.id, preset=preset)}
+    missing = [kind for kind in PLOT_KINDS if kind not in stored]
+    if missing:
+        with metrics.trace() as timings:
+            rendered = render_plots(cluster_result.plot_data, missing, preset)
+        add_timings(cluster_result, timings)
+        for kind, png in rendered.items():
+            _store_plot(cluster_result, kind, preset, png)
+
+
+def backfill_legacy_plots(chunk_size=100):
+    """
+    Move the base64 images of results clustered before plot_data existed into
+    plot_images and clear the old columns. Returns the number of results moved.
+    """
+    legacy = (ClusterResult.scatter_plot.is_not(None) | ClusterResult.bar_chart.is_not(None)
+              | ClusterResult.word_cloud.is_not(None))
+    total = 0
+    while True:
+        results = ClusterResult.query.filter(legacy).order_by(ClusterResult.id).limit(chunk_size).all()
+        if not results:
+            return total
+        for cluster_result in results:
+            if not cluster_result.plot_data:
+                stored = {kind for (kind,) in PlotImage.query.with_entities(PlotImage.kind)
+                          .filter_by(cluster_result_id=cluster_result.id, preset='full')}
+                for kind in PLOT_KINDS:
+                    png = legacy_plot_png(cluster_result, kind) if kind not in stored else None
+                    if png:
+                        db.session.add(PlotImage(cluster_result_id=cluster_result.id, kind=kind, preset='full',
+                                                 content_hash=hashlib.sha256(png).hexdigest(), image=png))
+            cluster_result.scatter_plot = cluster_result.bar_chart = cluster_result.word_cloud = None
+        db.session.commit()
+        total += len(results)
+
+
+def add_timings(cluster_result, timings):
+    # Fold later work (rendering, appends) into the result's stored timing breakdown
+    merged = dict(cluster_result.timings or {})
+    for stage, seconds in metrics.rounded(timings).items():
+        merged[stage] = round(merged.get(stage, 0.0) + seconds, 4)
+    cluster_result.timings = merged
+
+
+def cluster_submission_codewords(submission, theme_seeds=None, theme_set=None):
+    """
+    Cluster the submission's codewords with {theme: [seeds]} or a library
+    ThemeSet and store the result. Only ad-hoc themes are recorded as the
+    submission's Theme/Seed rows. Returns the ClusterResult, or None when
+    there are no codewords to cluster.
+    """
+    if theme_set is None:
+        process_themes_and_seeds(submission, theme_seeds)
+        db.session.commit()
+    return recluster_submission(submission, theme_seeds, theme_set=theme_set)
+
+
+def recluster_submission(submission, theme_seeds, extra_counts=None, theme_set=None):
+    # Full fit of all the submission's codewords against the given {theme: [seeds]} or theme set
+    counts = get_codeword_counts(submission.id)
+    if extra_counts:
+        counts.update(extra_counts)
+    if not counts:
+        return None
+
+    with metrics.trace() as timings:
+        centers = None
+        if theme_set is not None:
+            theme_seeds, centers = theme_set.themes, theme_centers(theme_set)
+        clustered, plot_data, state = cluster_codewords(counts, theme_seeds, theme_centers=centers)
 
+    cluster_result = save_cluster_result(submission.id, clustered, plot_data, theme_seeds, state, timings,
+                                         theme_set_id=theme_set.id if theme_set is not None else None)
+    db.session.commit()
+    return cluster_result
@@ -1,12 +1,25 @@
-from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify
-from .models import db, Submission, Feedback, ClusterResult
+from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify, current_app, Response, stream_with_context, g
+from .models import db, Submission, Feedback, Codeword, ClusterResult, Job, ThemeSet
+from . import jobs, metrics
+from .ingest import ingest_feedback, IngestError
+from sqlalchemy.orm import joinedload
 views = Blueprint('views', __name__)
-from app.thematic_analysis.utils import process_themes_and_seeds, get_codewords
-from app.thematic_analysis.llm_coding import generate_codewords, generate_seed_words
-from app.thematic_analysis.core import define_themes
-import pandas as pd
-from io import StringIO
+from app.thematic_analysis.utils import (
+    cluster_submission_codewords, recluster_submission, save_cluster_result, append_to_cluster_result,
+    get_or_render_plot, sync_codewords, insert_feedback, approve_feedback, get_codewords,
+    code_feedback, link_duplicates, pasted_code_counts, parse_theme_seeds, split_codewords
+)
+from app.thematic_analysis.theme_sets import ThemeSetError, save_theme_set, theme_centers, theme_set_to_dict
+from app.thematic_analysis.dedup import find_duplicates
+from app.thematic_analysis.llm_coding import generate_codewords, generate_codewords_bulk, generate_seed_words, LLM_BATCH_SIZE, LLM_CONCURRENCY
+from app.thematic_analysis.core import cluster_codewords
+from app.thematic_analysis.plots import PLOT_KINDS, PLOT_PRESETS, scatter_points, scatter_points_binary
+from app.thematic_analysis.embeddings import model_stats, normalize_text
+from app.thematic_analysis.llm_cache import cache_stats as llm_cache_stats
+from app.thematic_analysis.codeword_index import index_feedback, search_similar
 import json
+import time
+from collections import Counter
 
 @views.route('/')
 def home():
@@ -14,9 +27,18 @@ def home():
 
 
 
+FEEDBACK_PAGE_SIZE = 500
+FEEDBACK_PAGE_MAX = 5000
+
+
+def with_result(*columns):
+    # Load the cluster result in the same query, with only the columns the endpoint reads
+    return joinedload(Submission.cluster_result).load_only(ClusterResult.id, ClusterResult.version, *columns)
+
+
 @views.route('/results/<string:public_id>')
 def results(public_id):
-    submission = Submission.query.filter_by(public_id=public_id).first()
+    submission = Submission.query.options(with_result(ClusterResult.results)).filter_by(public_id=public_id).first()
     if not submission or not submission.cluster_result:
         return redirect(url_for('views.processing', public_id=public_id))
     results = json.loads(submission.cluster_result.results)
@@ -32,6 +54,49 @@ def debug():
     return "Blueprint is working!"
 
 
+@views.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@views.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unknown'
+    if endpoint != 'views.metrics_endpoint':
+        metrics.observe('http_request_seconds', time.perf_counter() - g.request_started, endpoint=endpoint)
+        metrics.inc('http_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+
+@views.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@views.route('/debug/models')
+def debug_models():
+    return jsonify(model_stats())
+
+
+@views.route('/debug/llm_cache')
+def debug_llm_cache():
+    return jsonify(llm_cache_stats())
+
+
+
+
+def wants_async(data):
+    # Run as a background job when asked to, or when ASYNC_JOBS is on for the whole app
+    flag = request.args.get('async', data.get('async') if isinstance(data, dict) else None)
+    if flag is None:
+        return current_app.config['ASYNC_JOBS']
+    return str(flag).lower() in ('1', 'true', 'yes')
+
+
+def job_accepted(job):
+    response = jobs.job_to_dict(job)
+    response["status_url"] = url_for('views.get_job', job_id=job.public_id)
+    return jsonify(response), 202
 
 
 #Starting process: Generate codes from each feedback in the submission
@@ -40,32 +105,23 @@ def generate():
 
     data = request.get_json()
     feedback_list = data.get('feedback', [])
+    batch_size = data.get('batch_size')  # feedback items per LLM call, defaults to LLM_BATCH_SIZE
 
     # Step 1: Create submission entry
     new_submission = Submission(upload_type='file') 
     db.session.add(new_submission)
     db.session.commit()  # Commit now to get the ID
 
-    results = []
+    if wants_async(data):
+        # Store the rows uncoded; the worker fills in codewords and can resume after a restart
+        insert_feedback(new_submission.id, feedback_list)
+        db.session.commit()
+        job = jobs.enqueue('generate', {"batch_size": batch_size}, submission_id=new_submission.id)
+        return job_accepted(job)
 
-    for feedback_text in feedback_list:
-        codewords = generate_codewords(feedback_text)
-
-        # Step 2: Create Feedback entry
-        feedback_entry = Feedback(
-            feedback_text=feedback_text,
-            codewords=','.join(codewords) if isinstance(codewords, list) else codewords,
-            submission_id=new_submission.id
-        )
-        db.session.add(feedback_entry)
-        db.session.flush()
-
-        # Append to response
-        results.append({
-            "feedback_id": feedback_entry.id,
-            "feedback": feedback_text,
-            "codewords": codewords if isinstance(codewords, list) else codewords.split(','),
-        })
+    # Duplicates are coded once; results come back in input order
+    coded, representatives = code_feedback(feedback_list, batch_size=batch_size)
+    results = save_coded_feedback(new_submission.id, feedback_list, coded, representatives)
 
     db.session.commit()
 
@@ -75,16 +131,170 @@ def generate():
     })
 
 
+@views.route('/upload', methods=['POST'])
+def upload_feedback():
+    """
+    Multipart upload of a CSV/XLSX export: file, text_column, and optionally
+    name_column (defaults to a "student_name" column if there is one) and
+    sheet. Rows are streamed into the database in batches, then coded by a
+    background job unless code=0 is sent.
+    """
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({"error": "file is required"}), 400
+    text_column = request.form.get('text_column')
+    if not text_column:
+        return jsonify({"error": "text_column is required"}), 400
+
+    new_submission = Submission(upload_type='file')
+    db.session.add(new_submission)
+    db.session.commit()
+
+    try:
+        stats = ingest_feedback(new_submission.id, upload.stream, upload.filename, text_column,
+                                name_column=request.form.get('name_column'),
+                                chunk_size=request.form.get('chunk_size', type=int),
+                                sheet=request.form.get('sheet'))
+        if not stats["rows"]:
+            raise IngestError("No feedback rows found in the uploaded file.")
+    except IngestError as e:
+        # Don't leave a half-imported submission behind
+        db.session.rollback()
+        Feedback.query.filter_by(submission_id=new_submission.id).delete()
+        db.session.delete(new_submission)
+        db.session.commit()
+        return jsonify({"error": str(e)}), 400
+
+    response = {"submission_id": new_submission.public_id, **stats}
+    if request.form.get('code', '1').lower() in ('0', 'false', 'no'):
+        return jsonify(response), 201
+
+    job = jobs.enqueue('generate', {"batch_size": request.form.get('batch_size', type=int)},
+                       submission_id=new_submission.id)
+    response["job"] = jobs.job_to_dict(job)
+    response["status_url"] = url_for('views.get_job', job_id=job.public_id)
+    return jsonify(response), 202
+
+
+def save_coded_feedback(submission_id, feedback_texts, coded, representatives=None, offset=0, earlier_ids=None):
+    """
+    Bulk-insert Feedback rows for coded texts and return their response
+    records. representatives (from code_feedback) links duplicates to their
+    representative's row. When the indices continue across calls
+    (streaming), offset is the index of the first text and earlier_ids maps
+    the indices of representatives saved by previous calls to their ids.
+    """
+    code_lists = [codewords if isinstance(codewords, list) else codewords.split(',') for codewords, _ in coded]
+    inserted = insert_feedback(submission_id, feedback_texts, [','.join(codes) for codes in code_lists])
+    sync_codewords(inserted)
+
+    def row_id(index):
+        return inserted[index - offset].id if index >= offset else earlier_ids[index]
+
+    links = {}
+    if representatives is not None:
+        links = {inserted[i].id: row_id(rep) for i, rep in enumerate(representatives) if rep != offset + i}
+        link_duplicates(list(links.items()))
+
+    results = []
+    for row, feedback_text, codes, (_, error) in zip(inserted, feedback_texts, code_lists, coded):
+        result = {
+            "feedback_id": row.id,
+            "feedback": feedback_text,
+            "codewords": codes,
+        }
+        if row.id in links:
+            result["representative_id"] = links[row.id]
+        if error:
+            result["error"] = error
+        results.append(result)
+    return results
+
+
+@views.route('/generate/stream', methods=['POST'])
+def generate_stream():
+    """
+    Streaming variant of /generate. Emits one record per feedback item as soon
+    as its chunk is coded and committed, then a summary record with the
+    submission id. NDJSON by default, Server-Sent Events with ?format=sse.
+    """
+    data = request.get_json()
+    feedback_list = data.get('feedback', [])
+    batch_size = data.get('batch_size') or LLM_BATCH_SIZE
+    sse = request.args.get('format') == 'sse'
+
+    new_submission = Submission(upload_type='file')
+    db.session.add(new_submission)
+    db.session.commit()
+    submission_id, public_id = new_submission.id, new_submission.public_id
+
+    # One chunk is one wave of parallel LLM calls
+    chunk_size = max(1, LLM_CONCURRENCY * batch_size)
+
+    def encode_record(record):
+        line = json.dumps(record)
+        return f"data: {line}\n\n" if sse else line + "\n"
+
+    def records():
+        total = failed = 0
+        # Grouped over the whole list; a representative always comes before its duplicates
+        representatives = find_duplicates(feedback_list)
+        metrics.inc('dedup_collapsed_total', sum(1 for i, rep in enumerate(representatives) if rep != i))
+        # Codes and row ids are kept per representative only until its last duplicate is saved
+        last_use = {rep: i for i, rep in enumerate(representatives)}
+        coded_by_rep, rep_ids = {}, {}
+        for start in range(0, len(feedback_list), chunk_size):
+            chunk_reps = representatives[start:start + chunk_size]
+            new = [rep for rep in dict.fromkeys(chunk_reps) if rep not in coded_by_rep]
+            coded_by_rep.update(zip(new, generate_codewords_bulk([feedback_list[rep] for rep in new],
+                                                                 batch_size=batch_size)))
+
+            chunk = feedback_list[start:start + chunk_size]
+            coded = [coded_by_rep[rep] for rep in chunk_reps]
+            chunk_results = save_coded_feedback(submission_id, chunk, coded, chunk_reps,
+                                                offset=start, earlier_ids=rep_ids)
+            db.session.commit()
+
+            end = start + len(chunk)
+            for rep in new:
+                rep_ids[rep] = chunk_results[rep - start]["feedback_id"]
+            for rep in dict.fromkeys(chunk_reps):
+                if last_use[rep] < end:
+                    del coded_by_rep[rep], rep_ids[rep]
+
+            for result in chunk_results:
+                total += 1
+                failed += 1 if "error" in result else 0
+                yield encode_record(result)
+
+        yield encode_record({"done": True, "submission_id": public_id, "total": total, "failed": failed})
+
+    return Response(
+        stream_with_context(records()),
+        mimetype='text/event-stream' if sse else 'application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @views.route('/regenerate_one', methods=['POST'])
 def regenerate_one():
     data = request.get_json()
     text = data.get('text')
+    texts = data.get('texts')  # optional list: regenerate several items in batched calls
+    use_cache = not data.get('force', False)  # force=true skips the LLM cache for a fresh answer
 
-    if not text:
+    if not text and not texts:
         return jsonify({'error': 'No feedback text provided.'}), 400
 
     try:
-        codewords = generate_codewords(text)
+        if texts:
+            coded = generate_codewords_bulk(texts, batch_size=data.get('batch_size') or len(texts),
+                                            use_cache=use_cache)
+            db.session.commit()  # the LLM cache entries
+            return jsonify({'codewords': [codewords for codewords, _ in coded]}), 200
+
+        codewords = generate_codewords(text, use_cache=use_cache)
+        db.session.commit()
         return jsonify({'codewords': codewords}), 200
     except Exception as e:
         print("Error in regenerate_one:", str(e))
@@ -92,59 +302,130 @@ def regenerate_one():
 
 
 
+def feedback_record(row):
+    return {
+        "feedback_id": row.id,
+        "feedback": row.feedback_text,
+        "codewords": [w for w in (row.codewords or '').split(',') if w],
+        "approved": bool(row.approved),
+        "representative_id": row.representative_id,
+    }
+
+
+def feedback_page(submission_id, cursor=0, limit=FEEDBACK_PAGE_SIZE):
+    # Keyset pagination on (submission_id, id): every page is an index range scan
+    rows = (db.session.query(Feedback.id, Feedback.feedback_text, Feedback.codewords, Feedback.approved,
+                             Feedback.representative_id)
+            .filter(Feedback.submission_id == submission_id, Feedback.id > cursor)
+            .order_by(Feedback.id)
+            .limit(limit)
+            .all())
+    next_cursor = rows[-1].id if len(rows) == limit else None
+    return [feedback_record(row) for row in rows], next_cursor
+
+
 @views.route('/submission/<int:id>', methods=['GET'])
 def get_submission(id):
     submission = Submission.query.get_or_404(id)
+    entries, next_cursor = feedback_page(submission.id)
     return jsonify({
         "id": submission.id,
-        "codewords": submission.codewords,  # assume flat list
-        "entries": [
-            {"text": fb.text, "codewords": fb.codewords}
-            for fb in submission.feedback_entries  # backref
-        ]
+        "public_id": submission.public_id,
+        "upload_type": submission.upload_type,
+        "date": submission.date.isoformat() if submission.date else None,
+        "feedback_count": Feedback.query.filter_by(submission_id=submission.id).count(),
+        "codewords": get_codewords(submission.id),
+        "entries": entries,
+        "next_cursor": next_cursor,
+        "feedback_url": url_for('views.list_feedback', public_id=submission.public_id),
     })
 
 
+@views.route('/submission/<string:public_id>/feedback', methods=['GET'])
+def list_feedback(public_id):
+    """
+    Feedback rows of a submission, one page at a time: pass the returned
+    next_cursor as ?cursor= for the next page (null on the last one).
+    ?stream=1 returns every row in one JSON document, streamed in pages.
+    """
+    submission_id, public_id = (db.session.query(Submission.id, Submission.public_id)
+                                .filter_by(public_id=public_id).first_or_404())
+    cursor = request.args.get('cursor', 0, type=int)
+    limit = max(1, min(request.args.get('limit', FEEDBACK_PAGE_SIZE, type=int), FEEDBACK_PAGE_MAX))
+
+    if request.args.get('stream') not in ('1', 'true'):
+        entries, next_cursor = feedback_page(submission_id, cursor, limit)
+        return jsonify({"submission_id": public_id, "feedback": entries, "next_cursor": next_cursor})
+
+    def document():
+        yield '{"submission_id": %s, "feedback": [' % json.dumps(public_id)
+        after, separator, total = cursor, '', 0
+        while after is not None:
+            entries, after = feedback_page(submission_id, after, limit)
+            for entry in entries:
+                yield separator + json.dumps(entry)
+                separator = ','
+            total += len(entries)
+        yield '], "total": %d}' % total
+
+    return Response(stream_with_context(document()), mimetype='application/json')
+
+
 @views.route('/approve_codewords', methods=['POST'])
 def approve_codewords():
 
     data = request.get_json()
     approved_entries = data.get("approved", [])
 
-    for entry in approved_entries:
-        feedback = Feedback.query.get(entry["feedback_id"])
-        if feedback:
-            # print(f" - {entry['feedback_id']}: {entry['codewords']}")
-            feedback.codewords = ','.join(entry["codewords"])  # Update with approved codewords
-            feedback.approved = True
-        
-
+    # One bulk UPDATE per chunk instead of a query and an update per entry
+    approved_feedbacks = approve_feedback(approved_entries)
+    sync_codewords(approved_feedbacks)
     db.session.commit()
+
+    # Keep the cross-submission search index in step with the approved codes
+    try:
+        index_feedback(approved_feedbacks)
+    except Exception as e:
+        db.session.rollback()
+        print("Codeword indexing failed:", str(e))
+
     return jsonify({"status": "success"})
 
 
+@views.route('/codewords/similar', methods=['GET'])
+def similar_codewords():
+    # ?q=<code>&k=10&submission=<public_id>[,<public_id>...]
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({"error": "q is required"}), 400
+    k = max(1, min(request.args.get('k', 10, type=int), 100))
 
+    submission_ids = None
+    if request.args.get('submission'):
+        public_ids = [p for p in request.args.get('submission').split(',') if p]
+        submission_ids = [sid for (sid,) in Submission.query.with_entities(Submission.id)
+                          .filter(Submission.public_id.in_(public_ids))]
+        if not submission_ids:
+            return jsonify({"error": "Submission not found"}), 404
 
+    return jsonify({"query": query, "results": search_similar(query, k=k, submission_ids=submission_ids)})
 
-@views.route('/submission/<public_id>/codewords', methods=['GET'])
-def get_codewords_for_submission(public_id):
-    submission = Submission.query.filter_by(public_id=public_id).first_or_404()
 
-    # print(f"Getting codewords for submission: {public_id}")
 
-    all_codewords = []
-    for fb in submission.feedbacks:
-        # print(f" - Feedback {fb.id} approved={getattr(fb, 'approved', None)} codewords={fb.codewords}")
-        if getattr(fb, 'approved', False) and fb.codewords:
-            if isinstance(fb.codewords, str):
-                split_words = [w.strip() for w in fb.codewords.split(',') if w.strip()]
-                all_codewords.extend(split_words)
-            elif isinstance(fb.codewords, list):
-                all_codewords.extend(fb.codewords)
 
-    # Remove duplicates while preserving order
-    seen = set()
-    unique_codewords = [x for x in all_codewords if not (x in seen or seen.add(x))]
+
+@views.route('/submission/<public_id>/codewords', methods=['GET'])
+def get_codewords_for_submission(public_id):
+    submission = Submission.query.with_entities(Submission.id).filter_by(public_id=public_id).first_or_404()
+
+    # Approved codewords in first-seen order, deduplicated in SQL
+    rows = (db.session.query(db.func.min(Codeword.text))
+            .join(Feedback, Feedback.id == Codeword.feedback_id)
+            .filter(Codeword.submission_id == submission.id, Feedback.approved.is_(True))
+            .group_by(Codeword.normalized_text)
+            .order_by(db.func.min(Codeword.id))
+            .all())
+    unique_codewords = [text for (text,) in rows]
 
     return jsonify({ "codewords": unique_codewords })
 
@@ -158,53 +439,30 @@ def cluster_submission(public_id):
         data = request.get_json()
         theme_names = {k: v for k, v in data.get("themes", {}).items() if k.startswith("theme[")}
         seed_texts = {k: v for k, v in data.get("seeds", {}).items() if k.startswith("seeds[")}
-
-        # Save to DB
-        process_themes_and_seeds(submission, theme_names, seed_texts)
-        db.session.commit()
-        # print("4. Seeds + Themes saved.")
-
-        # Now fetch codewords
-        codewords = get_codewords(submission.id)
-        # print("5. Codewords:", codewords)
-
-        if not codewords:
+        theme_set_id = data.get("theme_set_id")  # cluster with a saved theme set instead of themes/seeds
+        theme_set = None
+        if theme_set_id:
+            theme_set = ThemeSet.query.filter_by(public_id=theme_set_id).first()
+            if theme_set is None:
+                return jsonify({"error": "Theme set not found"}), 404
+
+        if wants_async(data):
+            job = jobs.enqueue('cluster', {"themes": theme_names, "seeds": seed_texts, "theme_set_id": theme_set_id},
+                               submission_id=submission.id)
+            return job_accepted(job)
+
+        theme_seeds = None if theme_set else parse_theme_seeds(theme_names, seed_texts)
+        cluster_result = cluster_submission_codewords(submission, theme_seeds, theme_set)
+        if cluster_result is None:
             return jsonify({"error": "No codewords available for clustering."}), 400
 
-        theme_seeds = {
-            theme_names[f'theme[{i}]']: [s.strip() for s in seed_texts.get(f'seeds[{i}]', '').split(',')]
-            for i in range(len(theme_names))
-        }
-
-        clustered, scatter_plot, bar_chart, word_cloud = define_themes(codewords, theme_seeds)
-
+        clustered = json.loads(cluster_result.results)
         print("6. Clustering Result:", clustered)
 
-        # Save or update result
-        cluster_result = ClusterResult.query.filter_by(submission_id=submission.id).first()
-        if cluster_result:
-            cluster_result.results = json.dumps(clustered)
-            cluster_result.scatter_plot = scatter_plot
-            cluster_result.bar_chart = bar_chart
-            cluster_result.word_cloud = word_cloud
-        else:
-            cluster_result = ClusterResult(
-                submission_id=submission.id,
-                results=json.dumps(clustered),
-                scatter_plot=scatter_plot,
-                bar_chart=bar_chart,
-                word_cloud=word_cloud
-            )
-            db.session.add(cluster_result)
-
-        db.session.commit()
-
         return jsonify({
             "message": "Clustering complete",
             "results": clustered,
-            "scatter_plot": cluster_result.scatter_plot,
-            "bar_chart": cluster_result.bar_chart,
-            "word_cloud": cluster_result.word_cloud
+            **plot_urls(submission, cluster_result)
         }), 200
 
     except Exception as e:
@@ -215,9 +473,56 @@ def cluster_submission(public_id):
 
 
 
+@views.route('/submission/<string:public_id>/append', methods=['POST'])
+def append_feedback(public_id):
+    """
+    Code new feedback for an existing submission. New codewords are assigned
+    to the stored theme centres (no refit) unless "refit": true is sent.
+    """
+    submission = Submission.query.filter_by(public_id=public_id).first_or_404()
+
+    data = request.get_json()
+    feedback_list = data.get('feedback', [])
+    refit = bool(data.get('refit', False))
+
+    coded, representatives = code_feedback(feedback_list, batch_size=data.get('batch_size'))
+    results = save_coded_feedback(submission.id, feedback_list, coded, representatives)
+    db.session.commit()
+
+    response = {"submission_id": submission.public_id, "results": results, "mode": None}
+    cluster_result = submission.cluster_result
+    if cluster_result is None:
+        # Not clustered yet: the new rows are simply part of the next clustering run
+        return jsonify(response), 200
+
+    try:
+        if refit or cluster_result.model_state is None:
+            if not cluster_result.theme_seeds:
+                return jsonify({**response, "error": "Stored result has no themes to refit; run clustering again."}), 409
+            # Manually pasted codes only live in the stored result, so carry them into the refit
+            extra = pasted_code_counts(submission.id, cluster_result.plot_data) if submission.upload_type == 'manual' else None
+            cluster_result = recluster_submission(submission, cluster_result.theme_seeds, extra,
+                                                  theme_set=cluster_result.theme_set)
+            response["mode"] = "refit"
+        else:
+            new_codewords = [word for r in results for _, word in split_codewords(r["codewords"])]
+            response["assigned"] = append_to_cluster_result(cluster_result, new_codewords)
+            db.session.commit()
+            response["mode"] = "incremental"
+    except Exception as e:
+        print("ERROR during append:", str(e))
+        return jsonify({**response, "error": "Internal Server Error", "details": str(e)}), 500
+
+    response["clustering"] = json.loads(cluster_result.results)
+    response.update(plot_urls(submission, cluster_result))
+    return jsonify(response), 200
+
+
+
 @views.route('/submission/<string:public_id>/results', methods=['GET'])
 def get_clustering_results(public_id):
-    submission = Submission.query.filter_by(public_id=public_id).first_or_404()
+    submission = (Submission.query.options(with_result(ClusterResult.results, ClusterResult.timings))
+                  .filter_by(public_id=public_id).first_or_404())
     cluster_result = submission.cluster_result
 
     if not cluster_result:
@@ -226,24 +531,162 @@ def get_clustering_results(public_id):
 
     return jsonify({
         "results": json.loads(cluster_result.results),
-        "scatter_plot": cluster_result.scatter_plot,
-        "bar_chart": cluster_result.bar_chart,
-        "word_cloud": cluster_result.word_cloud
+        "timings": cluster_result.timings or {},
+        **plot_urls(submission, cluster_result)
     }), 200
 
 
+def plot_urls(submission, cluster_result):
+    # Versioned URLs, so a re-cluster never serves a stale cached image
+    urls = {
+        kind: url_for('views.get_plot', public_id=submission.public_id, kind=kind, v=cluster_result.version)
+        for kind in PLOT_KINDS
+    }
+    urls["thumbnails"] = {
+        kind: url_for('views.get_plot', public_id=submission.public_id, kind=kind,
+                      v=cluster_result.version, size='thumb')
+        for kind in PLOT_KINDS
+    }
+    return urls
+
+
+@views.route('/submission/<string:public_id>/scatter', methods=['GET'])
+def get_scatter_points(public_id):
+    """
+    2-D coordinates and theme labels of every codeword, for interactive plotting.
+    ?format=bin returns float32 x, float32 y and uint16 labels back to back.
+    """
+    submission = (Submission.query.options(with_result(ClusterResult.plot_data))
+                  .filter_by(public_id=public_id).first_or_404())
+    cluster_result = submission.cluster_result
+    if not cluster_result or not cluster_result.plot_data:
+        return jsonify({"error": "No clustering result found."}), 404
+
+    plot_data = cluster_result.plot_data
+    if request.args.get('format') == 'bin':
+        response = Response(scatter_points_binary(plot_data), mimetype='application/octet-stream')
+        response.headers['X-Point-Count'] = str(len(plot_data["labels"]))
+        response.headers['X-Themes'] = json.dumps(plot_data["themes"])
+    else:
+        include_words = request.args.get('words', '1') != '0'
+        response = jsonify(scatter_points(plot_data, include_words))
+
+    response.set_etag(f"{cluster_result.id}-{cluster_result.version}-{request.args.get('format', 'json')}-{request.args.get('words', '1')}")
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@views.route('/submission/<string:public_id>/plots/<string:kind>.png', methods=['GET'])
+def get_plot(public_id, kind):
+    preset = request.args.get('size', 'full')
+    if kind not in PLOT_KINDS:
+        return jsonify({"error": f"Unknown plot: {kind}"}), 404
+    if preset not in PLOT_PRESETS:
+        return jsonify({"error": f"Unknown size: {preset}"}), 400
+
+    # plot_data is only loaded (lazily) when the image still has to be rendered
+    submission = Submission.query.options(with_result()).filter_by(public_id=public_id).first_or_404()
+    cluster_result = submission.cluster_result
+    plot = get_or_render_plot(cluster_result, kind, preset) if cluster_result else None
+    if plot is None:
+        return jsonify({"error": "No clustering result found."}), 404
+
+    response = Response(plot.image, mimetype='image/png')
+    response.set_etag(plot.content_hash)
+    response.last_modified = plot.created_at
+    if request.args.get('v') == str(cluster_result.version):
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    else:
+        # Unversioned URL: let the browser cache it but revalidate with the ETag
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+
+
+@views.route('/jobs/<string:job_id>', methods=['GET'])
+def get_job(job_id):
+    job = Job.query.filter_by(public_id=job_id).first_or_404()
+    data = jobs.job_to_dict(job)
+    if job.kind == 'generate' and job.status == 'done':
+        # The coded rows are paged from here rather than sent on every poll
+        data["feedback_url"] = url_for('views.list_feedback', public_id=data["result"]["submission_id"])
+    return jsonify(data)
+
+
+@views.route('/jobs/<string:job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = Job.query.filter_by(public_id=job_id).first_or_404()
+    return jsonify(jobs.job_to_dict(jobs.cancel(job)))
+
+
+@views.route('/jobs/<string:job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+    job = Job.query.filter_by(public_id=job_id).first_or_404()
+    if job.status not in ('failed', 'cancelled'):
+        return jsonify({"error": f"Job is {job.status}, only failed or cancelled jobs can be resumed."}), 409
+    return job_accepted(jobs.resume(job))
+
+
+
+# ------------- Theme library -------------
+
+@views.route('/theme_sets', methods=['POST'])
+def create_theme_set():
+    """
+    Save a named theme set: {"name", "themes": {theme: [seeds]}}, or the
+    theme[i]/seeds[i] form fields used by /cluster. Saving changed seeds under
+    an existing name creates a new version; unchanged seeds return the
+    current one.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a JSON object with name and themes"}), 400
+    themes = data.get("themes")
+    seeds = data.get("seeds") or {}
+    try:
+        if isinstance(themes, dict) and any(key.startswith("theme[") for key in themes):
+            if not isinstance(seeds, dict) or not all(isinstance(v, str) for v in [*themes.values(), *seeds.values()]):
+                raise ThemeSetError("theme[i] and seeds[i] fields must be strings")
+            themes = parse_theme_seeds(themes, seeds)
+        theme_set, created = save_theme_set(data.get("name"), themes)
+    except ThemeSetError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(theme_set_to_dict(theme_set)), 201 if created else 200
+
+
+@views.route('/theme_sets', methods=['GET'])
+def list_theme_sets():
+    # Every version, newest first; ?name= narrows it to one set
+    query = ThemeSet.query
+    if request.args.get('name'):
+        query = query.filter_by(name=request.args['name'])
+    theme_sets = query.order_by(ThemeSet.name, ThemeSet.version.desc()).all()
+    return jsonify({"theme_sets": [theme_set_to_dict(ts) for ts in theme_sets]})
+
+
+@views.route('/theme_sets/<string:theme_set_id>', methods=['GET'])
+def get_theme_set(theme_set_id):
+    theme_set = ThemeSet.query.filter_by(public_id=theme_set_id).first()
+    if theme_set is None:
+        return jsonify({"error": "Theme set not found"}), 404
+    return jsonify(theme_set_to_dict(theme_set))
 
 
 @views.route('/suggest_seeds', methods=['POST'])
 def suggest_seeds():
     data = request.get_json()
     theme = data.get("theme", "")
+    use_cache = not data.get("force", False)
 
     if not theme:
         return jsonify({"error": "Theme is required"}), 400
 
     try:
-        seeds = generate_seed_words(theme)
+        seeds = generate_seed_words(theme, use_cache=use_cache)
+        db.session.commit()  # the LLM cache entry
         return jsonify({"seeds": seeds})
     except Exception as e:
         print("Seed suggestion error:", e)
@@ -259,40 +702,34 @@ def cluster_manual_codes():
     seed_dict = data.get("seeds", {})
 
     # Preprocess the codes
-    cleaned_codes = [c.strip().lower() for c in raw_codes if c.strip()]
-
-    # Reconstruct the theme_seeds dictionary
-    theme_seeds = {}
-    for idx in range(len(theme_dict)):
-        theme = theme_dict.get(f"theme[{idx}]")
-        seed_string = seed_dict.get(f"seeds[{idx}]", "")
-        seed_list = [s.strip().lower() for s in seed_string.split(",") if s.strip()]
-        if theme:
-            theme_seeds[theme] = seed_list
+    cleaned_codes = [normalize_text(c) for c in raw_codes if c.strip()]
+
+    # A saved theme set brings its own seed centroids; otherwise rebuild the theme_seeds dictionary
+    theme_set = None
+    centers = None
+    if data.get("theme_set_id"):
+        theme_set = ThemeSet.query.filter_by(public_id=data["theme_set_id"]).first()
+        if theme_set is None:
+            return jsonify({"error": "Theme set not found"}), 404
+        theme_seeds, centers = theme_set.themes, theme_centers(theme_set)
+    else:
+        theme_seeds = parse_theme_seeds(theme_dict, seed_dict)
 
     # Run clustering
-    result, scatter_plot, bar_chart, word_cloud = define_themes(cleaned_codes, theme_seeds)
+    with metrics.trace() as timings:
+        result, plot_data, state = cluster_codewords(Counter(cleaned_codes), theme_seeds, theme_centers=centers)
 
     new_submission = Submission(upload_type='manual')
     db.session.add(new_submission)
     db.session.commit()
 
-    cluster_result = ClusterResult(
-    submission_id=new_submission.id,
-    results=json.dumps(result),
-    scatter_plot=scatter_plot,
-    bar_chart=bar_chart,
-    word_cloud=word_cloud
-)
-
-    db.session.add(cluster_result)
+    cluster_result = save_cluster_result(new_submission.id, result, plot_data, theme_seeds, state, timings,
+                                         theme_set_id=theme_set.id if theme_set else None)
     db.session.commit()
 
     return jsonify({ 
         "result": result,
-        "scatter_plot": scatter_plot,
-        "bar_chart": bar_chart,
-        "word_cloud": word_cloud,
+        **plot_urls(new_submission, cluster_result),
         "status": "success",
         "public_id": new_submission.public_id 
     })
@@ -0,0 +1,89 @@
+"""
+Exact (KMeans + PCA) vs streaming (MiniBatchKMeans + IncrementalPCA) clustering
+on synthetic embeddings, to find where CLUSTER_LARGE_THRESHOLD should sit.
+
+    python benchmarks/bench_clustering.py --sizes 1000 10000 50000 100000
+
+Embeddings are generated chunk by chunk from a fixed seed, so the streaming
+backend never holds the full matrix while the exact one has to build it.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.thematic_analysis.clustering import fit_exact, fit_streaming, CLUSTER_CHUNK_SIZE  # noqa: E402
+
+
+DIM = 384  # all-MiniLM-L6-v2
+N_THEMES = 6
+
+
+def theme_centers(rng):
+    centers = rng.normal(size=(N_THEMES, DIM))
+    return centers / np.linalg.norm(centers, axis=1, keepdims=True)
+
+
+def synthetic_chunks(n_items, centers, chunk_size, seed=0):
+    # Deterministic per chunk, so every pass over the data sees the same points
+    def chunks():
+        for i, start in enumerate(range(0, n_items, chunk_size)):
+            rng = np.random.default_rng((seed, i))
+            size = min(chunk_size, n_items - start)
+            labels = rng.integers(0, N_THEMES, size)
+            points = centers[labels] + rng.normal(scale=0.9 / np.sqrt(DIM) * 4, size=(size, DIM))
+            yield (points / np.linalg.norm(points, axis=1, keepdims=True)).astype(np.float32)
+    return chunks
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000, 50000, 100000])
+    parser.add_argument('--chunk-size', type=int, default=CLUSTER_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    true_centers = theme_centers(rng)
+    # Seeds sit near, not on, the true centres, like real seed words
+    seeds = true_centers + rng.normal(scale=0.05, size=true_centers.shape)
+
+    print(f"{'n':>8} {'exact s':>9} {'stream s':>9} {'exact MB':>9} {'stream MB':>10} {'agree':>6}")
+    rows = []
+    for n in args.sizes:
+        chunks = synthetic_chunks(n, true_centers, args.chunk_size)
+
+        exact, exact_s, exact_peak = measure(lambda: fit_exact(np.concatenate(list(chunks())), seeds))
+        stream, stream_s, stream_peak = measure(lambda: fit_streaming(chunks, seeds))
+        agree = float(np.mean(exact["labels"] == stream["labels"]))
+
+        print(f"{n:>8} {exact_s:>9.2f} {stream_s:>9.2f} {exact_peak / 2**20:>9.1f} {stream_peak / 2**20:>10.1f} {agree:>6.3f}")
+        rows.append((n, stream_s < exact_s, stream_peak < exact_peak))
+
+    print()
+    for label, column in (("faster", 1), ("lighter on memory", 2)):
+        # Crossover: the smallest size from which streaming wins at every larger size too
+        crossover = next((n for i, (n, *_) in enumerate(rows) if all(r[column] for r in rows[i:])), None)
+        if crossover is None:
+            print(f"Streaming is never consistently {label} in this range.")
+        else:
+            print(f"Streaming is {label} from n={crossover} on.")
+    print("Set CLUSTER_LARGE_THRESHOLD near the crossover that matters for your deployment.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Database round trips for the /generate and /approve_codewords write paths:
+the old per-row ORM code against the bulk helpers in thematic_analysis.utils.
+
+    python benchmarks/bench_db_writes.py --sizes 100 1000 10000
+    DATABASE_URL=postgresql://... python benchmarks/bench_db_writes.py
+
+A round trip is one cursor execute as seen by SQLAlchemy's
+before_cursor_execute event (an executemany counts once). Defaults to an
+in-memory SQLite database; point DATABASE_URL at Postgres to see the network
+cost as well.
+
+SQLite cannot promise the order of RETURNING rows from a multi-row INSERT, so
+SQLAlchemy still sends the ordered bulk insert one row per statement there
+(only the ORM overhead goes away). On Postgres it becomes one statement per
+1000 rows.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from sqlalchemy import event  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from app.models import Submission, Feedback  # noqa: E402
+from app.thematic_analysis.utils import insert_feedback, approve_feedback  # noqa: E402
+
+
+class RoundTrips:
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def measure(counter, fn):
+    db.session.commit()
+    counter.count = 0
+    start = time.perf_counter()
+    fn()
+    db.session.commit()
+    return counter.count, time.perf_counter() - start
+
+
+# The write paths as they were before the bulk helpers
+
+def legacy_insert(submission_id, texts, codewords):
+    for text, words in zip(texts, codewords):
+        feedback = Feedback(feedback_text=text, codewords=words, submission_id=submission_id)
+        db.session.add(feedback)
+        db.session.flush()
+
+
+def legacy_approve(entries):
+    for entry in entries:
+        feedback = db.session.get(Feedback, entry["feedback_id"])
+        if feedback:
+            feedback.codewords = ','.join(entry["codewords"])
+            feedback.approved = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        counter = RoundTrips(db.engine)
+
+        print(f"database: {db.engine.dialect.name}")
+        print(f"{'rows':>7} {'path':<18} {'before':>16} {'after':>16}")
+        for n in args.sizes:
+            texts = [f"feedback {i}" for i in range(n)]
+            codewords = ["code a,code b"] * n
+            submissions = [Submission(upload_type='file') for _ in range(2)]
+            db.session.add_all(submissions)
+            db.session.commit()
+            old_sub, new_sub = [s.id for s in submissions]
+
+            old_insert = measure(counter, lambda: legacy_insert(old_sub, texts, codewords))
+            new_insert = measure(counter, lambda: insert_feedback(new_sub, texts, codewords))
+
+            def entries(submission_id):
+                ids = [fid for (fid,) in db.session.query(Feedback.id).filter_by(submission_id=submission_id)]
+                return [{"feedback_id": fid, "codewords": ["approved code"]} for fid in ids]
+
+            old_entries, new_entries = entries(old_sub), entries(new_sub)
+            db.session.expunge_all()  # the old endpoint started from an empty session too
+            old_approve = measure(counter, lambda: legacy_approve(old_entries))
+            new_approve = measure(counter, lambda: approve_feedback(new_entries))
+
+            for path, old, new in (("insert feedback", old_insert, new_insert),
+                                   ("approve codewords", old_approve, new_approve)):
+                print(f"{n:>7} {path:<18} {old[0]:>6} ({old[1]:6.2f}s) {new[0]:>6} ({new[1]:6.2f}s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Throughput and accuracy of the CPU embedding backends (EMBEDDING_BACKEND):
+torch, onnx and quantized (dynamic int8), with torch as the reference.
+
+    python benchmarks/bench_embeddings.py                        # 5000 synthetic codewords, every backend
+    python benchmarks/bench_embeddings.py --backends torch onnx --batch-sizes 32 64 128 --threads 4
+
+Runs offline, so the model must be in the local Hugging Face cache; the
+onnx backend also needs pip install "sentence-transformers[onnx]". Texts go
+straight to the model, bypassing the embedding cache.
+
+Accuracy is the mean and minimum cosine similarity to the torch vectors,
+and cluster agreement: the share of codewords that K-means, seeded from the
+benchmark themes, puts in the same theme as it does with torch embeddings.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from app.thematic_analysis import embeddings  # noqa: E402
+from app.thematic_analysis.clustering import fit_kmeans, group_centroids  # noqa: E402
+from bench_pipeline import THEMES, synthetic_corpus  # noqa: E402
+
+
+def unit(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-9)
+
+
+def throughput(model, texts, batch_size, repeats):
+    # Best of `repeats` full passes, in texts per second
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        vectors = model.encode(texts, batch_size=batch_size, convert_to_numpy=True)
+        best = min(best, time.perf_counter() - start)
+    return unit(vectors), len(texts) / best
+
+
+def theme_labels(model, word_vectors):
+    # Seeded K-means as define_themes runs it: seed centroids per theme as the initial centres
+    seeds = [seed for words in THEMES.values() for seed in words[:3]]
+    owner = np.repeat(np.arange(len(THEMES)), 3)
+    centers = group_centroids(unit(model.encode(seeds, convert_to_numpy=True)), owner, len(THEMES))
+    return fit_kmeans(word_vectors, centers).labels_
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--texts', type=int, default=5000, help="number of synthetic codewords")
+    parser.add_argument('--backends', nargs='+', choices=embeddings.BACKENDS, default=list(embeddings.BACKENDS))
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[16, 32, 64, 128])
+    parser.add_argument('--threads', type=int, default=0, help="intra-op threads (0 = library default)")
+    parser.add_argument('--repeats', type=int, default=2)
+    parser.add_argument('--model', default=embeddings.DEFAULT_MODEL)
+    parser.add_argument('--output', help="write the results as JSON")
+    args = parser.parse_args()
+
+    embeddings.EMBEDDING_THREADS = args.threads
+    texts, _ = synthetic_corpus(args.texts)
+    backends = ['torch'] + [b for b in args.backends if b != 'torch']  # torch first: it is the reference
+
+    results = {}
+    reference = reference_labels = None
+    for backend in backends:
+        start = time.perf_counter()
+        model = embeddings.load_model(args.model, backend=backend)
+        load_s = time.perf_counter() - start
+        model.encode(['warm up'])
+
+        rates = {}
+        for batch_size in args.batch_sizes:
+            vectors, rates[batch_size] = throughput(model, texts, batch_size, args.repeats)
+        labels = theme_labels(model, vectors)
+        if reference is None:
+            reference, reference_labels = vectors, labels
+
+        cosines = (vectors * reference).sum(axis=1)
+        results[backend] = {
+            "load_s": round(load_s, 2),
+            "texts_per_s": {str(b): round(r, 1) for b, r in rates.items()},
+            "mean_cosine": round(float(cosines.mean()), 5),
+            "min_cosine": round(float(cosines.min()), 5),
+            "cluster_agreement": round(float((labels == reference_labels).mean()), 4),
+        }
+        del model
+
+    header = f"{'backend':<10} {'load s':>7} " + ' '.join(f"{'bs ' + str(b):>9}" for b in args.batch_sizes)
+    print(f"{args.texts} texts, texts/s per batch size, threads={args.threads or 'default'}")
+    print(header + f" {'speedup':>8} {'mean cos':>9} {'min cos':>8} {'agree':>7}")
+    base = max(results['torch']["texts_per_s"].values())
+    for backend, result in results.items():
+        rates = result["texts_per_s"]
+        print(f"{backend:<10} {result['load_s']:>7.2f} " + ' '.join(f"{rates[str(b)]:>9.1f}" for b in args.batch_sizes)
+              + f" {max(rates.values()) / base:>7.2f}x {result['mean_cosine']:>9.5f} {result['min_cosine']:>8.5f}"
+              + f" {result['cluster_agreement']:>7.2%}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"texts": args.texts, "threads": args.threads, "model": args.model, "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+Stage-by-stage benchmark of the clustering pipeline on synthetic corpora:
+encoding, codeword canonicalization, K-means, PCA, the full define_themes call, each plot and the JSON
+that gets stored and served.
+
+    python benchmarks/bench_pipeline.py                         # 100, 1k, 10k, 100k codewords
+    python benchmarks/bench_pipeline.py --sizes 1000 10000 --compare benchmarks/results/pipeline-abc1234.json
+
+Runs offline. By default a deterministic stub stands in for the embedding
+model (bag of hashed word vectors, so codewords sharing words with a seed
+land near it); --model cached uses the real SentenceTransformer from the
+local Hugging Face cache instead.
+
+Results are written as JSON (default benchmarks/results/pipeline-<commit>.json)
+so two commits can be compared with --compare. Peak memory is the tracemalloc
+peak of each stage, which includes NumPy buffers; the run's peak RSS is
+recorded as well.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import zlib
+from collections import Counter
+from datetime import datetime, timezone
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ.setdefault('HF_HUB_OFFLINE', '1')
+
+from app.thematic_analysis import embeddings  # noqa: E402
+from app.thematic_analysis.canonical import canonicalize  # noqa: E402
+from app.thematic_analysis.clustering import (  # noqa: E402
+    choose_backend, fit_kmeans, fit_pca, fit_streaming, group_centroids
+)
+from app.thematic_analysis.core import define_themes, embedding_chunks  # noqa: E402
+from app.thematic_analysis.plots import PLOT_KINDS, render_plot, scatter_points  # noqa: E402
+
+
+DIM = 384  # all-MiniLM-L6-v2
+
+THEMES = {
+    "Teaching": ["lectures", "explanations", "professor", "examples", "slides", "pacing", "teaching", "clarity"],
+    "Labs": ["labs", "equipment", "experiments", "lab manual", "lab sessions", "safety", "lab reports", "setup"],
+    "Assessment": ["exams", "grading", "quizzes", "feedback", "rubrics", "deadlines", "marks", "assignments"],
+    "Support": ["ta", "office hours", "tutors", "forum", "help", "email replies", "mentoring", "support"],
+    "Workload": ["workload", "homework", "projects", "reading", "time pressure", "stress", "hours", "coursework"],
+    "Community": ["group work", "classmates", "discussion", "teamwork", "inclusion", "peers", "collaboration", "belonging"],
+}
+INTENSITY = ["", "very", "somewhat", "often", "rarely", "always", "sometimes", "mostly"]
+MODIFIERS = ["unclear", "helpful", "slow", "engaging", "confusing", "fair", "heavy", "useful", "rushed", "boring",
+             "excellent", "inconsistent", "supportive", "stressful", "late", "clear", "poor", "motivating",
+             "overwhelming", "well organised", "frustrating", "valuable", "missing", "outdated", "flexible"]
+CONTEXTS = ["", "in week one", "before midterms", "after exams", "online", "in person", "for beginners",
+            "for group projects", "at the end", "during labs", "overall", "each week", "on weekends",
+            "for assignments", "in tutorials", "near deadlines", "this term", "for revision"]
+
+
+class StubEncoder:
+    """
+    Offline stand-in for SentenceTransformer: sum of per-word random vectors,
+    seeded by the word, normalized. Same text always gives the same vector.
+    """
+
+    def __init__(self, dim=DIM):
+        self.dim = dim
+        self._words = {}
+
+    def _word_vector(self, word):
+        vector = self._words.get(word)
+        if vector is None:
+            vector = np.random.default_rng(zlib.crc32(word.encode())).normal(size=self.dim).astype(np.float32)
+            self._words[word] = vector
+        return vector
+
+    def encode(self, texts, convert_to_numpy=True, **kwargs):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.lower().split():
+                out[i] += self._word_vector(word)
+        return out / np.maximum(np.linalg.norm(out, axis=1, keepdims=True), 1e-9)
+
+
+def synthetic_corpus(n, seed=0):
+    # n distinct codewords "[<intensity>] <modifier> <topic> [<context>]" plus {theme: seed words}
+    rng = np.random.default_rng(seed)
+    topics = [topic for words in THEMES.values() for topic in words]
+    parts = (INTENSITY, MODIFIERS, topics, CONTEXTS)
+    combinations = int(np.prod([len(p) for p in parts]))
+    if n > combinations:
+        raise ValueError(f"At most {combinations} distinct synthetic codewords")
+
+    picks = np.unravel_index(rng.choice(combinations, size=n, replace=False), [len(p) for p in parts])
+    codewords = [
+        ' '.join(filter(None, (part[i] for part, i in zip(parts, indices))))
+        for indices in zip(*picks)
+    ]
+
+    theme_seeds = {theme: words[:3] for theme, words in THEMES.items()}
+    return codewords, theme_seeds
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class Stages:
+
+    def __init__(self):
+        self.results = {}
+
+    def run(self, name, fn):
+        tracemalloc.start()
+        start = time.perf_counter()
+        value = fn()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.results[name] = {"seconds": round(elapsed, 4), "peak_mb": round(peak / 2**20, 2)}
+        return value
+
+
+def bench_size(n, backend, preset):
+    codewords, theme_seeds = synthetic_corpus(n)
+    themes = list(theme_seeds)
+    seeds = [seed for theme in themes for seed in theme_seeds[theme]]
+    seed_owner = np.repeat(np.arange(len(themes)), [len(theme_seeds[t]) for t in themes])
+    stages = Stages()
+    chosen = choose_backend(n, backend)
+
+    # Pieces of define_themes, timed one by one (the embedding cache is cleared first)
+    embeddings.clear_memory_cache()
+    word_embeddings = stages.run("encode", lambda: embeddings.encode(codewords))
+    seed_embeddings = stages.run("encode_seeds", lambda: embeddings.encode(seeds))
+    # Synthetic codewords are all distinct, so this measures the cost of the merge pass, not its savings
+    stages.run("canonicalize", lambda: canonicalize(Counter(codewords), streaming=chosen == 'streaming'))
+    centers = group_centroids(seed_embeddings, seed_owner, len(themes))
+    if chosen == 'exact':
+        stages.run("kmeans", lambda: fit_kmeans(word_embeddings, centers))
+        stages.run("pca", lambda: fit_pca(word_embeddings))
+    else:
+        # K-means and PCA are fitted together, chunk by chunk
+        stages.run("kmeans+pca (streaming)", lambda: fit_streaming(lambda: embedding_chunks(codewords), centers))
+    word_embeddings = None  # free it before the end-to-end run
+
+    # The real entry point end to end, embeddings already cached
+    clustered, plot_data, _ = stages.run("define_themes (cached)",
+                                         lambda: define_themes(list(codewords), theme_seeds, backend=chosen))
+
+    for kind in PLOT_KINDS:
+        stages.run(f"plot:{kind}", lambda: render_plot(kind, plot_data, preset))
+
+    # What save_cluster_result stores and the results/scatter endpoints serve
+    stages.run("json:results", lambda: json.dumps(clustered))
+    stages.run("json:plot_data", lambda: json.dumps(plot_data))
+    stages.run("json:scatter", lambda: json.dumps(scatter_points(plot_data)))
+
+    return {"n": n, "backend": chosen, "stages": stages.results,
+            "total_seconds": round(sum(s["seconds"] for s in stages.results.values()), 4),
+            "peak_mb": max(s["peak_mb"] for s in stages.results.values())}
+
+
+def print_table(run, baseline=None):
+    base = {r["n"]: r for r in (baseline or {}).get("results", [])}
+    for result in run["results"]:
+        print(f"\nn={result['n']} ({result['backend']})")
+        print(f"  {'stage':<24} {'seconds':>9} {'peak MB':>9}" + (f" {'vs base':>9}" if base else ""))
+        for name, stage in result["stages"].items():
+            line = f"  {name:<24} {stage['seconds']:>9.3f} {stage['peak_mb']:>9.1f}"
+            before = base.get(result["n"], {}).get("stages", {}).get(name)
+            if before and before["seconds"] > 0:
+                line += f" {stage['seconds'] / before['seconds']:>8.2f}x"
+            print(line)
+        print(f"  {'total':<24} {result['total_seconds']:>9.3f} {result['peak_mb']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--model', choices=['stub', 'cached'], default='stub')
+    parser.add_argument('--backend', choices=['auto', 'exact', 'streaming'], default='auto')
+    parser.add_argument('--preset', default='full', help="plot size preset (full or thumb)")
+    parser.add_argument('--output', help="JSON results path (default benchmarks/results/pipeline-<commit>.json)")
+    parser.add_argument('--compare', help="earlier results JSON to show per-stage ratios against")
+    args = parser.parse_args()
+
+    if args.model == 'stub':
+        embeddings.register_model(StubEncoder())
+    else:
+        embeddings.warm_up()
+
+    commit = git_commit()
+    run = {
+        "meta": {
+            "commit": commit,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "model": args.model if args.model == 'stub' else embeddings.DEFAULT_MODEL,
+            "backend": args.backend,
+            "preset": args.preset,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": [bench_size(n, args.backend, args.preset) for n in args.sizes],
+    }
+
+    # Peak RSS of the whole run, which also covers allocations tracemalloc can't see (e.g. Agg buffers)
+    import resource
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run["meta"]["max_rss_mb"] = round(max_rss / (2**20 if sys.platform == 'darwin' else 2**10), 1)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_table(run, baseline)
+
+    output = args.output or os.path.join(BACKEND_DIR, 'benchmarks', 'results', f'pipeline-{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(run, f, indent=2)
+    print(f"\nWrote {output}")
+
+
+if __name__ == '__main__':
+    main()
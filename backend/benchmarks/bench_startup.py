@@ -0,0 +1,79 @@
+"""
+Startup-time regression check: how long a fresh interpreter takes to build the
+app and answer its first request, and which heavy libraries that pulled in.
+
+    python benchmarks/bench_startup.py                  # 5 runs, 2 s budget
+    python benchmarks/bench_startup.py --runs 10 --max-seconds 1.5
+
+Exits with status 1 when the median exceeds --max-seconds or when a heavy
+module (torch, sentence_transformers, sklearn, matplotlib, seaborn, pandas,
+openai) is imported at startup, so it can run as a CI step. Those libraries
+must only load on first use; see the lazy imports in app/thematic_analysis.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ("torch", "sentence_transformers", "sklearn", "matplotlib", "seaborn", "pandas", "openai", "scipy")
+
+# Runs in a fresh interpreter, so nothing is cached between measurements
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+from main import app
+created = time.perf_counter()
+response = app.test_client().get('/api/debug')
+answered = time.perf_counter()
+print(json.dumps({
+    "create_app_s": created - start,
+    "first_request_s": answered - created,
+    "total_s": answered - start,
+    "status": response.status_code,
+    "heavy_modules": [m for m in %r if m in sys.modules],
+}))
+""" % (HEAVY_MODULES,)
+
+
+def probe():
+    env = dict(os.environ, EMBEDDING_WARMUP='0')
+    env.setdefault('DATABASE_URL', 'sqlite://')
+    output = subprocess.run([sys.executable, '-c', PROBE], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=2.0, help="budget for the median total")
+    args = parser.parse_args()
+
+    runs = [probe() for _ in range(args.runs)]
+    for key in ("create_app_s", "first_request_s", "total_s"):
+        values = [run[key] for run in runs]
+        print(f"{key:<16} median {statistics.median(values):.3f}s  min {min(values):.3f}s  max {max(values):.3f}s")
+
+    failures = []
+    heavy = sorted({m for run in runs for m in run["heavy_modules"]})
+    if heavy:
+        failures.append(f"heavy modules imported at startup: {', '.join(heavy)}")
+    if any(run["status"] != 200 for run in runs):
+        failures.append("/api/debug did not answer 200")
+    median_total = statistics.median(run["total_s"] for run in runs)
+    if median_total > args.max_seconds:
+        failures.append(f"median startup {median_total:.3f}s is over the {args.max_seconds:.1f}s budget")
+
+    for failure in failures:
+        print("FAIL:", failure)
+    if not failures:
+        print("OK")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
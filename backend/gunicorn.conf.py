@@ -0,0 +1,50 @@
+# gunicorn -c gunicorn.conf.py
+#
+# Preload mode (default) imports the app, the heavy libraries and the embedding
+# model once in the master process before forking, so every worker shares
+# their pages copy-on-write instead of holding its own copy. Set
+# GUNICORN_PRELOAD=0 to have each worker load the app itself (e.g. for --reload
+# during development).
+import os
+
+wsgi_app = 'main:app'
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))  # synchronous /generate waits on OpenAI
+
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+preload_model = preload_app and os.getenv('EMBEDDING_PRELOAD', '1') == '1'
+
+if preload_model:
+    # The master only loads the weights. Running an encode there would start
+    # torch's thread pools, which do not survive a fork; workers warm up instead.
+    os.environ['EMBEDDING_WARMUP'] = '0'
+
+
+def on_starting(server):
+    if preload_app:
+        # The app imports these lazily; importing them once here shares them with every worker
+        import matplotlib.figure  # noqa: F401
+        import seaborn  # noqa: F401
+        import sklearn.cluster  # noqa: F401
+        import sklearn.decomposition  # noqa: F401
+    if preload_model:
+        from app.thematic_analysis.embeddings import get_model
+        get_model()
+        server.log.info("Embedding model loaded in the master; workers share it copy-on-write")
+
+
+def post_fork(server, worker):
+    if not preload_app:
+        return
+    from main import app
+    from app import db
+
+    # Never reuse DB connections inherited from the master
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+    if preload_model:
+        from app.thematic_analysis.embeddings import get_model
+        get_model().encode(['warm up'])
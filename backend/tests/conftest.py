@@ -0,0 +1,53 @@
+import zlib
+
+import numpy as np
+import pytest
+
+from app import create_app, db
+from app.thematic_analysis.embeddings import clear_memory_cache, register_model
+
+
+class StubEncoder:
+    """
+    Offline stand-in for the SentenceTransformer: texts listed in `vectors`
+    get that vector, any other text a random one seeded by its crc32.
+    """
+
+    def __init__(self, vectors=None, dim=8):
+        self.vectors = {text: np.asarray(v, dtype=np.float32) for text, v in (vectors or {}).items()}
+        self.dim = len(next(iter(self.vectors.values()))) if self.vectors else dim
+        self.calls = []
+
+    def encode(self, texts, **kwargs):
+        self.calls.append(list(texts))
+        return np.stack([self.vectors[t] if t in self.vectors else self._random(t) for t in texts])
+
+    def _random(self, text):
+        return np.random.default_rng(zlib.crc32(text.encode('utf-8'))).standard_normal(self.dim).astype(np.float32)
+
+
+@pytest.fixture
+def stub_encoder():
+    """Install a StubEncoder as the shared model; tests fill in .vectors as needed."""
+    def install(vectors=None, dim=8):
+        clear_memory_cache()
+        return register_model(StubEncoder(vectors, dim))
+    yield install
+    clear_memory_cache()
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', 'sqlite://')
+    app = create_app()
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,102 @@
+import json
+
+import numpy as np
+import pytest
+
+from app import db
+from app.models import PlotImage, Submission
+from app.thematic_analysis.clustering import cosine_matrix, group_centroids, unpack_state
+from app.thematic_analysis.core import cluster_codewords
+from app.thematic_analysis.utils import append_to_cluster_result, save_cluster_result
+
+
+THEMES = {"Labs": ["lab"], "Grading": ["grading"]}
+
+VECTORS = {
+    "lab": [1, 0, 0, 0],
+    "grading": [0, 1, 0, 0],
+    "great labs": [0.9, 0.1, 0.3, 0],
+    "labs were great": [0.9, 0.1, 0.34, 0.02],  # merged into "great labs"
+    "lab equipment broke": [0.8, 0.2, -0.4, 0.3],
+    "slow grading": [0.1, 0.9, 0, 0.3],
+    "late marks": [0.2, 0.8, -0.2, -0.3],
+    # Appended later
+    "broken equipment": [0.85, 0.05, -0.3, 0.4],
+    "marking delays": [0.15, 0.85, -0.1, -0.4],
+}
+
+
+@pytest.fixture
+def cluster_result(app, stub_encoder):
+    stub_encoder(VECTORS)
+    submission = Submission(upload_type='file')
+    db.session.add(submission)
+    db.session.commit()
+
+    counts = {"great labs": 3, "labs were great": 1, "lab equipment broke": 1, "slow grading": 2, "late marks": 1}
+    clustered, plot_data, state = cluster_codewords(counts, THEMES, backend='exact')
+    cluster_result = save_cluster_result(submission.id, clustered, plot_data, THEMES, state)
+    db.session.flush()
+    cluster_result.plots = [PlotImage(kind='bar', preset='full', content_hash='0' * 64, image=b'png')]
+    db.session.commit()
+    return cluster_result
+
+
+def by_word(plot_data):
+    return {word: (label, count, coords) for word, label, count, coords in
+            zip(plot_data["words"], plot_data["labels"], plot_data["counts"], plot_data["coords"])}
+
+
+def test_append_updates_known_and_aliased_codes_and_adds_new_ones(cluster_result):
+    assert cluster_result.plot_data["aliases"] == {"great labs": ["labs were great"]}
+    before = by_word(cluster_result.plot_data)
+    version = cluster_result.version
+
+    added = append_to_cluster_result(cluster_result, ["great labs", "labs were great", "slow grading",
+                                                      "broken equipment", "broken equipment", "marking delays"])
+    db.session.commit()
+
+    assert added == {"Labs": ["broken equipment"], "Grading": ["marking delays"]}
+    plot_data = cluster_result.plot_data
+    after = by_word(plot_data)
+    assert after["great labs"][1] == before["great labs"][1] + 2  # once directly, once through its alias
+    assert after["slow grading"][1] == before["slow grading"][1] + 1
+    assert after["late marks"] == before["late marks"]
+    assert after["broken equipment"][:2] == (plot_data["themes"].index("Labs"), 2)
+    assert after["marking delays"][:2] == (plot_data["themes"].index("Grading"), 1)
+    assert len(plot_data["coords"]) == len(plot_data["words"]) == len(plot_data["labels"]) == 6
+
+    # New points are projected with the stored PCA basis
+    state = unpack_state(cluster_result.model_state)
+    expected = (np.asarray(VECTORS["marking delays"]) - state["pca_mean"]) @ state["pca_components"].T
+    assert after["marking delays"][2] == pytest.approx(expected.tolist(), abs=1e-4)
+
+    clustered = json.loads(cluster_result.results)
+    assert "broken equipment" in clustered["Labs"] and "marking delays" in clustered["Grading"]
+
+    assert cluster_result.version == version + 1
+    assert cluster_result.plots == []
+    assert PlotImage.query.count() == 0
+
+
+def test_append_keeps_the_overlap_of_every_code_from_the_running_sums(cluster_result):
+    append_to_cluster_result(cluster_result, ["broken equipment", "marking delays"])
+    plot_data = cluster_result.plot_data
+
+    # Same heatmap as one computed from the embeddings of every code in the result
+    embeddings = np.asarray([VECTORS[w] for w in plot_data["words"]], dtype=np.float64)
+    centroids = group_centroids(embeddings, plot_data["labels"], len(plot_data["themes"]))
+    assert plot_data["overlap_themes"] == plot_data["themes"]
+    assert np.asarray(plot_data["overlap"]) == pytest.approx(cosine_matrix(centroids), abs=1e-4)
+
+    state = unpack_state(cluster_result.model_state)
+    assert state["counts"].tolist() == [3, 3]
+
+
+def test_append_of_known_codes_only_updates_counts(cluster_result):
+    words, version = list(cluster_result.plot_data["words"]), cluster_result.version
+    assert append_to_cluster_result(cluster_result, ["late marks"]) == {}
+    assert cluster_result.plot_data["words"] == words
+    assert by_word(cluster_result.plot_data)["late marks"][1] == 2
+    assert cluster_result.version == version + 1
+    assert cluster_result.plots == []
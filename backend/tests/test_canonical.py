@@ -0,0 +1,72 @@
+import numpy as np
+
+from app.thematic_analysis.canonical import canonicalize
+
+
+def at_angle(degrees, axis=0, toward=1, dim=6):
+    # Unit vector `degrees` away from basis vector `axis`, rotated toward `toward`
+    vector = np.zeros(dim)
+    vector[axis] = np.cos(np.radians(degrees))
+    vector[toward] = np.sin(np.radians(degrees))
+    return vector
+
+
+VECTORS = {
+    "unclear instructions": at_angle(0),
+    "instructions were unclear": at_angle(15),      # cos 0.97 to "unclear instructions"
+    "clear instructions": at_angle(10, toward=2),   # cos 0.98, but the opposite meaning
+    "helpful ta": at_angle(0, axis=3, toward=4),
+    "unhelpful ta": at_angle(12, axis=3, toward=4),  # cos 0.98
+    "slow grading": at_angle(0, axis=5, toward=4),
+    "grading was slow": at_angle(25, axis=5, toward=4),        # cos 0.91 to "slow grading"
+    "late feedback on grades": at_angle(50, axis=5, toward=4),  # cos 0.91 to "grading was slow", 0.64 to "slow grading"
+}
+
+
+def test_merges_near_synonyms_into_the_most_frequent_code(stub_encoder):
+    stub_encoder(VECTORS)
+    codes, counts, aliases = canonicalize(
+        {"instructions were unclear": 2, "unclear instructions": 5, "helpful ta": 3}, threshold=0.88)
+    assert codes == ["unclear instructions", "helpful ta"]
+    assert counts == [7, 3]
+    assert aliases == {"unclear instructions": ["instructions were unclear"]}
+
+
+def test_never_merges_negated_or_opposite_codes(stub_encoder):
+    stub_encoder(VECTORS)
+    codeword_counts = {"unclear instructions": 4, "clear instructions": 3, "helpful ta": 2, "unhelpful ta": 1}
+    codes, counts, aliases = canonicalize(codeword_counts, threshold=0.88)
+    assert codes == list(codeword_counts)
+    assert counts == [4, 3, 2, 1]
+    assert aliases == {}
+
+
+def test_members_must_be_similar_to_the_canonical_code_itself(stub_encoder):
+    stub_encoder(VECTORS)
+    codes, counts, aliases = canonicalize(
+        {"slow grading": 5, "grading was slow": 2, "late feedback on grades": 1}, threshold=0.88)
+    assert codes == ["slow grading", "late feedback on grades"]
+    assert counts == [7, 1]
+    assert aliases == {"slow grading": ["grading was slow"]}
+
+
+def test_aliases_list_every_merged_spelling_by_frequency(stub_encoder):
+    vectors = dict(VECTORS, **{"instructions unclear": at_angle(5), "the instructions were unclear": at_angle(8)})
+    stub_encoder(vectors)
+    codes, counts, aliases = canonicalize(
+        {"instructions unclear": 1, "instructions were unclear": 3, "unclear instructions": 6,
+         "the instructions were unclear": 3, "clear instructions": 2}, threshold=0.88)
+    assert codes == ["unclear instructions", "clear instructions"]
+    assert counts == [13, 2]
+    assert aliases == {"unclear instructions": ["instructions were unclear", "the instructions were unclear",
+                                                "instructions unclear"]}
+
+
+def test_streaming_path_applies_the_same_rules(stub_encoder):
+    stub_encoder(VECTORS)
+    codeword_counts = {"unclear instructions": 5, "instructions were unclear": 2, "clear instructions": 3,
+                       "slow grading": 5, "grading was slow": 2, "late feedback on grades": 1}
+    codes, counts, aliases = canonicalize(codeword_counts, threshold=0.88, streaming=True)
+    assert dict(zip(codes, counts)) == {"unclear instructions": 7, "clear instructions": 3,
+                                        "slow grading": 7, "late feedback on grades": 1}
+    assert aliases == {"unclear instructions": ["instructions were unclear"], "slow grading": ["grading was slow"]}
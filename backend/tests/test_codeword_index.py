@@ -0,0 +1,41 @@
+import pytest
+
+from app import db
+from app.models import Feedback, Submission
+from app.thematic_analysis import codeword_index
+from app.thematic_analysis.utils import insert_feedback
+
+
+@pytest.fixture
+def indexed(app, stub_encoder, monkeypatch):
+    stub_encoder()
+    # The in-process index would otherwise still hold the previous test's rows
+    monkeypatch.setattr(codeword_index, '_index', codeword_index.CodewordIndex())
+
+    submissions = []
+    for codewords in (["slow grading"] * 30 + ["late marks"] * 5, ["slow grading"] * 3):
+        submission = Submission(upload_type='file')
+        db.session.add(submission)
+        db.session.commit()
+        insert_feedback(submission.id, [f"response {i}" for i in range(len(codewords))], codewords=codewords)
+        submissions.append(submission)
+    db.session.commit()
+    codeword_index.index_feedback(Feedback.query.all())
+    return submissions
+
+
+def test_feedback_count_covers_rows_outside_the_candidate_window(indexed, monkeypatch):
+    # One candidate row per result: the other 29 "slow grading" rows are never scored
+    monkeypatch.setattr(codeword_index, 'CANDIDATE_FACTOR', 1)
+    first, _ = indexed
+    results = codeword_index.search_similar("slow grading", k=1, submission_ids=[first.id])
+    assert [(r["codeword"], r["feedback_count"]) for r in results] == [("slow grading", 30)]
+
+
+def test_feedback_count_per_submission(indexed):
+    first, second = indexed
+    results = codeword_index.search_similar("slow grading", k=3)
+    counts = {(r["submission_id"], r["codeword"]): r["feedback_count"] for r in results}
+    assert counts == {(first.public_id, "slow grading"): 30, (second.public_id, "slow grading"): 3,
+                      (first.public_id, "late marks"): 5}
+    assert results[0]["score"] == pytest.approx(1.0, abs=1e-4)
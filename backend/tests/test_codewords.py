@@ -0,0 +1,82 @@
+from collections import Counter
+
+import pytest
+
+from app import db
+from app.models import Codeword, Feedback, Submission
+from app.thematic_analysis.utils import (
+    approve_feedback, backfill_codewords, get_codeword_counts, get_codewords, insert_feedback, sync_codewords
+)
+
+
+CODEWORDS = [
+    "Teamwork, leadership",
+    "teamwork ,  Leadership,TEAMWORK",  # repeated on one row: counted once for the row
+    "  time   management ",
+    "Time management,teamwork",
+    ",, ,",
+    "",
+    None,  # not coded yet
+]
+
+
+def counts_per_row(codewords_strings):
+    # The per-row split the codewords table replaced: each code counts once per feedback row
+    counts = Counter()
+    for value in codewords_strings:
+        counts.update({' '.join(w.lower().split()) for w in (value or '').split(',') if w.strip()})
+    return counts
+
+
+@pytest.fixture
+def submission(app):
+    submission = Submission(upload_type='file')
+    db.session.add(submission)
+    db.session.commit()
+    return submission
+
+
+def current_codewords(submission):
+    return [fb.codewords for fb in Feedback.query.filter_by(submission_id=submission.id)]
+
+
+def test_group_by_counts_match_the_per_row_split(submission):
+    rows = insert_feedback(submission.id, [f"response {i}" for i in range(len(CODEWORDS))], codewords=CODEWORDS)
+    sync_codewords(rows)
+    db.session.commit()
+
+    counts = get_codeword_counts(submission.id)
+    assert counts == counts_per_row(CODEWORDS)
+    assert counts == {"teamwork": 3, "leadership": 2, "time management": 2}
+    assert sorted(get_codewords(submission.id)) == sorted(counts)
+
+
+def test_edits_rewrite_the_rows_codewords(submission):
+    rows = insert_feedback(submission.id, ["a", "b", "c"], codewords=["teamwork", "teamwork, leadership", "slow grading"])
+    sync_codewords(rows)
+    db.session.commit()
+
+    first, second, _ = (row.id for row in rows)
+    sync_codewords(approve_feedback([
+        {"feedback_id": first, "codewords": ["Leadership", "clear goals"]},
+        {"feedback_id": second, "codewords": []},
+        {"feedback_id": 999999, "codewords": ["unknown row"]},
+    ]))
+    db.session.commit()
+
+    assert get_codeword_counts(submission.id) == counts_per_row(current_codewords(submission))
+    assert get_codeword_counts(submission.id) == {"leadership": 1, "clear goals": 1, "slow grading": 1}
+    assert Codeword.query.filter_by(feedback_id=second).count() == 0
+
+
+def test_backfill_fills_the_table_for_rows_saved_before_it(submission):
+    insert_feedback(submission.id, [f"response {i}" for i in range(len(CODEWORDS))], codewords=CODEWORDS)
+    db.session.commit()
+    assert get_codeword_counts(submission.id) == {}
+
+    assert backfill_codewords(chunk_size=3) == len(CODEWORDS)
+    assert get_codeword_counts(submission.id) == counts_per_row(CODEWORDS)
+
+    # Running it again rewrites rather than duplicates
+    backfill_codewords()
+    assert get_codeword_counts(submission.id) == counts_per_row(CODEWORDS)
@@ -0,0 +1,38 @@
+from app.thematic_analysis.dedup import (
+    DEDUP_THRESHOLD, _jaccard, _shingles, find_duplicates, normalize_feedback
+)
+
+
+# Pairs that share most character shingles but say opposite things
+OPPOSITE_PAIRS = [
+    ("The labs were helpful and the TA explained every exercise clearly.",
+     "The labs were not helpful and the TA explained every exercise clearly."),
+    ("I liked the weekly quizzes and the group project.",
+     "I disliked the weekly quizzes and the group project."),
+]
+
+
+def shingle_similarity(a, b):
+    return _jaccard(_shingles(normalize_feedback(a)), _shingles(normalize_feedback(b)))
+
+
+def test_opposite_pairs_look_like_near_duplicates():
+    # Guards the test below: character similarity alone would merge these
+    for a, b in OPPOSITE_PAIRS:
+        assert shingle_similarity(a, b) >= DEDUP_THRESHOLD
+
+
+def test_near_mode_never_merges_negated_or_opposite_responses():
+    for a, b in OPPOSITE_PAIRS:
+        assert find_duplicates([a, b], mode='near') == [0, 1]
+
+
+def test_default_mode_only_merges_case_and_whitespace_variants():
+    texts = ["The labs were great", "  the labs   were GREAT ", "The labs were great!", "The labs were not great"]
+    assert find_duplicates(texts) == [0, 0, 2, 3]
+
+
+def test_near_mode_still_merges_harmless_variants():
+    texts = ["The labs were great!!", "the labs were great", "The lab sessions were great, really",
+             "slow grading", "Slow grading."]
+    assert find_duplicates(texts, mode='near') == [0, 0, 2, 3, 3]
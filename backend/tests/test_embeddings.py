@@ -0,0 +1,9 @@
+from app.thematic_analysis.embeddings import DEFAULT_MODEL
+
+
+def test_debug_models_lists_registered_encoders_without_a_device(client, stub_encoder):
+    stub_encoder()  # only has .encode()
+    response = client.get('/api/debug/models')
+    assert response.status_code == 200
+    model = next(m for m in response.get_json()["models"] if m["name"] == DEFAULT_MODEL)
+    assert model["load_time_s"] == 0.0
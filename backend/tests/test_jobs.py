@@ -0,0 +1,60 @@
+import pytest
+
+from app import db, jobs
+from app.models import Feedback, Submission
+from app.thematic_analysis import llm_coding
+from app.thematic_analysis.utils import insert_feedback
+
+
+@pytest.fixture
+def submission(app):
+    submission = Submission(upload_type='file')
+    db.session.add(submission)
+    db.session.commit()
+    insert_feedback(submission.id, ["Labs were great", "labs were  GREAT", "Grading was slow",
+                                    "Too much homework", "Lectures were clear"])
+    db.session.commit()
+    return submission
+
+
+def fake_coder(fail_on=(), crash_after=None):
+    calls = []
+
+    def generate(texts, batch_size=None):
+        if crash_after is not None and len(calls) >= crash_after:
+            raise RuntimeError("worker lost")
+        calls.append(list(texts))
+        return [([], "timeout") if text in fail_on else ([text.lower()], None) for text in texts]
+    return generate
+
+
+def test_generate_result_holds_counts_and_errors_not_rows(client, submission, monkeypatch):
+    monkeypatch.setattr(llm_coding, 'generate_codewords_bulk', fake_coder(fail_on={"Grading was slow"}))
+    job = jobs.run_job(jobs.enqueue('generate', submission_id=submission.id))
+
+    failed_id = Feedback.query.filter_by(feedback_text="Grading was slow").one().id
+    assert job.status == 'done'
+    assert job.result == {"submission_id": submission.public_id, "rows": 5, "coded": 4, "duplicates": 1,
+                          "failed": 1, "errors": {str(failed_id): "timeout"}}
+
+    data = client.get(f'/api/jobs/{job.public_id}').get_json()
+    assert data["feedback_url"] == f'/api/submission/{submission.public_id}/feedback'
+    page = client.get(data["feedback_url"]).get_json()
+    assert len(page["feedback"]) == 5
+
+
+def test_errors_of_chunks_coded_before_a_restart_are_kept(app, submission, monkeypatch):
+    monkeypatch.setattr(jobs, 'GENERATE_CHUNK', 2)
+    monkeypatch.setattr(llm_coding, 'generate_codewords_bulk',
+                        fake_coder(fail_on={"Labs were great"}, crash_after=1))
+    job = jobs.run_job(jobs.enqueue('generate', submission_id=submission.id))
+    assert job.status == 'failed'
+
+    monkeypatch.setattr(llm_coding, 'generate_codewords_bulk', fake_coder(fail_on={"Lectures were clear"}))
+    job = jobs.run_job(jobs.resume(job))
+
+    failed = {fb.feedback_text: str(fb.id) for fb in Feedback.query.filter(
+        Feedback.feedback_text.in_(["Labs were great", "Lectures were clear"]))}
+    assert job.status == 'done'
+    assert job.result["errors"] == {failed["Labs were great"]: "timeout", failed["Lectures were clear"]: "timeout"}
+    assert job.result["failed"] == 2
@@ -0,0 +1,84 @@
+import pytest
+from sqlalchemy import insert
+
+from app import db
+from app.models import LLMCache, Submission
+from app.thematic_analysis import llm_cache
+
+
+MODEL, VERSION = "gpt-test", "v1"
+
+
+@pytest.fixture(autouse=True)
+def no_pending_hits():
+    # Hits tallied in memory refer to row ids of the previous test's database
+    llm_cache._touched.clear()
+
+
+def pending_submission():
+    # Work the request has not committed yet
+    submission = Submission(upload_type='file')
+    db.session.add(submission)
+    db.session.flush()
+    return submission.id
+
+
+def test_lookup_neither_commits_nor_writes(app):
+    llm_cache.store_many('codewords', MODEL, VERSION, [("Labs were great", ["labs"])])
+    db.session.commit()
+
+    submission_id = pending_submission()
+    assert llm_cache.lookup_many(MODEL, VERSION, ["labs were GREAT", "unseen"]) == {0: ["labs"]}
+    assert not db.session.dirty
+    db.session.rollback()
+    assert db.session.get(Submission, submission_id) is None
+    assert LLMCache.query.one().hits == 0
+
+    # The hit is written by the next store, together with its recency
+    llm_cache.store_many('codewords', MODEL, VERSION, [("Slow grading", ["grading"])])
+    db.session.commit()
+    assert LLMCache.query.filter_by(input_text="labs were great").one().hits == 1
+
+
+def test_store_leaves_committing_to_the_caller(app):
+    submission_id = pending_submission()
+    llm_cache.store_many('codewords', MODEL, VERSION, [("Labs were great", ["labs"])])
+    db.session.rollback()
+    assert db.session.get(Submission, submission_id) is None
+    assert LLMCache.query.count() == 0
+
+
+def test_a_key_conflict_keeps_the_rest_of_the_batch_and_the_callers_work(app, monkeypatch):
+    conflict = llm_cache.cache_key(MODEL, VERSION, "Slow grading")
+    upsert = llm_cache._upsert
+
+    def upsert_racing_another_worker(kind, model_name, prompt_version, by_key):
+        upsert(kind, model_name, prompt_version, by_key)
+        if conflict in by_key:
+            db.session.execute(insert(LLMCache).values(
+                cache_key=conflict, kind=kind, model_name=model_name, prompt_hash=prompt_version,
+                input_text="slow grading", response=["theirs"], hits=0))
+
+    monkeypatch.setattr(llm_cache, '_upsert', upsert_racing_another_worker)
+    submission_id = pending_submission()
+    llm_cache.store_many('codewords', MODEL, VERSION,
+                         [("Labs were great", ["labs"]), ("Slow grading", ["grading"]), ("Too long", ["length"])])
+    db.session.commit()
+
+    assert db.session.get(Submission, submission_id) is not None
+    stored = {entry.input_text for entry in LLMCache.query}
+    assert stored == {"labs were great", "too long"}
+
+
+def test_evict_drops_the_least_recently_used_without_committing(app, monkeypatch):
+    llm_cache.store_many('codewords', MODEL, VERSION, [("a", ["a"]), ("b", ["b"]), ("c", ["c"])])
+    db.session.commit()
+    llm_cache.lookup_many(MODEL, VERSION, ["a"])
+
+    monkeypatch.setattr(llm_cache, 'LLM_CACHE_MAX_ENTRIES', 1)
+    submission_id = pending_submission()
+    assert llm_cache.evict() == 2
+    assert [entry.input_text for entry in LLMCache.query] == ["a"]
+    db.session.rollback()
+    assert db.session.get(Submission, submission_id) is None
+    assert LLMCache.query.count() == 3
@@ -0,0 +1,231 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from app.thematic_analysis import llm_coding
+
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+
+def rate_limited(retry_after=None):
+    headers = {"retry-after": retry_after} if retry_after is not None else {}
+    return openai.RateLimitError("rate limited", response=httpx.Response(429, headers=headers, request=REQUEST),
+                                 body=None)
+
+
+def timed_out():
+    return openai.APITimeoutError(request=REQUEST)
+
+
+class FakeClient:
+    """
+    Stands in for the OpenAI client. reply(feedback text, attempt) returns the
+    completion's content or raises; every call is recorded.
+    """
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.calls = []
+        self.in_flight = self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def with_options(self, **kwargs):
+        return self
+
+    def create(self, **request):
+        text = request["messages"][-1]["content"]
+        with self._lock:
+            attempt = sum(1 for call in self.calls if call == text)
+            self.calls.append(text)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            content = self.reply(text, attempt)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=None)
+
+
+def feedback_of(message):
+    # 'Feedback: "Labs were great"' -> 'Labs were great'
+    return message[len('Feedback: "'):-1]
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    def install(reply):
+        client = FakeClient(reply)
+        monkeypatch.setattr(llm_coding, 'get_client', lambda: client)
+        return client
+    return install
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(time, 'sleep', slept.append)
+    return slept
+
+
+def test_results_come_back_in_input_order_under_concurrency(fake_client):
+    texts = [f"response {i}" for i in range(12)]
+
+    def reply(message, attempt):
+        # Earlier items answer last, so completion order is the reverse of input order
+        i = int(feedback_of(message).split()[1])
+        threading.Event().wait(0.005 * (len(texts) - i))
+        return f"code {i}, theme {i % 3}"
+
+    client = fake_client(reply)
+    results = llm_coding.generate_codewords_bulk(texts, max_workers=4)
+    assert results == [([f"code {i}", f"theme {i % 3}"], None) for i in range(12)]
+    assert client.max_in_flight > 1
+
+
+def test_a_failed_item_does_not_affect_the_others(fake_client):
+    def reply(message, attempt):
+        if feedback_of(message) == "broken":
+            raise ValueError("unparseable request")
+        return feedback_of(message).lower()
+
+    client = fake_client(reply)
+    results = llm_coding.generate_codewords_bulk(["Labs", "broken", "Grading"], max_workers=3)
+    assert results == [(["labs"], None), ([], "unparseable request"), (["grading"], None)]
+    assert client.calls.count('Feedback: "broken"') == 1  # not retryable
+
+
+def test_rate_limits_are_retried_after_the_servers_retry_after(fake_client, sleeps):
+    def reply(message, attempt):
+        if attempt == 0:
+            raise rate_limited(retry_after="3")
+        return "labs"
+
+    client = fake_client(reply)
+    assert llm_coding.generate_codewords_bulk(["Labs"]) == [(["labs"], None)]
+    assert len(client.calls) == 2
+    assert sleeps == [3.0]
+
+
+def test_retry_after_is_capped(fake_client, sleeps, monkeypatch):
+    monkeypatch.setattr(llm_coding, 'LLM_BACKOFF_MAX', 5.0)
+
+    def reply(message, attempt):
+        if attempt == 0:
+            raise rate_limited(retry_after="120")
+        return "labs"
+
+    fake_client(reply)
+    llm_coding.generate_codewords_bulk(["Labs"])
+    assert sleeps == [5.0]
+
+
+def test_timeouts_back_off_exponentially(fake_client, sleeps, monkeypatch):
+    monkeypatch.setattr(llm_coding, 'LLM_BACKOFF_BASE', 0.5)
+
+    def reply(message, attempt):
+        if attempt < 3:
+            raise timed_out()
+        return "labs"
+
+    client = fake_client(reply)
+    assert llm_coding.generate_codewords_bulk(["Labs"]) == [(["labs"], None)]
+    assert len(client.calls) == 4
+    # base * 2^attempt, plus up to 100% jitter
+    for attempt, delay in enumerate(sleeps):
+        assert 0.5 * 2 ** attempt <= delay <= 2 * 0.5 * 2 ** attempt
+
+
+def test_retries_are_bounded(fake_client, sleeps):
+    def reply(message, attempt):
+        if feedback_of(message) == "Labs":
+            raise rate_limited(retry_after="1")
+        return "grading"
+
+    client = fake_client(reply)
+    results = llm_coding.generate_codewords_bulk(["Labs", "Grading"], max_retries=2)
+    assert results[0][0] == [] and "rate limited" in results[0][1]
+    assert results[1] == (["grading"], None)
+    assert client.calls.count('Feedback: "Labs"') == 3
+    assert sleeps == [1.0, 1.0]
+
+
+# ------------- Batched prompts -------------
+
+def batch_reply(entries):
+    return json.dumps({"results": entries})
+
+
+def test_parse_batch_response_places_codes_by_id():
+    content = batch_reply([{"id": 1, "codes": ["slow grading "]}, {"id": 0, "codes": ["labs", ""]}])
+    assert llm_coding.parse_batch_response(content, 2) == [["labs"], ["slow grading"]]
+
+
+@pytest.mark.parametrize("content", [
+    batch_reply([{"id": 0, "codes": ["labs"]}]),                                      # one entry short
+    batch_reply([{"id": i, "codes": ["x"]} for i in range(3)]),                       # one entry too many
+    "labs, grading",                                                                  # not JSON
+    json.dumps({"codes": ["labs", "grading"]}),                                       # no results list
+])
+def test_parse_batch_response_rejects_a_reply_with_the_wrong_count(content):
+    assert llm_coding.parse_batch_response(content, 2) == [None, None]
+
+
+def test_parse_batch_response_leaves_missing_and_duplicate_ids_uncovered():
+    content = batch_reply([{"id": 0, "codes": ["labs"]}, {"id": 0, "codes": ["other"]},
+                           {"id": 7, "codes": ["x"]}, {"id": "3", "codes": ["y"]}])
+    # id 0 keeps its first entry; ids 1-3 are missing, out of range or not an int
+    assert llm_coding.parse_batch_response(content, 4) == [["labs"], None, None, None]
+
+
+def batch_items(message):
+    # 'Feedback items: [{"id": 0, "text": ...}]' -> [(0, text), ...]
+    return [(item["id"], item["text"]) for item in json.loads(message[len("Feedback items: "):])]
+
+
+def test_items_a_batch_leaves_out_fall_back_to_their_own_call(fake_client):
+    def reply(message, attempt):
+        if message.startswith("Feedback items: "):
+            items = batch_items(message)
+            # Answers the right number of entries but repeats the first id instead of the second
+            ids = [i for i, _ in items]
+            ids[1] = ids[0]
+            return batch_reply([{"id": i, "codes": [f"batch {dict(items)[i]}"]} for i in ids])
+        return f"single {feedback_of(message)}"
+
+    client = fake_client(reply)
+    texts = ["a", "b", "c", "d", "e"]
+    results = llm_coding.generate_codewords_bulk(texts, batch_size=3)
+    assert results == [(["batch a"], None), (["single b"], None), (["batch c"], None),
+                       (["batch d"], None), (["single e"], None)]
+    assert sorted(c for c in client.calls if not c.startswith("Feedback items")) == ['Feedback: "b"', 'Feedback: "e"']
+
+
+def test_a_reply_with_the_wrong_count_codes_every_item_on_its_own(fake_client):
+    def reply(message, attempt):
+        if message.startswith("Feedback items: "):
+            return batch_reply([{"id": 0, "codes": ["shifted"]}])
+        return f"single {feedback_of(message)}"
+
+    fake_client(reply)
+    results = llm_coding.generate_codewords_bulk(["a", "b"], batch_size=2)
+    assert results == [(["single a"], None), (["single b"], None)]
+
+
+def test_a_failed_batch_call_falls_back_to_per_item_calls(fake_client, sleeps):
+    def reply(message, attempt):
+        if message.startswith("Feedback items: "):
+            raise timed_out()
+        return f"single {feedback_of(message)}"
+
+    client = fake_client(reply)
+    results = llm_coding.generate_codewords_bulk(["a", "b", "c"], batch_size=3, max_retries=1)
+    assert results == [(["single a"], None), (["single b"], None), (["single c"], None)]
+    assert sum(1 for c in client.calls if c.startswith("Feedback items")) == 2
@@ -0,0 +1,33 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Same list as benchmarks/bench_startup.py: these must only load on first use
+HEAVY_MODULES = ("torch", "sentence_transformers", "sklearn", "matplotlib", "seaborn", "pandas", "openai", "scipy")
+
+PROBES = {
+    "create_app": "from app import create_app\napp = create_app()",
+    "main": "from main import app",
+}
+
+
+@pytest.mark.parametrize("probe", PROBES)
+def test_startup_imports_no_heavy_modules(probe):
+    # A fresh interpreter, so modules imported by other tests don't count
+    script = PROBES[probe] + f"""
+import json, sys
+status = app.test_client().get('/api/debug').status_code
+print(json.dumps({{"status": status, "heavy": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+"""
+    env = dict(os.environ, EMBEDDING_WARMUP='0', DATABASE_URL='sqlite://')
+    output = subprocess.run([sys.executable, '-c', script], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    assert result["heavy"] == []
+    assert result["status"] == 200
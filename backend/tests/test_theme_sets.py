@@ -0,0 +1,129 @@
+import json
+
+import numpy as np
+import pytest
+
+from app import db
+from app.models import ClusterResult, Submission, ThemeSet
+from app.thematic_analysis import core
+from app.thematic_analysis.theme_sets import theme_centers
+from app.thematic_analysis.utils import cluster_submission_codewords, insert_feedback, sync_codewords
+
+
+THEMES = {"Labs": ["lab", "equipment"], "Grading": "grading, marks"}
+SEEDS = {"lab", "equipment", "grading", "marks"}
+
+
+@pytest.fixture
+def encoded(monkeypatch, stub_encoder):
+    # Texts passed to core.encode, which embeds seeds and codewords for clustering
+    stub_encoder()
+    texts = []
+    encode = core.encode
+
+    def recording_encode(batch, *args, **kwargs):
+        texts.extend(batch)
+        return encode(batch, *args, **kwargs)
+    monkeypatch.setattr(core, 'encode', recording_encode)
+    return texts
+
+
+def post(client, payload):
+    # json.dumps keeps the theme order; the test client's json= would sort the keys
+    return client.post('/api/theme_sets', data=json.dumps(payload), content_type='application/json')
+
+
+def save(client, themes=THEMES, name="Course feedback"):
+    return post(client, {"name": name, "themes": themes})
+
+
+@pytest.mark.parametrize("payload", [
+    None,
+    ["not", "an", "object"],
+    {"themes": THEMES},
+    {"name": "  ", "themes": THEMES},
+    {"name": "x" * 201, "themes": THEMES},
+    {"name": "Course feedback"},
+    {"name": "Course feedback", "themes": ["Labs", "Grading"]},
+    {"name": "Course feedback", "themes": {}},
+    {"name": "Course feedback", "themes": {"Labs": [1, 2]}},
+    {"name": "Course feedback", "themes": {"Labs": {"seed": "lab"}}},
+    {"name": "Course feedback", "themes": {"theme[0]": "Labs"}, "seeds": {"seeds[0]": ["lab"]}},
+])
+def test_bad_payloads_answer_400(client, encoded, payload):
+    if payload is None:
+        response = client.post('/api/theme_sets', data="not json", content_type='application/json')
+    else:
+        response = post(client, payload)
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+    assert ThemeSet.query.count() == 0
+
+
+def test_saving_the_same_seeds_again_returns_the_current_version(client, encoded):
+    first = save(client)
+    assert first.status_code == 201
+    assert first.get_json()["version"] == 1
+
+    # Same themes and seeds after normalization, also sent as /cluster form fields
+    again = save(client, {" Labs ": ["Lab", "equipment", "lab"], "Grading": ["grading", "marks"]})
+    form = post(client, {"name": "Course feedback", "themes": {"theme[0]": "Labs", "theme[1]": "Grading"},
+                         "seeds": {"seeds[0]": "lab, equipment", "seeds[1]": "grading,marks"}})
+    for response in (again, form):
+        assert response.status_code == 200
+        assert response.get_json()["id"] == first.get_json()["id"]
+    assert ThemeSet.query.count() == 1
+
+
+def test_changed_seeds_create_the_next_version(client, encoded):
+    first = save(client).get_json()
+    changed = save(client, {"Labs": ["lab", "equipment", "safety"], "Grading": "grading, marks"})
+    assert changed.status_code == 201
+    assert changed.get_json()["version"] == 2
+    assert changed.get_json()["id"] != first["id"]
+
+    # Theme order decides the cluster labels, so reordering is a change too
+    reordered = save(client, {"Grading": "grading, marks", "Labs": ["lab", "equipment", "safety"]})
+    assert reordered.get_json()["version"] == 3
+
+    versions = client.get('/api/theme_sets?name=Course feedback').get_json()["theme_sets"]
+    assert [ts["version"] for ts in versions] == [3, 2, 1]
+
+
+def test_clustering_with_a_theme_set_reuses_its_stored_centroids(client, encoded):
+    theme_set = ThemeSet.query.filter_by(public_id=save(client).get_json()["id"]).one()
+    stored = np.frombuffer(theme_set.centroids, dtype=np.float32).copy()
+    assert SEEDS <= set(encoded)
+
+    submission = Submission(upload_type='file')
+    db.session.add(submission)
+    db.session.commit()
+    sync_codewords(insert_feedback(submission.id, ["a", "b", "c", "d"],
+                                   codewords=["broken equipment", "late marks", "great labs", "unfair grading"]))
+    db.session.commit()
+
+    encoded.clear()
+    cluster_result = cluster_submission_codewords(submission, theme_set=theme_set)
+
+    assert not SEEDS & set(encoded)
+    assert np.frombuffer(theme_set.centroids, dtype=np.float32).tolist() == stored.tolist()
+    assert db.session.get(ClusterResult, cluster_result.id).theme_set_id == theme_set.id
+    assert cluster_result.plot_data["themes"] == ["Labs", "Grading"]
+    assert submission.themes == []  # library themes aren't copied onto the submission
+
+
+def test_centroids_are_recomputed_for_a_new_embedding_space(client, encoded):
+    theme_set = ThemeSet.query.filter_by(public_id=save(client).get_json()["id"]).one()
+    current_space = theme_set.embedding_space
+
+    theme_centers(theme_set)
+    encoded.clear()
+    theme_centers(theme_set)
+    assert encoded == []
+
+    theme_set.embedding_space = "another-model"
+    db.session.commit()
+    centers = theme_centers(theme_set)
+    assert SEEDS == set(encoded)
+    assert centers.shape == (2, theme_set.dim)
+    assert db.session.get(ThemeSet, theme_set.id).embedding_space == current_space
@@ -0,0 +1,35 @@
+import argparse
+from multiprocessing import Process
+
+from app import create_app, db
+from app.jobs import run_worker, requeue_stale
+
+
+def start_worker(poll_interval):
+    app = create_app()
+    run_worker(app, poll_interval=poll_interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run background job workers.')
+    parser.add_argument('--processes', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--poll-interval', type=float, default=None, help='seconds between queue polls')
+    parser.add_argument('--recover', action='store_true',
+                        help='requeue every running job first (use after a full restart)')
+    args = parser.parse_args()
+
+    if args.recover:
+        app = create_app()
+        with app.app_context():
+            print(f"Requeued {requeue_stale(stale_after=0)} interrupted job(s).")
+            db.session.remove()
+            db.engine.dispose()  # don't hand open connections to forked workers
+
+    if args.processes == 1:
+        start_worker(args.poll_interval)
+    else:
+        workers = [Process(target=start_worker, args=(args.poll_interval,)) for _ in range(args.processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
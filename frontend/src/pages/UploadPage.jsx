@@ -142,7 +142,7 @@ export default function UploadPage() {
 
         try {
             setRegeneratingIndex(idx);  // Start loading
-            const response = await axios.post('/api/regenerate_one', { text });
+            const response = await axios.post('/api/regenerate_one', { text, force: true });
             const updated = [...reviewData];
             updated[idx].codewords = response.data.codewords;
             updated[idx].approved = false;